@@ -3,15 +3,29 @@ _is_main = False
 
 
 def create_manager(queue=None, result=None, sync=False,
-                   unknown=None, default_queue=None):  # pragma: no cover
+                   unknown=None, default_queue=None, cluster=False,
+                   codec=None, offload_threshold=None,
+                   offload_ttl=7 * 86400):  # pragma: no cover
     from .manager import Manager
-    from .store import QueueStore, ResultStore
-    from .utils import redis_client
+    from .store import QueueStore, ClusterQueueStore, ResultStore
+    from .utils import redis_client, redis_cluster_client
     '''Helper to create dsq manager
 
     :param queue: Redis url for queue store. [redis://]host[:port]/dbnum.
+                  ``memory://`` selects in-memory stores for tasks and
+                  results, see :py:mod:`dsq.memory`.
     :param result: Redis url for result store. By default it is the
                    same as queue. [redis://]host[:port]/dbnum.
+    :param cluster: Use redis cluster. ``queue`` and ``result`` are urls of
+                    any cluster node. Requires redis-py>=4.1.
+    :param codec: Codec for tasks and results, for example
+                  :py:class:`~.codec.CompactCodec`. By default tasks are
+                  stored as msgpack dicts.
+    :param offload_threshold: Keep task args of this encoded size and larger
+                              under separate payload keys, see
+                              :py:class:`~.store.QueueStore`. Not supported
+                              by in-memory store.
+    :param offload_ttl: Payload key time to live in addition to task delay.
     :returns: :py:class:`~.manager.Manager`
 
     ``sync``, ``unknown`` and ``default_queue`` params are the same as for
@@ -24,8 +38,19 @@ def create_manager(queue=None, result=None, sync=False,
        def add(a, b):
            return a + b
     '''
-    return Manager(QueueStore(redis_client(queue)),
-                   ResultStore(redis_client(result or queue)),
+    if queue == 'memory://':
+        from .memory import MemoryQueueStore, MemoryResultStore
+        return Manager(MemoryQueueStore(codec), MemoryResultStore(),
+                       sync=sync, unknown=unknown, default_queue=default_queue)
+
+    offload = dict(offload_threshold=offload_threshold, offload_ttl=offload_ttl)
+    if cluster:
+        return Manager(ClusterQueueStore(redis_cluster_client(queue), codec, **offload),
+                       ResultStore(redis_cluster_client(result or queue), codec),
+                       sync=sync, unknown=unknown, default_queue=default_queue)
+
+    return Manager(QueueStore(redis_client(queue), codec, **offload),
+                   ResultStore(redis_client(result or queue), codec),
                    sync=sync, unknown=unknown, default_queue=default_queue)
 
 
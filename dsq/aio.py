@@ -0,0 +1,447 @@
+"""Asyncio client API
+
+Async stores share key layout and wire format with sync ones, tasks pushed
+from asyncio code are processed by regular workers. Requires python 3.6+
+and redis-py>=4.2.
+"""
+import os
+import asyncio
+import logging
+from time import time
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+
+from .store import (QueueStore, ResultStore, PAYLOAD_PREFIX, RATE_PREFIX,
+                    notify_key, qname, sitem, token_args, slot_keys, parked_batch,
+                    holder_list)
+from .codec import unpack_args
+from .manager import Manager, Result, Results, Context, batch_results
+from .worker import StopWorker, Limits, QueueOrder
+from .utils import RunFlag, task_fmt
+
+log = logging.getLogger(__name__)
+
+
+class AsyncQueueStore(QueueStore):
+    """Asyncio queue store
+
+    Push, pop and task loading methods are coroutines. Use sync
+    :py:class:`~.store.QueueStore` for administration.
+
+    :param client: ``redis.asyncio.Redis`` client.
+    """
+    async def load_args(self, task):
+        ref = task.get('args_ref')
+        if not ref:
+            return unpack_args(task, self.codec.loads)
+        return self.decode_payload(ref, await self.client.get(PAYLOAD_PREFIX + ref))
+
+    async def push(self, queue, task, eta=None):
+        await self.push_pipe(self.client.pipeline(False), queue, task, eta).execute()
+
+    async def push_unique(self, queue, task, eta=None, replace=False, ttl=3600):
+        payloads, keys, args = self.unique_params(queue, task, eta, replace, ttl)
+        if payloads:
+            pipe = self.client.pipeline(False)
+            self.write_payloads(pipe, payloads)
+            await pipe.execute()
+        result = await self._push_unique(keys, args)
+        if eta:
+            await self.wakeup_pipe(self.client.pipeline(False), eta).execute()
+        return result
+
+    async def release_unique(self, task):
+        await self._release_unique([self.ukey(task.get('queue'), task['unique'])], [task['id']])
+
+    async def push_many(self, items):
+        await self.push_many_pipe(self.client.pipeline(False), items).execute()
+
+    async def pop(self, queue_list, timeout=None, now=None):
+        item = await self.client.blpop([self.qkey(r) for r in queue_list],
+                                       timeout=timeout or 0)
+        if not item:
+            return None, None
+
+        return qname(item[0]), self.codec.loads_task(item[1])
+
+    async def take_token(self, name, rate, period, now=None):
+        return float(await self._take_token([RATE_PREFIX + name],
+                                            token_args(rate, period, now)))
+
+    async def acquire_slot(self, name, limit, holder, queue, task, lease=60, now=None):
+        now = now or time()
+        return bool(await self._acquire_slot(
+            slot_keys(name),
+            [limit, repr(now + lease), holder, repr(now),
+             sitem(queue, self.codec.dumps_task(task))]))
+
+    async def renew_slot(self, name, holder, lease=60):
+        expire = time() + lease
+        await self.client.zadd(slot_keys(name)[0],
+                               dict((r, expire) for r in holder_list(holder)), xx=True)
+
+    async def release_slot(self, name, limit, holder=None, now=None):
+        items = await self._release_slot(slot_keys(name),
+                                         [repr(now or time()), limit] + holder_list(holder))
+        if items:
+            await self.put_many_pipe(self.client.pipeline(False), parked_batch(items)).execute()
+        return len(items)
+
+
+class AsyncResultStore(ResultStore):
+    """Asyncio result store
+
+    :param client: ``redis.asyncio.Redis`` client.
+    """
+    async def set(self, id, value, ttl):
+        nkey = notify_key(id)
+        await (self.client.pipeline(False)
+               .set(id, self.codec.dumps(value), ttl)
+               .rpush(nkey, 1)
+               .expire(nkey, ttl)
+               .execute())
+
+    async def wait(self, id, timeout):
+        value = await self.get(id)
+        if value is not None:
+            return value
+
+        nkey = notify_key(id)
+        if await self.client.blpop([nkey], timeout=timeout):
+            await self._renotify([nkey, id])
+            return await self.get(id)
+
+    async def get_many(self, ids):
+        if not ids:
+            return []
+        mget = getattr(self.client, 'mget_nonatomic', self.client.mget)
+        loads = self.codec.loads
+        return [None if r is None else loads(r) for r in await mget(ids)]
+
+    async def get(self, id):
+        value = await self.client.get(id)
+        if value is not None:
+            return self.codec.loads(value)
+
+
+class AsyncResult(Result):
+    async def ready(self, timeout=None, interval=None):
+        """Fetch task result, see :py:meth:`.manager.Result.ready`"""
+        if self._ready:
+            return self
+
+        if timeout:
+            value = await self.manager.result.wait(self.id, timeout)
+        else:
+            value = await self.manager.result.get(self.id)
+
+        if value is not None:
+            return self._set(value)
+
+
+class AsyncManager(Manager):
+    """Asyncio manager
+
+    Same as :py:class:`~.manager.Manager` but ``push``, ``push_many``,
+    ``gather`` and result fetching are coroutines. ``Task.push`` of
+    registered tasks returns an awaitable too. Sync mode is not supported.
+
+    :param queue: :py:class:`AsyncQueueStore` to use for tasks.
+    :param result: :py:class:`AsyncResultStore` to use for task results.
+    """
+    result_class = AsyncResult
+
+    async def push(self, queue, name, args=None, kwargs=None, unique=None,
+                   debounce=None, **params):
+        """Add task into queue, see :py:meth:`.manager.Manager.push` for params"""
+        task, eta = self.prepare(name, args, kwargs, unique=unique, debounce=debounce, **params)
+        if unique or debounce:
+            task_id = await self.queue.push_unique(
+                queue, task, eta=eta, replace=bool(debounce),
+                ttl=params.get('ttl') or self.default_unique_ttl)
+        else:
+            await self.queue.push(queue, task, eta=eta)
+            task_id = task['id']
+        return AsyncResult(self, task_id.decode())
+
+    async def push_many(self, items, chunk_size=1000, **params):
+        """Add many tasks into queues, see :py:meth:`.manager.Manager.push_many`"""
+        ids = []
+        for chunk in self.prepare_chunks(items, chunk_size, params):
+            await self.queue.push_many([r for r in chunk if type(r) is tuple])
+            for r in chunk:
+                if type(r) is dict:
+                    ids.append((await self.push(**r)).id)
+                else:
+                    ids.append(r[1]['id'].decode())
+
+        return Results(self, ids)
+
+    async def pop(self, queue_list, timeout=None):
+        """Pop item from the first not empty queue in ``queue_list``"""
+        queue, task = await self.queue.pop(queue_list, timeout)
+        if task:
+            task['queue'] = queue
+            return task
+
+    async def process(self, task, now=None, log_exc=True, executor=None):
+        """Process task item
+
+        Coroutine functions are awaited, plain ones are run in ``executor``.
+        See :py:meth:`.manager.Manager.process` for other params.
+        """
+        expire = task.get('expire')
+        tname = task['name']
+        if expire is not None and (now or time()) > expire:
+            if task.get('unique'):
+                await self.queue.release_unique(task)
+            return
+
+        if tname not in self.registry:
+            await self.queue.push(self.unknown, task)
+            log.error('Function for task "%s" not found', tname)
+            return
+
+        if tname in self.concurrency_limits and task.get('queue'):
+            limit = self.concurrency_limits[tname]
+            if not await self.queue.acquire_slot(tname, limit, task['id'], task['queue'],
+                                                 task, self.slot_lease):
+                log.info('Parked %s, all %s slots are busy', task_fmt(task), limit)
+                return
+
+            lease = asyncio.ensure_future(self.renew_slot(tname, task['id']))
+            try:
+                return await self.execute(task, now, log_exc, executor)
+            finally:
+                lease.cancel()
+                await self.queue.release_slot(tname, limit, task['id'])
+
+        return await self.execute(task, now, log_exc, executor)
+
+    async def renew_slot(self, name, holder):
+        while True:
+            await asyncio.sleep(self.slot_lease / 3.0)
+            await self.queue.renew_slot(name, holder, self.slot_lease)
+
+    async def execute(self, task, now=None, log_exc=True, executor=None):
+        """Execute registered task, see :py:meth:`.manager.Manager.execute`"""
+        tname = task['name']
+        func, with_context, init_state = self.registry[tname]
+        if tname in self.rate_limits and self.rate_check(task):
+            delay = await self.queue.take_token(tname, *self.rate_limits[tname], now=now)
+            if delay > 0:
+                log.info('Deferred %s for %.3fs by rate limit', task_fmt(task), delay)
+                task['rate_deferred'] = True
+                await self.queue.push(task['queue'], task, (now or time()) + delay)
+                return
+
+        if task.get('unique'):
+            await self.queue.release_unique(task)
+
+        log.info('Executing %s', task_fmt(task))
+        batch = tname in self.batches
+        try:
+            args, kwargs = await self.queue.load_args(task)
+            if batch:
+                # batches are not collected, task is passed as a batch of one
+                args, kwargs = [[(args, kwargs)]], {}
+
+            if with_context:
+                ctx = Context(self, [task] if batch else task,
+                              init_state and self.get_state(tname, init_state))
+                args = [ctx] + list(args)
+
+            if asyncio.iscoroutinefunction(func):
+                result = await func(*args, **kwargs)
+            else:
+                result = await asyncio.get_event_loop().run_in_executor(
+                    executor, partial(func, *args, **kwargs))
+
+            if batch and not init_state:
+                result = batch_results(result, 1)[0]
+                if isinstance(result, Exception):
+                    raise result
+
+            if not init_state:
+                await self.set_result(task, result, now=now)
+            return result
+        except StopWorker:
+            raise
+        except Exception:
+            await self.set_result(task, exc_info=True, log_exc=log_exc, now=now)
+
+    async def set_result(self, task, result=None, exc_info=None, now=None, log_exc=True):
+        """Set result for task item, see :py:meth:`.manager.Manager.set_result`"""
+        for func, args in self.result_calls(task, result, exc_info, now, log_exc):
+            await func(*args)
+
+    async def as_completed(self, results, timeout=None, interval=0.1):
+        """Async iterator over ready results, see :py:meth:`.manager.Manager.as_completed`"""
+        pending = []
+        for r in results:
+            if r._ready:
+                yield r
+            else:
+                pending.append(r)
+
+        deadline = time() + (timeout or 0)
+        while pending:
+            values = await self.result.get_many([r.id for r in pending])
+            rest = []
+            for r, value in zip(pending, values):
+                if value is None:
+                    rest.append(r)
+                else:
+                    yield r._set(value)
+
+            pending = rest
+            left = deadline - time()
+            if not pending or left <= 0:
+                break
+            await asyncio.sleep(min(interval, left))
+
+    async def gather(self, results, timeout=None, interval=0.1):
+        """Waits for many results, see :py:meth:`.manager.Manager.gather`"""
+        results = list(results)
+        async for _ in self.as_completed(results, timeout, interval):
+            pass
+        return [r if r._ready else None for r in results]
+
+
+class AsyncWorker(object):
+    """Asyncio worker
+
+    Runs up to ``concurrency`` tasks at once. Next task is popped only when
+    there is a free slot, so queue priorities are kept. Plain functions are
+    run in a thread pool of the same size.
+
+    Task timeout cancels the task coroutine. Note, a plain function can't be
+    interrupted and keeps its thread until return.
+
+    Batch tasks are not collected, they are called with a batch of one task.
+
+    :param manager: :py:class:`AsyncManager`.
+    :param lifetime: Max worker lifetime in seconds.
+    :param task_timeout: Default task timeout.
+    :param concurrency: Max amount of tasks in flight.
+    :param max_tasks: Stop after this amount of tasks, see :py:class:`~.worker.Limits`.
+    :param max_memory: Stop after resident memory exceeds this amount of megabytes.
+    :param aging: Queue aging period, see :py:class:`~.worker.QueueOrder`.
+    """
+    def __init__(self, manager, lifetime=None, task_timeout=None, concurrency=10,
+                 max_tasks=None, max_memory=None, aging=None):
+        self.manager = manager
+        self.lifetime = lifetime
+        self.task_timeout = task_timeout
+        self.concurrency = concurrency
+        self.executor = ThreadPoolExecutor(concurrency)
+        self.stopped = False
+        self.limits = Limits(max_tasks, max_memory)
+        self.aging = aging
+
+    async def process_one(self, task):
+        timeout = task.get('timeout', self.task_timeout)
+        try:
+            await asyncio.wait_for(self.manager.process(task, executor=self.executor),
+                                   timeout or None)
+        except asyncio.TimeoutError:
+            log.error('Timeout during processing task %s', task_fmt(task))
+        except StopWorker:
+            self.stopped = True
+        self.limits.done()
+
+    async def process(self, queue_list, burst=False, run=True):
+        """Process tasks until ``run`` flag is set
+
+        :returns: when worker is stopped and all tasks are finished.
+        """
+        slots = asyncio.Semaphore(self.concurrency)
+        running = set()
+        order = QueueOrder(queue_list, self.aging)
+        start = time()
+        while run and not self.stopped:
+            await slots.acquire()
+            if self.stopped or self.limits.reached:
+                break
+
+            task = await self.manager.pop(order(), 1)
+            order.served(task and task['queue'])
+            if task:
+                future = asyncio.ensure_future(self.process_one(task))
+                running.add(future)
+                future.add_done_callback(running.discard)
+                future.add_done_callback(lambda _: slots.release())
+            else:
+                slots.release()
+                if burst:
+                    break
+
+            if self.lifetime and time() - start > self.lifetime:
+                break
+
+        if running:
+            await asyncio.wait(running)
+        self.limits.log('async-{}'.format(os.getpid()))
+        self.executor.shutdown()
+        self.manager.close()
+
+    def start(self, queue_list, burst=False):  # pragma: no cover
+        """Runs event loop until worker is stopped by signal"""
+        asyncio.run(self.process(queue_list, burst, RunFlag()))
+
+
+def from_manager(manager):
+    """Makes async manager with the same tasks and redis servers as sync one
+
+    Allows to use one tasks module for sync and async workers. Only host,
+    port, db and credentials of redis connections are copied. Cluster stores
+    are not supported.
+
+    :param manager: :py:class:`~.manager.Manager`.
+    :returns: :py:class:`AsyncManager`
+    """
+    from redis.asyncio import Redis
+
+    def client(store):
+        kwargs = store.client.connection_pool.connection_kwargs
+        return Redis(**dict((k, kwargs[k]) for k in ('host', 'port', 'db', 'username', 'password')
+                            if k in kwargs))
+
+    queue = manager.queue
+    result = AsyncManager(
+        AsyncQueueStore(client(queue), queue.codec, queue.offload_threshold, queue.offload_ttl),
+        AsyncResultStore(client(manager.result), manager.result.codec),
+        unknown=manager.unknown, default_queue=manager.default_queue)
+    result.registry = manager.registry
+    result.batches = manager.batches
+    result.rate_limits = manager.rate_limits
+    result.concurrency_limits = manager.concurrency_limits
+    result.slot_lease = manager.slot_lease
+    result.states = manager.states
+    result.retry_filters = manager.retry_filters
+    result.default_retry_delay = manager.default_retry_delay
+    result.default_retry_backoff_max = manager.default_retry_backoff_max
+    result.default_unique_ttl = manager.default_unique_ttl
+    return result
+
+
+def create_manager(queue=None, result=None, unknown=None, default_queue=None,
+                   codec=None, offload_threshold=None,
+                   offload_ttl=7 * 86400):  # pragma: no cover
+    """Helper to create asyncio dsq manager
+
+    Params are the same as for :py:func:`dsq.create_manager`.
+
+    :returns: :py:class:`AsyncManager`
+    """
+    from redis.asyncio import Redis
+
+    def client(url):
+        url = url or 'localhost:6379'
+        if not url.startswith('redis://'):
+            url = 'redis://' + url
+        return Redis.from_url(url)
+
+    return AsyncManager(AsyncQueueStore(client(queue), codec, offload_threshold, offload_ttl),
+                        AsyncResultStore(client(result or queue), codec),
+                        unknown=unknown, default_queue=default_queue)
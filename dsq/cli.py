@@ -27,8 +27,26 @@ tasks_help=('Task module. By default dsq searches `manager` '
 @click.option('--lifetime', type=int, help='Max worker lifetime.')
 @click.option('--task-timeout', type=int, help='Kill task after this period of time.')
 @click.option('-b', '--burst', is_flag=True, help='Stop worker after all queue is empty.')
+@click.option('-p', '--prefetch', type=int,
+              help='Fetch up to N tasks at once into worker\'s inflight list. '
+                   'Not supported with --async and --threads.')
+@click.option('--async', 'use_async', is_flag=True,
+              help='Run coroutine tasks concurrently in event loop.')
+@click.option('-c', '--concurrency', type=int, default=10,
+              help='Max amount of concurrent tasks in async mode.')
+@click.option('--threads', type=int, help='Run tasks in a pool of N threads.')
+@click.option('--processes', type=int,
+              help='Fork N worker processes and respawn them on exit.')
+@click.option('--preload-states', is_flag=True,
+              help='Initialize task states before fork. Not supported with --threads.')
+@click.option('--max-tasks', type=int, help='Exit after processing N tasks.')
+@click.option('--max-memory', type=int,
+              help='Exit after resident memory exceeds N megabytes.')
+@click.option('--aging', type=float,
+              help='Serve a non-empty queue first if it waits longer than N seconds.')
 @click.argument('queue', nargs=-1, required=True)
-def worker(tasks, lifetime, task_timeout, burst, queue):
+def worker(tasks, lifetime, task_timeout, burst, prefetch, use_async, concurrency,
+           threads, processes, preload_states, max_tasks, max_memory, aging, queue):
     '''Task executor.
 
     QUEUE is a prioritized queue list. Worker will take tasks from the first queue
@@ -36,46 +54,66 @@ def worker(tasks, lifetime, task_timeout, burst, queue):
 
         dsq worker -t tasks high normal low
 
-    Allows to handle tasks from `high` queue first.
+    Allows to handle tasks from `high` queue first. Queues with weights
+    are served in proportion to them, so busy `high` doesn't starve others:
+
+        dsq worker -t tasks high:5 normal:3 low:1
     '''
+    if use_async and threads:
+        raise click.UsageError('--async and --threads can\'t be used together')
+    if prefetch and (use_async or threads):
+        raise click.UsageError('--prefetch is supported only by default worker, '
+                               'not with --async or --threads')
+    if preload_states and threads:
+        raise click.UsageError('--preload-states can\'t be used with --threads, '
+                               'task states are per-thread')
+
     from .utils import load_manager
-    from .worker import Worker
-    worker = Worker(load_manager(tasks), lifetime=lifetime,
-                    task_timeout=task_timeout)
-    worker.process(queue, burst)
+    from .worker import Worker, ThreadWorker, Prefork
+    manager = load_manager(tasks)
+    if prefetch and not manager.queue.supports_prefetch:
+        raise click.UsageError('--prefetch is not supported by {}'.format(
+            type(manager.queue).__name__))
+
+    if preload_states:
+        manager.init_states()
+
+    limits = dict(lifetime=lifetime, task_timeout=task_timeout,
+                  max_tasks=max_tasks, max_memory=max_memory, aging=aging)
+
+    def run():
+        if use_async:
+            from .aio import AsyncManager, AsyncWorker, from_manager
+            m = manager if isinstance(manager, AsyncManager) else from_manager(manager)
+            AsyncWorker(m, concurrency=concurrency, **limits).start(queue, burst)
+        elif threads:
+            ThreadWorker(manager, threads=threads, **limits).process(queue, burst)
+        else:
+            Worker(manager, prefetch=prefetch, **limits).process(queue, burst)
+
+    if processes:
+        Prefork(run, processes, respawn=not burst).start()
+    else:
+        run()
 
 
 @cli.command()
 @click.option('-t', '--tasks', required=True, help=tasks_help)
 @click.option('-b', '--burst', is_flag=True, help='Stop scheduler after queue is empty.')
-def scheduler(tasks, burst):
-    '''Schedule delayed tasks into execution queues.'''
+@click.option('-l', '--limit', type=int, default=5000,
+              help='Max amount of tasks to move into queues at once.')
+@click.option('--catch-up', type=int,
+              help='Run crontab events missed during last N seconds of downtime.')
+def scheduler(tasks, burst, limit, catch_up):
+    '''Schedule delayed tasks into execution queues and run crontab.'''
     from .utils import RunFlag, load_manager
-    manager = load_manager(tasks)
+    from .sched import Scheduler
+    sched = Scheduler(load_manager(tasks), limit, catch_up)
     run = RunFlag()
     if burst:
-        while run:
-            if not manager.queue.reschedule():
-                break
-            time.sleep(1)
+        sched.burst(run)
     else:
-        now = time.time()
-        timer = manager.periodic.timer(now)
-        timer.add(manager.queue.reschedule, now, 1)
-        timer.add('check-crontab', now, 60)
-        crontab_check = manager.crontab.checker()
-        for next_run, action in timer:
-            now = time.time()
-            if next_run > now:
-                time.sleep(next_run - now)
-
-            if not run:
-                break
-
-            if action == 'check-crontab':
-                crontab_check(next_run)
-            else:
-                action()
+        sched.run(run)
 
 
 @cli.command()
@@ -83,19 +121,26 @@ def scheduler(tasks, burst):
 @click.option('-i', '--interval', type=float, default=1)
 @click.option('-b', '--batch-size', type=int, default=5000)
 @click.option('-s', '--source')
+@click.option('--source-cluster', is_flag=True, help='Source is a redis cluster.')
+@click.option('--dest-cluster', is_flag=True, help='Destination is a redis cluster.')
 @click.argument('dest')
-def forwarder(tasks, interval, batch_size, source, dest):
+def forwarder(tasks, interval, batch_size, source, source_cluster, dest, dest_cluster):
     '''Forward items from one storage to another.'''
-    from .utils import RunFlag, load_manager, redis_client
-    from .store import QueueStore
+    from .utils import RunFlag, load_manager, redis_client, redis_cluster_client
+    from .store import QueueStore, ClusterQueueStore
     log = logging.getLogger('dsq.forwarder')
 
     if not tasks and not source:
         print('--tasks or --source must be provided')
         sys.exit(1)
 
-    s = QueueStore(redis_client(source)) if source else load_manager(tasks).queue
-    d = QueueStore(redis_client(dest))
+    def make_store(url, cluster):
+        if cluster:
+            return ClusterQueueStore(redis_cluster_client(url))
+        return QueueStore(redis_client(url))
+
+    s = make_store(source, source_cluster) if source else load_manager(tasks).queue
+    d = make_store(dest, dest_cluster)
     run = RunFlag()
     while run:
         batch = s.take_many(batch_size)
@@ -175,10 +220,17 @@ def dump_schedule(tasks):
 
 @cli.command('queue-list')
 @click.option('-t', '--tasks', required=True, help=tasks_help)
-def queue_list(tasks):
-    """Print non empty queues"""
+@click.option('--scan', is_flag=True,
+              help='Find existing queues via SCAN and add them into queue registry.')
+def queue_list(tasks, scan):
+    """Print registered queues
+
+    Drained queues stay registered until pruned by stat or forwarder.
+    """
     from .utils import load_manager
     manager = load_manager(tasks)
+    if scan:
+        manager.queue.sync_queues()
     for r in manager.queue.queue_list():
         print(r)
 
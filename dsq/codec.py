@@ -0,0 +1,161 @@
+import zlib
+from functools import partial
+
+import msgpack
+from msgpack import packb, unpackb
+
+from .compat import iteritems
+
+if msgpack.version < (0, 5, 2):  # pragma: no cover
+    msgpack_loads = partial(unpackb, encoding='utf-8')
+elif msgpack.version < (1, 0, 0):  # pragma: no cover
+    msgpack_loads = partial(unpackb, raw=False)
+else:  # pragma: no cover
+    msgpack_loads = partial(unpackb, raw=False, strict_map_key=False)
+
+msgpack_dumps = partial(packb, use_bin_type=True)
+
+#: Compact envelope version, first item of envelope array.
+COMPACT_V1 = 1
+
+#: Positional fields of compact envelope. Other task keys are stored in
+#: an extra dict after them.
+TASK_FIELDS = ('name', 'id', 'args', 'kwargs', 'meta', 'expire', 'dead',
+               'retry', 'retry_delay', 'timeout', 'keep_result')
+TASK_FIELD_SET = frozenset(TASK_FIELDS)
+
+#: Marker of compressed data. 0xc1 byte is never used by msgpack, so
+#: compressed and plain items can be mixed.
+COMPRESSED = b'\xc1'
+
+#: Compressors available for codecs: id byte -> (compress, decompress).
+compressors = {
+    b'z': (zlib.compress, zlib.decompress),
+}
+
+
+def compress(data, threshold, method=b'z'):
+    """Compresses data if it's not shorter than threshold
+
+    Result is marked with :py:data:`COMPRESSED` and compressor id.
+    Data is left as is if compression doesn't make it smaller.
+    """
+    if threshold is None or len(data) < threshold:
+        return data
+
+    result = COMPRESSED + method + compressors[method][0](data)
+    if len(result) < len(data):
+        return result
+    return data
+
+
+def decompress(data):
+    """Decompresses marked data, other data is returned as is"""
+    if data[:1] != COMPRESSED:
+        return data
+    return compressors[data[1:2]][1](data[2:])
+
+
+def compact_task(task):
+    """Converts task dict into compact envelope"""
+    result = [COMPACT_V1]
+    result.extend(task.get(r) for r in TASK_FIELDS)
+    extra = dict(r for r in iteritems(task) if r[0] not in TASK_FIELD_SET)
+    if extra:
+        result.append(extra)
+    else:
+        while result[-1] is None:
+            result.pop()
+    return result
+
+
+def expand_task(value):
+    """Converts compact envelope into task dict
+
+    Legacy dict tasks and other values are returned as is.
+    """
+    if type(value) is not list or not value or value[0] != COMPACT_V1:
+        return value
+
+    task = dict(r for r in zip(TASK_FIELDS, value[1:]) if r[1] is not None)
+    if len(value) > len(TASK_FIELDS) + 1:
+        task.update(value[-1])
+    return task
+
+
+def pack_args(task, dumps):
+    """Moves task args and kwargs into ``args_blob`` field
+
+    Worker can read other task fields without decoding of arguments.
+    """
+    if not isinstance(task, dict) or not (task.get('args') or task.get('kwargs')):
+        return task
+
+    task = task.copy()
+    task['args_blob'] = dumps([task.pop('args', None), task.pop('kwargs', None)])
+    return task
+
+
+def unpack_args(task, loads):
+    """Returns task ``(args, kwargs)`` decoding ``args_blob`` if any"""
+    blob = task.get('args_blob')
+    if blob is None:
+        return task.get('args', ()), task.get('kwargs', {})
+
+    args, kwargs = loads(blob)
+    return args or (), kwargs or {}
+
+
+class MsgpackCodec(object):
+    """Msgpack codec
+
+    Stores tasks as msgpack dicts. It's a default codec compatible with all
+    dsq versions. Reads both dict and compact tasks.
+
+    Custom codecs should implement ``dumps``/``loads`` for results and
+    ``dumps_task``/``loads_task`` for tasks.
+
+    :param compress_threshold: Compress encoded tasks and results of this
+                               size and larger. Compression is off by default.
+                               Compressed data is always decoded.
+    :param compressor: Compressor id from :py:data:`compressors`.
+    :param pack_args: Encode task args and kwargs into a separate blob,
+                      see :py:func:`pack_args`. Expired and unknown tasks
+                      are dropped or forwarded without args decoding.
+                      Blob is compressed on its own, so task fields are
+                      readable without decompression of large args.
+                      Packed tasks are readable by all codecs.
+    """
+    def __init__(self, compress_threshold=None, compressor=b'z', pack_args=False):
+        self.compress_threshold = compress_threshold
+        self.compressor = compressor
+        self.pack_args = pack_args
+
+    def dumps(self, value):
+        return compress(msgpack_dumps(value), self.compress_threshold, self.compressor)
+
+    def loads(self, data):
+        return msgpack_loads(decompress(data))
+
+    def dumps_task(self, task):
+        if self.pack_args:
+            task = pack_args(task, self.dumps)
+        return compress(msgpack_dumps(task), self.compress_threshold, self.compressor)
+
+    def loads_task(self, data):
+        return expand_task(msgpack_loads(decompress(data)))
+
+
+class CompactCodec(MsgpackCodec):
+    """Compact codec
+
+    Stores tasks as positional msgpack arrays without repeated key names.
+    Reads both dict and compact tasks, so it's safe to switch on a working
+    queue. But workers must be upgraded before producers.
+    """
+    def dumps_task(self, task):
+        if self.pack_args:
+            task = pack_args(task, self.dumps)
+        if isinstance(task, dict):
+            task = compact_task(task)
+        return compress(msgpack_dumps(task), self.compress_threshold, self.compressor)
@@ -5,6 +5,8 @@ PY2 = sys.version_info[0] == 2
 if PY2:  # pragma: no cover
     import __builtin__ as builtins
     import urlparse
+    import Queue as queue
+    from thread import get_ident
     range = builtins.xrange
     reduce = builtins.reduce
     string_types = (str, unicode)
@@ -23,6 +25,8 @@ if PY2:  # pragma: no cover
         return data
 else:  # pragma: no cover
     import builtins
+    import queue
+    from threading import get_ident
     from functools import reduce
     from urllib import parse as urlparse
     range = builtins.range
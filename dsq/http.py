@@ -3,6 +3,7 @@ import msgpack
 import logging
 import codecs
 
+from .codec import msgpack_loads
 from .compat import bytestr, PY2, urlparse
 
 log = logging.getLogger('dsq.http')
@@ -47,7 +48,7 @@ class Application(object):
                 return Error('400 BAD REQUEST', 'invalid-encoding', 'Can\'t decode body')
         elif ct == 'application/x-msgpack':
             try:
-                task = msgpack.loads(content, encoding='utf-8')
+                task = msgpack_loads(content)
             except:
                 return Error('400 BAD REQUEST', 'invalid-encoding', 'Can\'t decode body')
         else:
@@ -1,14 +1,18 @@
 from __future__ import print_function
 
 import sys
+import random
 import logging
 import traceback
 from time import time, sleep
+from functools import partial
+from hashlib import sha1
 
-from .utils import make_id, task_fmt, safe_call
+from .utils import make_id, task_fmt, safe_call, iter_chunks, parse_rate, Repeat
 from .worker import StopWorker
 from .sched import Timer, Crontab
-from .compat import PY2
+from .codec import msgpack_dumps
+from .compat import PY2, get_ident
 
 log = logging.getLogger(__name__)
 
@@ -19,6 +23,31 @@ def make_task(name, **kwargs):
     return dict(r for r in kwargs.items() if r[1] is not None)
 
 
+def unique_key(name, args=None, kwargs=None, key=None):
+    """Returns unique key of task
+
+    :param key: Callable to make key from task arguments. By default
+                key is a hash of arguments, kwargs order doesn't matter.
+    """
+    if callable(key):
+        return '{}:{}'.format(name, key(*(args or ()), **(kwargs or {})))
+    kwargs = kwargs and sorted(kwargs.items())
+    return '{}:{}'.format(name, sha1(msgpack_dumps([args, kwargs])).hexdigest())
+
+
+def batch_results(result, size):
+    """Returns per-task results of batch function call
+
+    :raises ValueError: if result is not None or a list of ``size`` items.
+    """
+    if result is None:
+        return [None] * size
+    if not isinstance(result, list) or len(result) != size:
+        raise ValueError('Batch function must return None or a list of {} results'
+                         .format(size))
+    return result
+
+
 class Task(object):
     def __init__(self, manager, func, **params):
         self.manager = manager
@@ -31,6 +60,12 @@ class Task(object):
     def push(self, *args, **kwargs):
         return self.manager.push(args=args or None, kwargs=kwargs or None, **self.params)
 
+    def push_many(self, items, **params):
+        """Push many tasks at once, see :py:meth:`Manager.push_many`"""
+        new_params = self.params.copy()
+        new_params.update(params)
+        return self.manager.push_many(items, **new_params)
+
     def modify(self, **params):
         new_params = self.params.copy()
         new_params.update(params)
@@ -60,33 +95,80 @@ class Result(object):
             self._ready = True
             self.value = value
 
-    def _fetch(self, timeout, interval):
-        now = time() + (timeout or 0)
-        while True:
-            result = self.manager.result.get(self.id)
-            if result is not None:
-                return result
-            if time() > now:
-                break
-            sleep(interval)
+    def ready(self, timeout=None, interval=None):
+        """Fetch task result
 
-    def ready(self, timeout=None, interval=1.0):
+        :param timeout: Wait result for this amount of seconds. Worker notifies
+                        waiters as soon as result is set. By default result
+                        is checked once.
+        :param interval: Not used, left for compatibility.
+        :returns: self if result is ready or None.
+        """
         if self._ready:
             return self
 
-        value = self._fetch(timeout, interval=interval)
+        if timeout:
+            value = self.manager.result.wait(self.id, timeout)
+        else:
+            value = self.manager.result.get(self.id)
+
         if value is not None:
-            if 'error' in value:
-                self.error = value['error']
-                self.error_message = value['message']
-                self.error_trace = value['trace']
-            else:
-                self.value = value['result']
-            self._ready = True
-            return self
+            return self._set(value)
 
         return None
 
+    def _set(self, value):
+        if 'error' in value:
+            self.error = value['error']
+            self.error_message = value['message']
+            self.error_trace = value['trace']
+        else:
+            self.value = value['result']
+        self._ready = True
+        return self
+
+
+class Results(object):
+    """Lazy sequence of :py:class:`Result` handles for pushed task ids
+
+    Handles are created on first access and kept, so ready state is
+    fetched once.
+    """
+    def __init__(self, manager, ids):
+        self.manager = manager
+        self.ids = ids
+        self.items = [None] * len(ids)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return [self[r] for r in range(*idx.indices(len(self.ids)))]
+
+        item = self.items[idx]
+        if item is None:
+            item = self.items[idx] = self.manager.result_class(self.manager, self.ids[idx])
+        return item
+
+    def __iter__(self):
+        for idx in range(len(self.ids)):
+            yield self[idx]
+
+
+def item_params(item):
+    if isinstance(item, dict):
+        return item
+
+    params = {}
+    if item[0]:
+        params['args'] = item[0]
+    if len(item) > 1 and item[1]:
+        params['kwargs'] = item[1]
+    if len(item) > 2 and item[2]:
+        params.update(item[2])
+    return params
+
 
 class Manager(object):
     """DSQ manager
@@ -100,20 +182,38 @@ class Manager(object):
     :param unknown: Name of unknown queue for tasks for which there is no registered functions.
                     Default is 'unknown'.
     :param default_queue: Name of default queue. Default is 'dsq'.
+
+    Set ``thread_states`` attribute to make task states per-thread. It's
+    done by threaded worker.
     """
+    result_class = Result
+
     def __init__(self, queue, result=None, sync=False, unknown=None, default_queue=None):
         self.queue = queue
         self.result = result
         self.sync = sync
         self.registry = {}
+        self.batches = {}
+        self.rate_limits = {}
+        self.concurrency_limits = {}
+        self.retry_filters = {}
         self.states = {}
         self.unknown = unknown or 'unknown'
         self.default_queue = default_queue or 'dsq'
         self.default_retry_delay = 60
+        self.default_retry_backoff_max = 3600
+        self.default_unique_ttl = 3600
+        self.slot_lease = 60
+        self.batch_heartbeat = 60
+        self.batch_poll_interval = 0.05
+        self.thread_states = False
         self.crontab = CrontabCollector()
         self.periodic = PeriodicCollector()
 
     def get_state(self, name, init):
+        if self.thread_states:
+            name = name, get_ident()
+
         try:
             return self.states[name]
         except KeyError:
@@ -122,12 +222,20 @@ class Manager(object):
         result = self.states[name] = init()
         return result
 
+    def init_states(self):
+        """Initializes states of all registered stateful tasks"""
+        for name, (_, _, init_state) in self.registry.items():
+            if init_state:
+                self.get_state(name, init_state)
+
     def close(self):
         for s in self.states.values():
             if hasattr(s, 'close'):
                 s.close()
 
-    def task(self, name=None, queue=None, with_context=False, init_state=None, **kwargs):
+    def task(self, name=None, queue=None, with_context=False, init_state=None,
+             batch_size=None, batch_wait=0, rate_limit=None, concurrency=None,
+             retry_on=None, **kwargs):
         r"""Task decorator
 
         Function wrapper to register task in manager and provide simple interface to calling it.
@@ -136,6 +244,11 @@ class Manager(object):
         :param queue: Queue name to use.
         :param with_context: Provide task context as first task argument.
         :param init_state: Task state initializer.
+        :param batch_size: Make batch task, see :py:meth:`register`.
+        :param batch_wait: Batch collecting time.
+        :param rate_limit: Task rate limit, see :py:meth:`register`.
+        :param concurrency: Max amount of running tasks, see :py:meth:`register`.
+        :param retry_on: Retry only these exceptions, see :py:meth:`register`.
         :param \*\*kwrags: Rest params as for :py:meth:`push`.
 
         ::
@@ -155,7 +268,8 @@ class Manager(object):
         """
         def decorator(func):
             fname = tname or func.__name__
-            self.register(fname, func, with_context, init_state)
+            self.register(fname, func, with_context, init_state, batch_size, batch_wait,
+                          rate_limit, concurrency, retry_on)
             return Task(self, func, queue=queue or self.default_queue, name=fname, **kwargs)
 
         if callable(name):
@@ -165,13 +279,44 @@ class Manager(object):
         tname = name
         return decorator
 
-    def register(self, name, func, with_context=False, init_state=None):
+    def register(self, name, func, with_context=False, init_state=None,
+                 batch_size=None, batch_wait=0, rate_limit=None, concurrency=None,
+                 retry_on=None):
         """Register task
 
         :param name: Task name.
         :param func: Function.
         :param with_context: Provide task context as first task argument.
         :param init_state: Task state initializer.
+        :param batch_size: Make batch task. Worker collects up to this amount
+                           of tasks from the same queue and calls function
+                           once with a list of ``(args, kwargs)`` tuples.
+                           Collecting stops at a task with other name, so
+                           batch tasks should have their own queue. Function
+                           must return None or a list of per-item results,
+                           exception instances in it are handled as item
+                           errors. Context's ``task`` is a list of tasks for
+                           batch tasks. Queue store must support prefetch,
+                           otherwise tasks are processed one by one.
+        :param batch_wait: Wait up to this amount of seconds for a full batch.
+                           By default only already queued tasks are taken.
+        :param rate_limit: Max task rate across all workers: ``'100/s'``,
+                           ``'10/m'``, ``'1000/h'`` or tasks per second.
+                           Up to a rate amount of tasks can be run at once
+                           after idle period. Tasks over the limit are
+                           deferred via schedule until their reserved time,
+                           so the scheduler must be running. Every task of
+                           a batch takes a token, batch isn't extended over
+                           the limit.
+        :param concurrency: Max amount of tasks running at once across all
+                            workers. Worker takes a slot with ``slot_lease``
+                            seconds lease and renews it while task is
+                            running. If all slots are busy, task is parked
+                            and returned into its queue when a slot is
+                            freed. Scheduler frees slots of dead workers.
+        :param retry_on: Exception class or tuple of classes. Task is retried
+                         only on these exceptions, others go straight to
+                         dead-letter queue and result.
 
         ::
 
@@ -182,10 +327,30 @@ class Manager(object):
             manager.push('normal', 'add', (1, 2), keep_result=300)
         """
         self.registry[name] = (func, with_context or init_state, init_state)
+        if batch_size:
+            self.batches[name] = batch_size, batch_wait
+        else:
+            self.batches.pop(name, None)
+
+        if rate_limit:
+            self.rate_limits[name] = parse_rate(rate_limit)
+        else:
+            self.rate_limits.pop(name, None)
+
+        if concurrency:
+            self.concurrency_limits[name] = concurrency
+        else:
+            self.concurrency_limits.pop(name, None)
+
+        if retry_on:
+            self.retry_filters[name] = retry_on
+        else:
+            self.retry_filters.pop(name, None)
 
     def push(self, queue, name, args=None, kwargs=None, meta=None, ttl=None,
              eta=None, delay=None, dead=None, retry=None, retry_delay=None,
-             timeout=None, keep_result=None):
+             timeout=None, keep_result=None, unique=None, debounce=None,
+             retry_backoff=None, retry_backoff_max=None, retry_jitter=None):
         """Add task into queue
 
         :param queue: Queue name.
@@ -199,26 +364,168 @@ class Manager(object):
         :param dead: Name of dead-letter queue.
         :param retry: Retry task execution after exception. True - forever,
                       number - retry this amount.
-        :param retry_delay: Delay between retry attempts.
+        :param retry_delay: Delay between retry attempts. It's a base delay
+                            for backoff.
+        :param retry_backoff: Double retry delay after each attempt.
+        :param retry_backoff_max: Max backoff delay, 3600 seconds by default.
+        :param retry_jitter: Use random retry delay between zero and
+                             computed one to spread retries of many tasks
+                             failed at the same time.
         :param timeout: Task execution timeout.
         :param keep_result: Keep task return value for this amount of seconds.
                             Result is ignored by default.
+        :param unique: Don't push task if there is a pending task with
+                       the same name and arguments. Could be a callable
+                       which returns a key from task arguments. Result
+                       for a pending task is returned in this case.
+        :param debounce: Delay task for this amount of seconds and replace
+                         pending scheduled task with the same unique key.
+                         So only the last push is executed.
         """
         if self.sync:
             task = make_task(name=name, args=args, kwargs=kwargs, meta=meta)
             result = self.process(task)
             return Result(self, task['id'], result)
 
+        task, eta = self.prepare(name, args=args, kwargs=kwargs, meta=meta,
+                                 ttl=ttl, eta=eta, delay=delay, dead=dead,
+                                 retry=retry, retry_delay=retry_delay,
+                                 timeout=timeout, keep_result=keep_result,
+                                 unique=unique, debounce=debounce,
+                                 retry_backoff=retry_backoff,
+                                 retry_backoff_max=retry_backoff_max,
+                                 retry_jitter=retry_jitter)
+        if unique or debounce:
+            task_id = self.queue.push_unique(queue, task, eta=eta, replace=bool(debounce),
+                                             ttl=ttl or self.default_unique_ttl)
+        else:
+            self.queue.push(queue, task, eta=eta)
+            task_id = task['id']
+        return Result(self, task_id if PY2 else task_id.decode())
+
+    def prepare(self, name, args=None, kwargs=None, meta=None, ttl=None,
+                eta=None, delay=None, dead=None, retry=None, retry_delay=None,
+                timeout=None, keep_result=None, unique=None, debounce=None,
+                retry_backoff=None, retry_backoff_max=None, retry_jitter=None):
+        """Make task item from :py:meth:`push` params
+
+        :returns: ``(task, eta)`` tuple.
+        """
+        if debounce and not eta:
+            delay = delay or debounce
+
         if delay:
             eta = time() + delay
 
         task = make_task(name=name, args=args, kwargs=kwargs, meta=meta,
                          expire=ttl and (time() + ttl), dead=dead, retry=retry,
                          retry_delay=retry_delay, timeout=timeout,
-                         keep_result=keep_result)
-        self.queue.push(queue, task, eta=eta)
-        task_id = task['id'] if PY2 else task['id'].decode()
-        return Result(self, task_id)
+                         keep_result=keep_result, retry_backoff=retry_backoff or None,
+                         retry_backoff_max=retry_backoff_max,
+                         retry_jitter=retry_jitter or None)
+        if unique or debounce:
+            task['unique'] = unique_key(name, args, kwargs, unique)
+        return task, eta
+
+    def push_many(self, items, chunk_size=1000, **params):
+        r"""Add many tasks into queues in bulk
+
+        Input is consumed in ``chunk_size`` chunks and every chunk is written
+        in one round trip.
+
+        :param items: Iterable of ``(args, kwargs)``, ``(args, kwargs, params)``
+                      tuples or dicts with :py:meth:`push` params.
+        :param chunk_size: Amount of tasks to send at once.
+        :param \*\*params: Default :py:meth:`push` params for every item.
+        :returns: :py:class:`Results` sequence.
+
+        ::
+
+            manager.push_many([((1, 2), None), ((3, 4), None, {'delay': 10})],
+                              queue='normal', name='add')
+            add.push_many(((r,), None) for r in range(100000))
+        """
+        if self.sync:
+            return [self.push(**dict(params, **item_params(r))) for r in items]
+
+        ids = []
+        for chunk in self.prepare_chunks(items, chunk_size, params):
+            self.queue.push_many([r for r in chunk if type(r) is tuple])
+            for r in chunk:
+                if type(r) is dict:
+                    ids.append(self.push(**r).id)
+                else:
+                    ids.append(r[1]['id'] if PY2 else r[1]['id'].decode())
+
+        return Results(self, ids)
+
+    def prepare_chunks(self, items, chunk_size, params):
+        """Yields chunks of prepared ``(queue, task, eta)`` tuples
+
+        Unique and debounced tasks can't be pushed in bulk, they are
+        left as dicts with :py:meth:`push` params.
+        """
+        for chunk in iter_chunks(items, chunk_size):
+            result = []
+            for r in chunk:
+                p = params.copy()
+                p.update(item_params(r))
+                if p.get('unique') or p.get('debounce'):
+                    result.append(p)
+                else:
+                    queue = p.pop('queue')
+                    task, eta = self.prepare(**p)
+                    result.append((queue, task, eta))
+            yield result
+
+    def as_completed(self, results, timeout=None, interval=0.1):
+        """Yields results as soon as they are ready
+
+        Each poll fetches all pending results in one round trip.
+
+        :param results: Iterable of :py:class:`Result` handles.
+        :param timeout: Wait results for this amount of seconds. By default
+                        results are checked once. Iteration stops on timeout,
+                        pending results are not yielded.
+        :param interval: Poll interval in seconds.
+        """
+        pending = []
+        for r in results:
+            if r._ready:
+                yield r
+            else:
+                pending.append(r)
+
+        deadline = time() + (timeout or 0)
+        while pending:
+            values = self.result.get_many([r.id for r in pending])
+            rest = []
+            for r, value in zip(pending, values):
+                if value is None:
+                    rest.append(r)
+                else:
+                    yield r._set(value)
+
+            pending = rest
+            left = deadline - time()
+            if not pending or left <= 0:
+                break
+            sleep(min(interval, left))
+
+    def gather(self, results, timeout=None, interval=0.1):
+        """Waits for many results
+
+        :param results: Iterable of :py:class:`Result` handles.
+        :param timeout: Wait results for this amount of seconds. By default
+                        results are checked once.
+        :param interval: Poll interval in seconds.
+        :returns: list of results in the same order, None for
+                  not ready ones.
+        """
+        results = list(results)
+        for _ in self.as_completed(results, timeout, interval):
+            pass
+        return [r if r._ready else None for r in results]
 
     def pop(self, queue_list, timeout=None):
         """Pop item from the first not empty queue in ``queue_list``
@@ -238,6 +545,22 @@ class Manager(object):
             task['queue'] = queue
             return task
 
+    def prefetch(self, queue_list, owner, count, heartbeat=60):
+        """Move up to ``count`` tasks from prioritized ``queue_list`` into owner's inflight list
+
+        Processed tasks must be confirmed via :py:meth:`~.store.QueueStore.ack`.
+
+        :param queue_list: List of queue names.
+        :param owner: Inflight list owner (worker id).
+        :param count: Max amount of tasks to fetch.
+        :param heartbeat: Owner's heartbeat time to live.
+        """
+        tasks = []
+        for queue, task in self.queue.prefetch(queue_list, owner, count, heartbeat):
+            task['queue'] = queue
+            tasks.append(task)
+        return tasks
+
     def process(self, task, now=None, log_exc=True):
         """Process task item
 
@@ -248,21 +571,55 @@ class Manager(object):
         expire = task.get('expire')
         tname = task['name']
         if expire is not None and (now or time()) > expire:
+            if task.get('unique'):
+                self.queue.release_unique(task)
             return
 
-        try:
-            func, with_context, init_state = self.registry[tname]
-        except KeyError:
+        if tname not in self.registry:
             if self.sync:
-                raise
+                raise KeyError(tname)
             self.queue.push(self.unknown, task)
             log.error('Function for task "%s" not found', tname)
             return
 
-        args = task.get('args', ())
-        kwargs = task.get('kwargs', {})
+        if tname in self.concurrency_limits and not self.sync and task.get('queue'):
+            limit = self.concurrency_limits[tname]
+            if not self.queue.acquire_slot(tname, limit, task['id'], task['queue'],
+                                           task, self.slot_lease):
+                log.info('Parked %s, all %s slots are busy', task_fmt(task), limit)
+                return
+
+            lease = Repeat(partial(self.queue.renew_slot, tname, task['id'], self.slot_lease),
+                           self.slot_lease / 3.0, log)
+            try:
+                return self.execute(task, now, log_exc)
+            finally:
+                lease.stop()
+                self.queue.release_slot(tname, limit, task['id'])
+
+        return self.execute(task, now, log_exc)
+
+    def execute(self, task, now=None, log_exc=True):
+        """Execute registered task without expiration and concurrency checks
+
+        Params are the same as for :py:meth:`process`.
+        """
+        tname = task['name']
+        func, with_context, init_state = self.registry[tname]
+        if tname in self.rate_limits and self.rate_check(task):
+            delay = self.queue.take_token(tname, *self.rate_limits[tname], now=now)
+            if self.defer(task, delay, now):
+                return
+
+        if tname in self.batches:
+            return self.execute_batch(task, now, log_exc)
+
+        if task.get('unique'):
+            self.queue.release_unique(task)
+
         log.info('Executing %s', task_fmt(task))
         try:
+            args, kwargs = self.queue.load_args(task)
             if with_context:
                 ctx = Context(self, task, init_state and self.get_state(tname, init_state))
                 result = func(ctx, *args, **kwargs)
@@ -277,6 +634,185 @@ class Manager(object):
         except Exception:
             self.set_result(task, exc_info=True, log_exc=log_exc, now=now)
 
+    def wake_parked(self):
+        """Frees slots of expired leases and returns parked tasks into queues
+
+        Scheduler calls it to recover slots of dead workers.
+
+        :returns: amount of woken tasks.
+        """
+        return sum(self.queue.release_slot(name, limit)
+                   for name, limit in self.concurrency_limits.items())
+
+    def rate_check(self, task):
+        """Returns True if task must take a rate limit token
+
+        Deferred tasks have a token already.
+        """
+        return not self.sync and task.get('queue') and not task.pop('rate_deferred', None)
+
+    def defer(self, task, delay, now=None):
+        """Pushes rate limited task back to its queue after ``delay`` seconds
+
+        :returns: True if task is deferred.
+        """
+        if delay <= 0:
+            return False
+        log.info('Deferred %s for %.3fs by rate limit', task_fmt(task), delay)
+        task['rate_deferred'] = True
+        self.queue.push(task['queue'], task, (now or time()) + delay)
+        return True
+
+    def execute_batch(self, task, now=None, log_exc=True):
+        """Collect more tasks for batch ``task`` and process them in one call
+
+        Extra tasks take rate limit tokens and concurrency slots without
+        deferring and parking, tasks over the limits stay in the queue.
+        Collected tasks are kept in an inflight list until the call is done
+        and are returned into the queue head on any error.
+
+        :returns: function result.
+        """
+        tname = task['name']
+        size = self.batches[tname][0]
+        queue = task.get('queue')
+        if self.sync or not queue or not self.queue.supports_prefetch:
+            return self.process_batch([task], now, log_exc)
+
+        owner = 'batch-' + make_id().decode('ascii')
+        count, tokens = size - 1, 0
+        rate = self.rate_limits.get(tname)
+        if rate and count:
+            count = tokens = self.queue.take_tokens(tname, *rate, count=count, now=now)
+
+        holders = []
+        limit = self.concurrency_limits.get(tname)
+        if limit and count:
+            holders = ['{}:{}'.format(owner, i) for i in range(count)]
+            count = self.queue.acquire_slots(tname, limit, holders, self.slot_lease)
+            holders = holders[:count]
+
+        if not count:
+            if tokens:
+                self.queue.take_tokens(tname, *rate, count=-tokens, now=now)
+            return self.process_batch([task], now, log_exc)
+
+        beat = Repeat(partial(self.renew_batch, tname, owner, holders),
+                      min(self.batch_heartbeat, self.slot_lease) / 3.0, log)
+        try:
+            extra = self.collect_batch(task, owner, count)
+            if tokens:
+                # deferred tasks have their tokens already
+                tokens -= sum(1 for r in extra if not r.pop('rate_deferred', None))
+                if tokens:
+                    self.queue.take_tokens(tname, *rate, count=-tokens, now=now)
+            if len(holders) > len(extra):
+                self.queue.release_slot(tname, limit, holders[len(extra):])
+                holders = holders[:len(extra)]
+
+            result = self.process_batch([task] + extra, now, log_exc)
+            self.queue.ack(owner, len(extra), self.batch_heartbeat)
+            return result
+        finally:
+            beat.stop()
+            self.queue.requeue_inflight(owner)
+            if holders:
+                self.queue.release_slot(tname, limit, holders)
+
+    def renew_batch(self, name, owner, holders):
+        self.queue.ack(owner, 0, self.batch_heartbeat)
+        if holders:
+            self.queue.renew_slot(name, holders, self.slot_lease)
+
+    def collect_batch(self, task, owner, count):
+        """Moves up to ``count`` more tasks from the task's queue into owner's inflight list
+
+        Waits up to ``batch_wait`` seconds until batch is full. Collecting stops
+        at a task with other name, it's returned into the queue head.
+
+        :returns: list of collected tasks.
+        """
+        tname = task['name']
+        queue = task['queue']
+        deadline = time() + self.batches[tname][1]
+        tasks = []
+        while len(tasks) < count:
+            items = self.prefetch([queue], owner, count - len(tasks), self.batch_heartbeat)
+            for i, r in enumerate(items):
+                if r['name'] != tname:
+                    tasks.extend(items[:i])
+                    self.queue.requeue_inflight(owner, keep=len(tasks))
+                    return tasks
+            tasks.extend(items)
+
+            if not items:
+                left = deadline - time()
+                if left <= 0:
+                    break
+                sleep(min(left, self.batch_poll_interval))
+        return tasks
+
+    def process_batch(self, tasks, now=None, log_exc=True):
+        """Process tasks of one batch task in a single call
+
+        :returns: function result.
+        """
+        tname = tasks[0]['name']
+        func, with_context, init_state = self.registry[tname]
+        batch = []
+        for task in tasks:
+            expire = task.get('expire')
+            if task.get('unique'):
+                self.queue.release_unique(task)
+            if expire is None or (now or time()) <= expire:
+                batch.append(task)
+
+        if not batch:
+            return
+
+        log.info('Executing batch of %s %s tasks', len(batch), tname)
+        try:
+            items = [self.queue.load_args(r) for r in batch]
+            if with_context:
+                ctx = Context(self, batch, init_state and self.get_state(tname, init_state))
+                result = func(ctx, items)
+            else:
+                result = func(items)
+            if not init_state:
+                results = batch_results(result, len(batch))
+        except StopWorker:
+            raise
+        except Exception:
+            exc_info = sys.exc_info()
+            for task in batch:
+                self.set_result(task, exc_info=exc_info, log_exc=log_exc, now=now)
+            return
+
+        if not init_state:
+            for task, r in zip(batch, results):
+                if isinstance(r, Exception):
+                    if self.sync:
+                        raise r
+                    self.set_result(task, exc_info=(type(r), r, None),
+                                    log_exc=log_exc, now=now)
+                else:
+                    self.set_result(task, r, now=now)
+        return result
+
+    def retry_eta(self, task, now=None):
+        """Returns ETA of the next task attempt
+
+        Delay is doubled after each attempt with ``retry_backoff`` and
+        randomized with ``retry_jitter``.
+        """
+        delay = task.get('retry_delay', self.default_retry_delay)
+        if delay and task.get('retry_backoff'):
+            delay = min(delay * 2 ** min(task.get('attempt', 0), 32),
+                        task.get('retry_backoff_max', self.default_retry_backoff_max))
+        if delay and task.get('retry_jitter'):
+            delay = random.uniform(0, delay)
+        return delay and (now or time()) + delay
+
     def set_result(self, task, result=None, exc_info=None, now=None, log_exc=True):
         """Set result for task item
 
@@ -286,6 +822,16 @@ class Manager(object):
         :param now: Unix timestamp to set ``eta`` on retry.
         :param log_exc: Log exc_info if any. ``True`` by default.
         """
+        for func, args in self.result_calls(task, result, exc_info, now, log_exc):
+            func(*args)
+
+    def result_calls(self, task, result=None, exc_info=None, now=None, log_exc=True):
+        """Returns store calls to set task result
+
+        Params are the same as for :py:meth:`set_result`.
+
+        :returns: list of ``(func, args)`` tuples.
+        """
         keep_result = task.get('keep_result')
         if exc_info:
             if exc_info is True:
@@ -298,39 +844,47 @@ class Manager(object):
                 log.exception('Error during processing task %s', task_fmt(task), exc_info=exc_info)
 
             retry = task.get('retry')
-            if retry and retry > 0:
+            retry_on = self.retry_filters.get(task['name'])
+            if retry and retry > 0 and (not retry_on or issubclass(exc_info[0], retry_on)):
                 if retry is not True:
                     task['retry'] -= 1
 
-                retry_delay = task.get('retry_delay', self.default_retry_delay)
-                eta = retry_delay and (now or time()) + retry_delay
-                self.queue.push(task['queue'], task, eta=eta)
-                return
+                eta = self.retry_eta(task, now)
+                task['attempt'] = task.get('attempt', 0) + 1
+                return [(self.queue.push, (task['queue'], task, eta))]
 
+            calls = []
             if task.get('dead'):
                 task.pop('retry', None)
                 task.pop('retry_delay', None)
-                self.queue.push(task['dead'], task)
+                calls.append((self.queue.push, (task['dead'], task)))
 
             if keep_result:
                 result = {'error': exc_info[0].__name__,
                           'message': '{}'.format(exc_info[1]),
                           'trace': ''.join(traceback.format_exception(*exc_info))}
-                self.result.set(task['id'], result, keep_result)
+                calls.append((self.result.set, (task['id'], result, keep_result)))
+            return calls
         else:
-            if keep_result:
-                self.result.set(task['id'], {'result': result}, keep_result)
             log.info('Done %s', task_fmt(task))
+            if keep_result:
+                return [(self.result.set, (task['id'], {'result': result}, keep_result))]
+            return []
 
 
 class CrontabCollector(object):
     def __init__(self):
         self.entries = []
 
-    def checker(self):
+    def crontab(self):
+        """Returns :py:class:`~.sched.Crontab` with collected entries"""
         crontab = Crontab()
         for r in self.entries:
             crontab.add(*r)
+        return crontab
+
+    def checker(self):
+        crontab = self.crontab()
 
         def check(ts):
             for action in crontab.actions_ts(ts):
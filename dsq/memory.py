@@ -0,0 +1,413 @@
+from time import time
+from copy import deepcopy
+from heapq import heappush, heappop
+from itertools import count, islice
+from collections import deque
+from threading import Condition, Lock
+
+from .codec import MsgpackCodec, unpack_args
+from .store import PayloadError, sitem, ritem, holder_list
+from .compat import iteritems, PY2
+
+
+class MemoryQueueStore(object):
+    """In-memory queue store
+
+    Thread-safe store for a single process: embedded workers, tests and
+    benchmarks. Tasks are kept as dicts in per-queue deques and a heap-backed
+    schedule, so they are not encoded on push and pop. Pushed tasks are
+    copied, changes of task args after push don't affect queued task.
+    Codec is used only to exchange items with other stores via
+    ``take_many``/``put_many``.
+
+    Tasks are lost on process exit. Args offloading is not supported,
+    offloaded args of tasks from ``put_many`` batches are inlined.
+
+    :param codec: Task codec for ``take_many``/``put_many``.
+    """
+    shared_schedule = True
+    supports_prefetch = True
+
+    def __init__(self, codec=None):
+        self.codec = codec or MsgpackCodec()
+        self.cond = Condition(Lock())
+        self.queues = {}
+        self.schedule = []
+        self.cancelled = 0
+        self.unique = {}
+        self.inflight = {}
+        self.heartbeats = {}
+        self.buckets = {}
+        self.slots = {}
+        self.parked = {}
+        self.crontab_last = None
+        self._seq = count()
+
+    def _schedule(self, queue, task, eta):
+        entry = [eta, next(self._seq), queue, task]
+        heappush(self.schedule, entry)
+        return entry
+
+    def _pop_schedule(self):
+        # popped entry is marked as cancelled, so replacing of unique
+        # task doesn't count it twice
+        entry = heappop(self.schedule)
+        task, entry[3] = entry[3], None
+        if task is None:
+            self.cancelled -= 1
+        return entry[0], entry[2], task
+
+    def _push(self, queue, task, eta):
+        assert ':' not in queue, 'Queue name must not contain colon: "{}"'.format(queue)
+        task = deepcopy(task)
+        if eta:
+            return self._schedule(queue, task, eta)
+        self.queues.setdefault(queue, deque()).append(task)
+
+    def load_args(self, task):
+        ref = task.get('args_ref')
+        if ref:
+            raise PayloadError(ref)
+        return unpack_args(task, self.codec.loads)
+
+    def push(self, queue, task, eta=None):
+        with self.cond:
+            self._push(queue, task, eta)
+            self.cond.notify_all()
+
+    def push_unique(self, queue, task, eta=None, replace=False, ttl=3600):
+        now = time()
+        key = task['unique']
+        with self.cond:
+            old = self.unique.get(key)
+            if old and old[2] > now:
+                if not replace:
+                    return old[0]
+                if old[1] and old[1][3] is not None:
+                    old[1][3] = None
+                    self.cancelled += 1
+
+            entry = self._push(queue, task, eta)
+            self.unique[key] = task['id'], entry, now + ttl + max(0, (eta or 0) - now)
+            self.cond.notify_all()
+            return task['id']
+
+    def release_unique(self, task):
+        with self.cond:
+            old = self.unique.get(task['unique'])
+            if old and old[0] == task['id']:
+                del self.unique[task['unique']]
+
+    def push_many(self, items):
+        with self.cond:
+            for queue, task, eta in items:
+                self._push(queue, task, eta)
+            self.cond.notify_all()
+
+    def _pop_one(self, queue_list):
+        for q in queue_list:
+            items = self.queues.get(q)
+            if items:
+                return q, items.popleft()
+
+    def pop(self, queue_list, timeout=None, now=None):
+        deadline = timeout and time() + timeout
+        with self.cond:
+            while True:
+                item = self._pop_one(queue_list)
+                if item:
+                    return item
+
+                wait = None
+                if deadline:
+                    wait = deadline - time()
+                    if wait <= 0:
+                        return None, None
+                self.cond.wait(wait)
+
+    def pop_many(self, queue, count):
+        with self.cond:
+            items = self.queues.get(queue, ())
+            return [items.popleft() for _ in range(min(count, len(items)))]
+
+    def take_token(self, name, rate, period, now=None):
+        now = now or time()
+        interval = float(period) / rate
+        with self.cond:
+            tokens, ts = self.buckets.get(name, (rate, now))
+            tokens = min(rate, tokens + max(0, now - ts) / interval) - 1
+            self.buckets[name] = tokens, now
+        return max(0, -tokens * interval)
+
+    def take_tokens(self, name, rate, period, count, now=None):
+        now = now or time()
+        interval = float(period) / rate
+        with self.cond:
+            tokens, ts = self.buckets.get(name, (rate, now))
+            tokens = min(rate, tokens + max(0, now - ts) / interval)
+            if count > 0:
+                count = max(0, min(count, int(tokens)))
+            self.buckets[name] = min(rate, tokens - count), now
+        return count
+
+    def _slots(self, name, now):
+        slots = self.slots.setdefault(name, {})
+        for holder in [k for k, v in iteritems(slots) if v < now]:
+            del slots[holder]
+        return slots
+
+    def acquire_slot(self, name, limit, holder, queue, task, lease=60, now=None):
+        now = now or time()
+        with self.cond:
+            slots = self._slots(name, now)
+            if len(slots) < limit:
+                slots[holder] = now + lease
+                return True
+            self.parked.setdefault(name, deque()).append((queue, task))
+            return False
+
+    def acquire_slots(self, name, limit, holders, lease=60, now=None):
+        now = now or time()
+        with self.cond:
+            slots = self._slots(name, now)
+            taken = holders[:max(0, limit - len(slots))]
+            for r in taken:
+                slots[r] = now + lease
+        return len(taken)
+
+    def renew_slot(self, name, holder, lease=60):
+        with self.cond:
+            slots = self.slots.get(name, {})
+            for r in holder_list(holder):
+                if r in slots:
+                    slots[r] = time() + lease
+
+    def release_slot(self, name, limit, holder=None, now=None):
+        with self.cond:
+            slots = self._slots(name, now or time())
+            for r in holder_list(holder):
+                slots.pop(r, None)
+            parked = self.parked.get(name, ())
+            items = [parked.popleft() for _ in range(min(limit - len(slots), len(parked)))]
+            for queue, task in items:
+                self._push(queue, task, None)
+            if items:
+                self.cond.notify_all()
+        return len(items)
+
+    def prefetch(self, queue_list, owner, count, heartbeat=60):
+        result = []
+        with self.cond:
+            while len(result) < count:
+                item = self._pop_one(queue_list)
+                if not item:
+                    break
+                result.append(item)
+
+            if result:
+                self.inflight.setdefault(owner, deque()).extend(result)
+                self.heartbeats[owner] = time() + heartbeat
+        return result
+
+    def ack(self, owner, count, heartbeat=60):
+        with self.cond:
+            items = self.inflight.get(owner, ())
+            for _ in range(min(count, len(items))):
+                items.popleft()
+            self.heartbeats[owner] = time() + heartbeat
+
+    def requeue_inflight(self, owner=None, keep=0):
+        now = time()
+        result = 0
+        with self.cond:
+            if owner is None:
+                owners = [k for k in self.inflight
+                          if self.heartbeats.get(k, 0) < now]
+            else:
+                owners = [owner]
+
+            for k in owners:
+                items = list(self.inflight.pop(k, ()))
+                if keep:
+                    self.inflight[k] = deque(items[:keep])
+                    items = items[keep:]
+                else:
+                    self.heartbeats.pop(k, None)
+                for q, t in reversed(items):
+                    self.queues.setdefault(q, deque()).appendleft(t)
+                result += len(items)
+
+            if result:
+                self.cond.notify_all()
+        return result
+
+    def reschedule(self, now=None, limit=5000):
+        now = now or time()
+        moved = 0
+        with self.cond:
+            schedule = self.schedule
+            for _ in range(limit):
+                if not schedule or schedule[0][0] > now:
+                    break
+                _, queue, task = self._pop_schedule()
+                if task is None:
+                    continue
+                expire = task.get('expire') if isinstance(task, dict) else None
+                if expire is None or now <= expire:
+                    self.queues.setdefault(queue, deque()).append(task)
+                    moved += 1
+
+            if moved:
+                self.cond.notify_all()
+
+            due = sum(1 for r in schedule if r[0] <= now and r[3] is not None)
+            return moved, due, len(schedule) - self.cancelled
+
+    def crontab_mark(self):
+        return self.crontab_last
+
+    def set_crontab_mark(self, ts):
+        self.crontab_last = ts
+
+    def _next_eta(self):
+        while self.schedule and self.schedule[0][3] is None:
+            self._pop_schedule()
+        return self.schedule[0][0] if self.schedule else None
+
+    def next_eta(self):
+        with self.cond:
+            return self._next_eta()
+
+    def wait_wakeup(self, timeout):
+        with self.cond:
+            eta = self._next_eta()
+            self.cond.wait(timeout)
+            new = self._next_eta()
+            if new is not None and (eta is None or new < eta):
+                return new
+
+    def take_many(self, count):
+        dumps = self.codec.dumps_task
+        with self.cond:
+            schedule = []
+            while self.schedule and len(schedule) < count:
+                ts, queue, task = self._pop_schedule()
+                if task is not None:
+                    schedule.append((sitem(queue, dumps(task)), ts))
+
+            queues = {}
+            for q, items in iteritems(self.queues):
+                if items:
+                    queues[q] = [dumps(items.popleft())
+                                 for _ in range(min(count, len(items)))]
+        return {'schedule': schedule, 'queues': queues}
+
+    def _load(self, body, payloads):
+        task = self.codec.loads_task(body)
+        ref = isinstance(task, dict) and task.get('args_ref')
+        if ref and ref in payloads:
+            args, kwargs = self.codec.loads(payloads[ref][0])
+            del task['args_ref']
+            if args:
+                task['args'] = args
+            if kwargs:
+                task['kwargs'] = kwargs
+        return task
+
+    def put_many(self, batch):
+        payloads = batch.get('payloads', {})
+        with self.cond:
+            for item, ts in batch['schedule']:
+                queue, body = ritem(item)
+                self._schedule(queue, self._load(body, payloads), ts)
+
+            for q, items in iteritems(batch['queues']):
+                if items:
+                    self.queues.setdefault(q, deque()).extend(
+                        self._load(r, payloads) for r in items)
+            self.cond.notify_all()
+
+    def queue_list(self):
+        with self.cond:
+            return [q for q, items in iteritems(self.queues) if items]
+
+    def prune_queues(self, queues):
+        with self.cond:
+            for q in queues:
+                if not self.queues.get(q, True):
+                    del self.queues[q]
+
+    def sync_queues(self):
+        return self.queue_list()
+
+    def stat(self):
+        with self.cond:
+            result = dict((q, len(items)) for q, items in iteritems(self.queues) if items)
+            result['schedule'] = len(self.schedule) - self.cancelled
+        return result
+
+    def get_queue(self, queue, offset=0, limit=100):
+        with self.cond:
+            items = self.queues.get(queue, ())
+            return list(islice(items, offset, offset + limit))
+
+    def get_schedule(self, offset=0, limit=100):
+        with self.cond:
+            items = sorted(r for r in self.schedule if r[3] is not None)
+        return [(ts, q, t) for ts, _, q, t in items[offset:offset + limit]]
+
+
+def rkey(id):
+    # task ids are bytes under python 3 but Result handles can use str ones
+    if not PY2 and not isinstance(id, str):
+        return id.decode('utf-8')
+    return id
+
+
+class MemoryResultStore(object):
+    """In-memory result store
+
+    Results are kept as is without encoding. Expired results are purged
+    on :py:meth:`set`.
+    """
+    def __init__(self):
+        self.cond = Condition(Lock())
+        self.results = {}
+        self.expires = []
+
+    def set(self, id, value, ttl):
+        now = time()
+        id = rkey(id)
+        with self.cond:
+            self.results[id] = value, now + ttl
+            heappush(self.expires, (now + ttl, id))
+            while self.expires and self.expires[0][0] < now:
+                _, rid = heappop(self.expires)
+                item = self.results.get(rid)
+                if item and item[1] < now:
+                    del self.results[rid]
+            self.cond.notify_all()
+
+    def _get(self, id, now):
+        item = self.results.get(rkey(id))
+        if item and item[1] >= now:
+            return item[0]
+
+    def wait(self, id, timeout):
+        deadline = time() + timeout
+        with self.cond:
+            while True:
+                now = time()
+                value = self._get(id, now)
+                if value is not None or now >= deadline:
+                    return value
+                self.cond.wait(deadline - now)
+
+    def get_many(self, ids):
+        now = time()
+        with self.cond:
+            return [self._get(r, now) for r in ids]
+
+    def get(self, id):
+        with self.cond:
+            return self._get(id, time())
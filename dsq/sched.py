@@ -1,7 +1,16 @@
+from time import mktime, time, sleep
 from heapq import heappush, heappop
-from datetime import datetime
+from datetime import datetime, timedelta
 
-from .compat import range
+from .compat import range, string_types
+
+MONTH_NAMES = dict((r, i) for i, r in enumerate(
+    'jan feb mar apr may jun jul aug sep oct nov dec'.split(), 1))
+WDAY_NAMES = dict((r, i) for i, r in enumerate('sun mon tue wed thu fri sat'.split()))
+
+#: Value ranges and names of cron expression fields.
+CRON_FIELDS = ((0, 59, {}), (0, 23, {}), (1, 31, {}), (1, 12, MONTH_NAMES),
+               (0, 7, WDAY_NAMES))
 
 
 class Event(object):
@@ -45,6 +54,79 @@ def get_points(desc, min, max):
         return [desc]
 
 
+def parse_field(desc, min, max, names):
+    points = set()
+    for part in desc.lower().split(','):
+        rng, _, step = part.partition('/')
+        if rng == '*':
+            start, end = min, max
+        else:
+            start, _, end = rng.partition('-')
+            start = names[start] if start in names else int(start)
+            end = (names[end] if end in names else int(end)) if end else (max if step else start)
+
+        if not min <= start <= end <= max:
+            raise ValueError('Invalid cron field: "{}"'.format(desc))
+        points.update(range(start, end + 1, int(step or 1)))
+    return sorted(points)
+
+
+def parse_cron(expr):
+    """Parses cron expression
+
+    Supports ``*``, ranges, steps, lists and 3-letter month and week day
+    names: ``*/15 9-18 * * mon-fri``.
+
+    :returns: ``(minute, hour, day, month, wday)`` lists of points.
+    :raises ValueError: if expression is invalid.
+    """
+    fields = expr.split()
+    if len(fields) != 5:
+        raise ValueError('Cron expression must have 5 fields: "{}"'.format(expr))
+    return tuple(parse_field(f, *r) for f, r in zip(fields, CRON_FIELDS))
+
+
+def day_match(days, wdays, day, wday):
+    """Checks day and week day fields
+
+    As in cron they are combined with OR if both are restricted, a field
+    covering its whole range isn't restricted.
+    """
+    if len(days) < 31 and len(wdays) < 7:
+        return day in days or wday in wdays
+    return day in days and wday in wdays
+
+
+def local_ts(dt):
+    return int(mktime(dt.timetuple()))
+
+
+def next_time(entry, ts):
+    """Returns the first minute boundary after ``ts`` matching crontab entry
+
+    Time is stepped over real timestamps and matched by local time fields,
+    so repeated hours of DST fall-back are run twice and skipped ones of
+    spring-forward are not run at all. Result is always greater than ``ts``.
+    """
+    minutes, hours, days, months, wdays = entry
+    t = (int(ts) // 60 + 1) * 60
+    # Feb 29 on a particular week day repeats in 28 years
+    limit = t + 366 * 28 * 86400
+    while t < limit:
+        dt = datetime.fromtimestamp(t)
+        if dt.month not in months:
+            nt = local_ts((dt.replace(day=1, hour=0, minute=0) + timedelta(days=32)).replace(day=1))
+        elif not day_match(days, wdays, dt.day, dt.isoweekday()):
+            nt = local_ts(dt.replace(hour=0, minute=0) + timedelta(days=1))
+        elif dt.hour not in hours:
+            nt = t + (60 - dt.minute) * 60
+        elif dt.minute not in minutes:
+            nt = t + 60
+        else:
+            return t
+        t = max(nt, t + 60)
+
+
 def update_set(s, action, points):
     for p in points:
         s.setdefault(p, set()).add(action)
@@ -57,22 +139,146 @@ class Crontab(object):
         self.days = {}
         self.months = {}
         self.wdays = {}
+        self.either_day = set()
+        self.entries = []
 
     def add(self, action, minute=-1, hour=-1, day=-1, month=-1, wday=-1):
-        update_set(self.minutes, action, get_points(minute, 0, 59))
-        update_set(self.hours, action, get_points(hour, 0, 23))
-        update_set(self.days, action, get_points(day, 1, 31))
-        update_set(self.months, action, get_points(month, 1, 12))
-        update_set(self.wdays, action, [r or 7 for r in get_points(wday, 1, 7)])
+        """Adds crontab entry
+
+        ``minute`` could be a cron expression string, see :py:func:`parse_cron`.
+        Negative values mean every Nth point, lists are sets of points.
+        Day and week day conditions are combined with OR if both are
+        restricted, see :py:func:`day_match`.
+        """
+        if isinstance(minute, string_types):
+            minute, hour, day, month, wday = parse_cron(minute)
+
+        entry = (get_points(minute, 0, 59), get_points(hour, 0, 23),
+                 get_points(day, 1, 31), get_points(month, 1, 12),
+                 [r or 7 for r in get_points(wday, 1, 7)])
+        for index, points in zip((self.minutes, self.hours, self.days,
+                                  self.months, self.wdays), entry):
+            update_set(index, action, points)
+        entry = tuple(set(r) for r in entry)
+        if len(entry[2]) < 31 and len(entry[4]) < 7:
+            self.either_day.add(action)
+        self.entries.append((action, entry))
 
     def actions(self, minute, hour, day, month, wday):
         empty = set()
+        days = self.days.get(day, empty)
+        wdays = self.wdays.get(wday, empty)
         return (self.minutes.get(minute, empty)
                 & self.hours.get(hour, empty)
-                & self.days.get(day, empty)
                 & self.months.get(month, empty)
-                & self.wdays.get(wday, empty))
+                & ((days & wdays) | ((days | wdays) & self.either_day)))
 
     def actions_ts(self, ts):
         dt = datetime.fromtimestamp(ts)
         return self.actions(dt.minute, dt.hour, dt.day, dt.month, dt.isoweekday())
+
+    def next_after(self, ts):
+        """Returns the next crontab event after ``ts``
+
+        :returns: ``(ts, actions)`` tuple, ``(None, set())`` if there are
+                  no events.
+        """
+        result, actions = None, set()
+        for action, entry in self.entries:
+            t = next_time(entry, ts)
+            if t is None or (result is not None and t > result):
+                continue
+            if t != result:
+                result, actions = t, set()
+            actions.add(action)
+        return result, actions
+
+
+class Scheduler(object):
+    """Moves due tasks into queues and runs periodic and crontab events
+
+    It sleeps until the earliest ETA, timer or crontab event. Pushes of
+    earlier tasks wake it up.
+
+    :param manager: :py:class:`~.manager.Manager` with collected periodic
+                    and crontab entries.
+    :param limit: Max amount of tasks to move into queues at once.
+    :param catch_up: Run crontab events missed during last N seconds of
+                     downtime.
+    :param now: Start time.
+    """
+    def __init__(self, manager, limit=5000, catch_up=None, now=None):
+        self.manager = manager
+        self.limit = limit
+        self.catch_up = catch_up
+
+        now = now or time()
+        timer = manager.periodic.timer(now)
+        # empty event to check run flag
+        timer.add(None, now + 5, 5)
+        if manager.concurrency_limits:
+            timer.add(manager.wake_parked, now, 1)
+        self.events = iter(timer)
+        self.next_run, self.action = next(self.events)
+
+        self.crontab = manager.crontab.crontab()
+        last = catch_up and manager.queue.crontab_mark()
+        self.next_cron, self.cron_actions = self.crontab.next_after(
+            max(last, now - catch_up) if last else now)
+        self.eta = 0
+
+    def reschedule(self, now=None, run=True):
+        """Moves all due tasks into queues in chunks of ``limit``
+
+        :returns: schedule size.
+        """
+        while run:
+            _, due, size = self.manager.queue.reschedule(now, self.limit)
+            if not due:
+                return size
+
+    def step(self, now=None):
+        """Handles the earliest due event or waits for it"""
+        now = now or time()
+        if self.eta is not None and self.eta <= now:
+            self.reschedule(now)
+            self.eta = self.manager.queue.next_eta()
+        elif self.next_cron is not None and self.next_cron <= now:
+            window = max(self.catch_up or 0, 60)
+            if now - self.next_cron < window:
+                for a in self.cron_actions:
+                    a()
+            else:
+                # events missed by stalled scheduler are skipped at once
+                self.next_cron = now - window
+            mark = self.next_cron
+            self.manager.queue.set_crontab_mark(mark)
+            self.next_cron, self.cron_actions = self.crontab.next_after(mark)
+            if self.next_cron is not None and self.next_cron <= mark:
+                # never step back, scheduler would spin on a past event
+                self.next_cron, self.cron_actions = mark + 60, set()
+        elif self.next_run <= now:
+            if self.action:
+                self.action()
+            self.next_run, self.action = next(self.events)
+        else:
+            # sleep until the earliest ETA or event, pushes of earlier tasks
+            # wake scheduler up
+            wait = min(self.next_run, self.eta or self.next_run,
+                       self.next_cron or self.next_run) - now
+            woke = self.manager.queue.wait_wakeup(wait)
+            if woke is not None and (self.eta is None or woke < self.eta):
+                self.eta = woke
+
+    def run(self, run):
+        """Handles events while ``run`` flag is true"""
+        while run:
+            self.step()
+
+    def burst(self, run):
+        """Moves due tasks until schedule is empty"""
+        while run:
+            self.manager.wake_parked()
+            if not self.reschedule(run=run):
+                break
+            sleep(1)
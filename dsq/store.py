@@ -1,11 +1,273 @@
+import logging
 from time import time
+from hashlib import sha1
 
-from msgpack import dumps, loads
+from .codec import MsgpackCodec, COMPRESSED, unpack_args
+from .compat import iteritems, itervalues, PY2, string_types
 
-from .utils import iter_chunks
-from .compat import iteritems, PY2, string_types
+log = logging.getLogger(__name__)
 
 SCHEDULE_KEY = 'schedule'
+WAKEUP_KEY = 'wakeup:schedule'
+CRONTAB_MARK_KEY = 'crontab:last'
+INFLIGHT_KEY = 'inflight'
+QUEUES_KEY = 'queues'
+UNIQUE_PREFIX = 'unique:'
+PAYLOAD_PREFIX = 'payload:'
+RATE_PREFIX = 'rate:'
+
+# KEYS: schedule, [queue registry]. ARGV: now, limit, queue key prefix, queue key suffix.
+# Moves at most `limit` due items into queues, drops expired tasks
+# and returns {moved, still due, schedule size}. Compressed tasks can't
+# be decoded here and are moved as is, workers drop them if expired.
+RESCHEDULE_SCRIPT = '''
+local function expired(body, now)
+    if cmsgpack == nil then
+        return false
+    end
+    local ok, task = pcall(cmsgpack.unpack, body)
+    if not ok or type(task) ~= 'table' then
+        return false
+    end
+    -- compact envelope stores expire at fixed position
+    local expire = task[1] == 1 and task[7] or task.expire
+    return type(expire) == 'number' and now > expire
+end
+
+local now = tonumber(ARGV[1])
+local items = redis.call('zrangebyscore', KEYS[1], '-inf', now, 'LIMIT', 0, ARGV[2])
+if #items == 0 then
+    return {0, 0, redis.call('zcard', KEYS[1])}
+end
+
+local queues = {}
+local moved = 0
+for _, item in ipairs(items) do
+    local sep = string.find(item, ':', 1, true)
+    local body = string.sub(item, sep + 1)
+    if not expired(body, now) then
+        local queue = string.sub(item, 1, sep - 1)
+        queues[queue] = queues[queue] or {}
+        table.insert(queues[queue], body)
+        moved = moved + 1
+    end
+end
+
+for queue, bodies in pairs(queues) do
+    if KEYS[2] then
+        redis.call('sadd', KEYS[2], queue)
+    end
+    for i = 1, #bodies, 1000 do
+        redis.call('rpush', ARGV[3] .. queue .. ARGV[4],
+                   unpack(bodies, i, math.min(i + 999, #bodies)))
+    end
+end
+
+redis.call('zremrangebyrank', KEYS[1], 0, #items - 1)
+return {moved, redis.call('zcount', KEYS[1], '-inf', now), redis.call('zcard', KEYS[1])}
+'''
+
+# KEYS: inflight list, inflight registry, heartbeat, queues...
+# ARGV: count, heartbeat ttl, owner, queue names...
+# Moves up to `count` items from prioritized queues into inflight list.
+PREFETCH_SCRIPT = '''
+local need = tonumber(ARGV[1])
+local result = {}
+for i = 4, #KEYS do
+    local items = redis.call('lrange', KEYS[i], 0, need - 1)
+    if #items > 0 then
+        redis.call('ltrim', KEYS[i], #items, -1)
+        for _, body in ipairs(items) do
+            table.insert(result, ARGV[i] .. ':' .. body)
+        end
+        need = need - #items
+        if need <= 0 then
+            break
+        end
+    end
+end
+
+if #result > 0 then
+    for i = 1, #result, 1000 do
+        redis.call('rpush', KEYS[1], unpack(result, i, math.min(i + 999, #result)))
+    end
+    redis.call('sadd', KEYS[2], ARGV[3])
+    redis.call('set', KEYS[3], 1, 'EX', ARGV[2])
+end
+return result
+'''
+
+# KEYS: inflight list, inflight registry, heartbeat, queue registry.
+# ARGV: owner, queue key prefix, force, keep.
+# Returns inflight items back to queue heads if owner is dead. With `keep`
+# only items after the first `keep` ones are returned and owner stays alive.
+REQUEUE_SCRIPT = '''
+if ARGV[3] ~= '1' and redis.call('exists', KEYS[3]) == 1 then
+    return 0
+end
+
+local keep = tonumber(ARGV[4])
+local items = redis.call('lrange', KEYS[1], keep, -1)
+for i = #items, 1, -1 do
+    local sep = string.find(items[i], ':', 1, true)
+    local queue = string.sub(items[i], 1, sep - 1)
+    redis.call('lpush', ARGV[2] .. queue, string.sub(items[i], sep + 1))
+    redis.call('sadd', KEYS[4], queue)
+end
+if keep > 0 then
+    redis.call('ltrim', KEYS[1], 0, keep - 1)
+else
+    redis.call('del', KEYS[1], KEYS[3])
+    redis.call('srem', KEYS[2], ARGV[1])
+end
+return #items
+'''
+
+# KEYS: queue registry, queues... ARGV: queue names...
+# Removes empty queues from registry.
+PRUNE_SCRIPT = '''
+local result = 0
+for i = 2, #KEYS do
+    if redis.call('llen', KEYS[i]) == 0 then
+        result = result + redis.call('srem', KEYS[1], ARGV[i - 1])
+    end
+end
+return result
+'''
+
+# KEYS: unique key, queue list or schedule, [queue registry].
+# ARGV: task id, body or schedule item, eta, replace, ttl, queue name.
+# Pushes task if there is no pending task with the same unique key, returns
+# id of pending task. With replace flag pending scheduled task is replaced.
+# Unique key holds "<id>:<schedule item>", schedule item is kept only for
+# scheduled tasks to be able to replace them.
+PUSH_UNIQUE_SCRIPT = '''
+local old = redis.call('get', KEYS[1])
+if old then
+    local sep = string.find(old, ':', 1, true)
+    if ARGV[4] ~= '1' then
+        return string.sub(old, 1, sep - 1)
+    end
+    if sep < #old then
+        redis.call('zrem', KEYS[2], string.sub(old, sep + 1))
+    end
+end
+
+local member = ARGV[3] ~= '' and ARGV[2] or ''
+redis.call('set', KEYS[1], ARGV[1] .. ':' .. member, 'EX', ARGV[5])
+if ARGV[3] ~= '' then
+    redis.call('zadd', KEYS[2], ARGV[3], ARGV[2])
+else
+    redis.call('rpush', KEYS[2], ARGV[2])
+end
+if KEYS[3] then
+    redis.call('sadd', KEYS[3], ARGV[6])
+end
+return ARGV[1]
+'''
+
+# KEYS: unique key. ARGV: task id.
+RELEASE_UNIQUE_SCRIPT = '''
+local value = redis.call('get', KEYS[1])
+if value and string.sub(value, 1, #ARGV[1] + 1) == ARGV[1] .. ':' then
+    return redis.call('del', KEYS[1])
+end
+return 0
+'''
+
+# KEYS: list or sorted set. ARGV: count.
+TAKE_LIST_SCRIPT = '''
+local items = redis.call('lrange', KEYS[1], 0, ARGV[1] - 1)
+redis.call('ltrim', KEYS[1], ARGV[1], -1)
+return items
+'''
+
+TAKE_ZSET_SCRIPT = '''
+local items = redis.call('zrange', KEYS[1], 0, ARGV[1] - 1, 'WITHSCORES')
+redis.call('zremrangebyrank', KEYS[1], 0, ARGV[1] - 1)
+return items
+'''
+
+# KEYS: bucket. ARGV: capacity, seconds per token, now, [count].
+# Token bucket which lends tokens into the future. Always takes a token and
+# returns delay in seconds until it's available, so deferred callers get
+# distinct slots. With `count` takes up to `count` available tokens without
+# lending and returns amount of taken ones, negative `count` returns tokens.
+TAKE_TOKEN_SCRIPT = '''
+local capacity = tonumber(ARGV[1])
+local interval = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local count = tonumber(ARGV[4])
+local bucket = redis.call('hmget', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(bucket[1]) or capacity
+local ts = tonumber(bucket[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - ts) / interval)
+local result
+if count then
+    if count > 0 then
+        count = math.max(0, math.min(count, math.floor(tokens)))
+    end
+    tokens = math.min(capacity, tokens - count)
+    result = count
+else
+    tokens = tokens - 1
+    result = tokens >= 0 and '0' or tostring(-tokens * interval)
+end
+redis.call('hmset', KEYS[1], 'tokens', tostring(tokens), 'ts', tostring(now))
+redis.call('pexpire', KEYS[1], math.ceil((capacity - tokens) * interval * 1000) + 1000)
+return result
+'''
+
+# KEYS: slots, parked list. ARGV: limit, lease expire, holder, now, parked item.
+# Takes a concurrency slot or parks the item if all slots are busy.
+# Slots of expired leases are freed.
+ACQUIRE_SLOT_SCRIPT = '''
+redis.call('zremrangebyscore', KEYS[1], '-inf', ARGV[4])
+if redis.call('zcard', KEYS[1]) < tonumber(ARGV[1]) then
+    redis.call('zadd', KEYS[1], ARGV[2], ARGV[3])
+    return 1
+end
+redis.call('rpush', KEYS[2], ARGV[5])
+return 0
+'''
+
+# KEYS: slots. ARGV: limit, lease expire, now, holders...
+# Takes free slots for holders in order without parking.
+# Returns amount of taken slots.
+ACQUIRE_SLOTS_SCRIPT = '''
+redis.call('zremrangebyscore', KEYS[1], '-inf', ARGV[3])
+local free = math.min(tonumber(ARGV[1]) - redis.call('zcard', KEYS[1]), #ARGV - 3)
+for i = 1, free do
+    redis.call('zadd', KEYS[1], ARGV[2], ARGV[i + 3])
+end
+return math.max(free, 0)
+'''
+
+# KEYS: slots, parked list. ARGV: now, limit, holders...
+# Frees holders' slots and takes parked items for free slots.
+RELEASE_SLOT_SCRIPT = '''
+for i = 3, #ARGV do
+    redis.call('zrem', KEYS[1], ARGV[i])
+end
+redis.call('zremrangebyscore', KEYS[1], '-inf', ARGV[1])
+local free = tonumber(ARGV[2]) - redis.call('zcard', KEYS[1])
+if free <= 0 then
+    return {}
+end
+local items = redis.call('lrange', KEYS[2], 0, free - 1)
+redis.call('ltrim', KEYS[2], free, -1)
+return items
+'''
+
+# KEYS: notification list, result.
+# Returns notification back for other waiters, it lives as long as result.
+RENOTIFY_SCRIPT = '''
+local ttl = redis.call('pttl', KEYS[2])
+if ttl > 0 then
+    redis.call('rpush', KEYS[1], 1)
+    redis.call('pexpire', KEYS[1], ttl)
+end
+'''
 
 if PY2:  # pragma: no cover
     def qname(name):
@@ -16,6 +278,10 @@ if PY2:  # pragma: no cover
 
     def rqname(name):
         return 'queue:{}'.format(name)
+
+    def ritem(item):
+        queue, _, task = item.partition(':')
+        return queue, task
 else:  # pragma: no cover
     def qname(name):
         return name.rpartition(b':')[2].decode('utf-8')
@@ -28,47 +294,427 @@ else:  # pragma: no cover
             name = name.encode('utf-8')
         return b'queue:' + name
 
+    def ritem(item):
+        queue, _, task = item.partition(b':')
+        return queue.decode('utf-8'), task
+
+
+def notify_key(id):
+    # hash tag places notification list into the same cluster slot as result
+    if not PY2 and not isinstance(id, str):
+        id = id.decode('utf-8')
+    return 'notify:{%s}' % id
+
+
+def slot_keys(name):
+    # hash tag keeps slots and parked list in one cluster slot
+    return ['slots:{%s}' % name, 'parked:{%s}' % name]
+
+
+def holder_list(holder):
+    if holder is None:
+        return []
+    return holder if isinstance(holder, list) else [holder]
+
+
+def parked_batch(items):
+    queues = {}
+    for r in items:
+        queue, task = ritem(r)
+        queues.setdefault(queue, []).append(task)
+    return {'schedule': [], 'queues': queues}
+
+
+def token_args(rate, period, now):
+    return [rate, repr(float(period) / rate), repr(now or time())]
+
+
+def inflight_keys(owner):
+    return ['inflight:{}'.format(owner), INFLIGHT_KEY, 'worker:{}'.format(owner)]
+
+
+class PayloadError(Exception):
+    """Offloaded task payload is expired or missing"""
+    def __init__(self, ref):
+        Exception.__init__(self, 'Payload {} not found'.format(ref))
+        self.ref = ref
+
 
 class QueueStore(object):
-    """Queue store"""
-    def __init__(self, client):
+    """Queue store
+
+    :param client: Redis client.
+    :param codec: Task codec, :py:class:`~.codec.MsgpackCodec` by default.
+    :param offload_threshold: Store task args and kwargs encoded into this
+                              amount of bytes or more under a separate
+                              ``payload:<sha1>`` key. Task carries only
+                              a reference. Identical payloads are stored once.
+                              :py:meth:`take_many` batches carry payloads of
+                              taken tasks, so forwarder moves them too.
+    :param offload_ttl: Payload key time to live in addition to task delay.
+    """
+    #: All queues use one schedule. Otherwise queues with scheduled
+    #: tasks must be kept in registry.
+    shared_schedule = True
+
+    #: Store implements :py:meth:`prefetch`, :py:meth:`ack` and
+    #: :py:meth:`requeue_inflight`.
+    supports_prefetch = True
+
+    def __init__(self, client, codec=None, offload_threshold=None, offload_ttl=7 * 86400):
         self.client = client
+        self.codec = codec or MsgpackCodec()
+        self.offload_threshold = offload_threshold
+        self.offload_ttl = offload_ttl
+        self._reschedule = client.register_script(RESCHEDULE_SCRIPT)
+        self._prefetch = client.register_script(PREFETCH_SCRIPT)
+        self._requeue = client.register_script(REQUEUE_SCRIPT)
+        self._prune = client.register_script(PRUNE_SCRIPT)
+        self._push_unique = client.register_script(PUSH_UNIQUE_SCRIPT)
+        self._release_unique = client.register_script(RELEASE_UNIQUE_SCRIPT)
+        self._take_list = client.register_script(TAKE_LIST_SCRIPT)
+        self._take_token = client.register_script(TAKE_TOKEN_SCRIPT)
+        self._acquire_slot = client.register_script(ACQUIRE_SLOT_SCRIPT)
+        self._acquire_slots = client.register_script(ACQUIRE_SLOTS_SCRIPT)
+        self._release_slot = client.register_script(RELEASE_SLOT_SCRIPT)
+
+    def qkey(self, queue):
+        """Returns redis key of queue list"""
+        return rqname(queue)
+
+    def ukey(self, queue, key):
+        """Returns redis key of unique task lock"""
+        return UNIQUE_PREFIX + key
+
+    def skey(self, queue):
+        """Returns redis key of schedule for queue"""
+        return SCHEDULE_KEY
+
+    def schedule_keys(self, queues):
+        """Returns all schedule keys for queues"""
+        return [SCHEDULE_KEY]
+
+    def offload(self, task, eta, payloads):
+        """Replaces large task args with a payload reference
+
+        Payloads to write are collected into ``payloads`` dict,
+        see :py:meth:`write_payloads`.
+        """
+        if not isinstance(task, dict):
+            return task
+
+        ttl = int(self.offload_ttl + max(0, (eta or 0) - time()))
+        ref = task.get('args_ref')
+        if ref:
+            payloads.setdefault(ref, (None, ttl))
+            return task
+
+        if not self.offload_threshold or not (task.get('args') or task.get('kwargs')):
+            return task
+
+        blob = self.codec.dumps([task.get('args'), task.get('kwargs')])
+        if len(blob) < self.offload_threshold:
+            return task
+
+        ref = sha1(blob).hexdigest()
+        payloads[ref] = blob, ttl
+        task = task.copy()
+        task.pop('args', None)
+        task.pop('kwargs', None)
+        task['args_ref'] = ref
+        return task
+
+    def write_payloads(self, pipe, payloads):
+        """Writes offloaded payloads or prolongs existing ones"""
+        for ref, (blob, ttl) in iteritems(payloads):
+            if blob is None:
+                pipe.expire(PAYLOAD_PREFIX + ref, ttl)
+            else:
+                pipe.set(PAYLOAD_PREFIX + ref, blob, ex=ttl)
+
+    def load_args(self, task):
+        """Returns task ``(args, kwargs)`` resolving offloaded payload
+
+        :raises PayloadError: if payload is expired.
+        """
+        ref = task.get('args_ref')
+        if not ref:
+            return unpack_args(task, self.codec.loads)
+
+        return self.decode_payload(ref, self.client.get(PAYLOAD_PREFIX + ref))
+
+    def decode_payload(self, ref, blob):
+        if blob is None:
+            raise PayloadError(ref)
+
+        args, kwargs = self.codec.loads(blob)
+        return args or (), kwargs or {}
 
     def push(self, queue, task, eta=None):
+        self.push_pipe(self.client.pipeline(False), queue, task, eta).execute()
+
+    def push_pipe(self, pipe, queue, task, eta=None):
+        """Adds push commands into pipeline"""
+        assert ':' not in queue, 'Queue name must not contain colon: "{}"'.format(queue)
+        payloads = {}
+        body = self.codec.dumps_task(self.offload(task, eta, payloads))
+        self.write_payloads(pipe, payloads)
+        if eta:
+            pipe.zadd(self.skey(queue), {sitem(queue, body): eta})
+            self.wakeup_pipe(pipe, eta)
+        else:
+            pipe.rpush(self.qkey(queue), body)
+        if not eta or not self.shared_schedule:
+            pipe.sadd(QUEUES_KEY, queue)
+        return pipe
+
+    def push_unique(self, queue, task, eta=None, replace=False, ttl=3600):
+        """Push task if there is no pending task with the same ``task['unique']`` key
+
+        :param replace: Replace pending scheduled task with this one.
+        :param ttl: Unique key time to live in addition to task delay.
+        :returns: id of pushed or pending task.
+        """
+        payloads, keys, args = self.unique_params(queue, task, eta, replace, ttl)
+        if payloads:
+            pipe = self.client.pipeline(False)
+            self.write_payloads(pipe, payloads)
+            pipe.execute()
+
+        result = self._push_unique(keys, args)
+        if not self.shared_schedule:
+            self.client.sadd(QUEUES_KEY, queue)
+        if eta:
+            self.wakeup_pipe(self.client.pipeline(False), eta).execute()
+        return result
+
+    def unique_params(self, queue, task, eta, replace, ttl):
+        """Returns ``(payloads, keys, args)`` for unique push script"""
         assert ':' not in queue, 'Queue name must not contain colon: "{}"'.format(queue)
-        body = dumps(task, use_bin_type=True)  # TODO: may be better to move task packing to manager
+        payloads = {}
+        body = self.codec.dumps_task(self.offload(task, eta, payloads))
+        keys = [self.ukey(queue, task['unique'])]
         if eta:
-            self.client.zadd(SCHEDULE_KEY, {sitem(queue, body): eta})
+            keys.append(self.skey(queue))
+            body = sitem(queue, body)
         else:
-            self.client.rpush(rqname(queue), body)
+            keys.append(self.qkey(queue))
+            if self.shared_schedule:
+                keys.append(QUEUES_KEY)
+
+        ttl = int(ttl + max(0, (eta or 0) - time()))
+        return payloads, keys, [task['id'], body, repr(eta) if eta else '',
+                                int(replace), ttl, queue]
+
+    def release_unique(self, task):
+        """Remove unique key of task to allow new pushes"""
+        self._release_unique([self.ukey(task.get('queue'), task['unique'])], [task['id']])
+
+    def push_many(self, items):
+        """Push many tasks in one round trip
+
+        :param items: Iterable of ``(queue, task, eta)`` tuples. Immediate tasks
+                      are grouped by queue into multi-value RPUSH and delayed
+                      ones into a single ZADD.
+        """
+        self.push_many_pipe(self.client.pipeline(False), items).execute()
+
+    def push_many_pipe(self, pipe, items):
+        """Adds bulk push commands into pipeline"""
+        queues = {}
+        schedule = {}
+        names = set()
+        payloads = {}
+        for queue, task, eta in items:
+            assert ':' not in queue, 'Queue name must not contain colon: "{}"'.format(queue)
+            body = self.codec.dumps_task(self.offload(task, eta, payloads))
+            if eta:
+                schedule.setdefault(self.skey(queue), {})[sitem(queue, body)] = eta
+            else:
+                queues.setdefault(queue, []).append(body)
+            if not eta or not self.shared_schedule:
+                names.add(queue)
+
+        self.write_payloads(pipe, payloads)
+        for key, items in iteritems(schedule):
+            pipe.zadd(key, items)
+            self.wakeup_pipe(pipe, min(itervalues(items)))
+
+        for q, bodies in iteritems(queues):
+            pipe.rpush(self.qkey(q), *bodies)
+
+        if names:
+            pipe.sadd(QUEUES_KEY, *names)
+
+        return pipe
+
+    def wakeup_pipe(self, pipe, eta):
+        """Adds scheduler notification about task with ``eta`` into pipeline
+
+        Notification set keeps only the earliest ETA.
+        """
+        pipe.zadd(WAKEUP_KEY, {repr(eta): eta})
+        pipe.zremrangebyrank(WAKEUP_KEY, 1, -1)
+        return pipe
+
+    def wait_wakeup(self, timeout):
+        """Waits for a notification about scheduled task
+
+        :returns: notified ETA or None on timeout.
+        """
+        item = self.client.bzpopmin(WAKEUP_KEY, max(timeout, 0.01))
+        return item and item[2]
+
+    def crontab_mark(self):
+        """Returns time of the last crontab event run by scheduler"""
+        value = self.client.get(CRONTAB_MARK_KEY)
+        return value and float(value)
+
+    def set_crontab_mark(self, ts):
+        self.client.set(CRONTAB_MARK_KEY, repr(ts))
+
+    def next_eta(self):
+        """Returns the earliest ETA in schedule or None if it's empty"""
+        items = self.client.zrange(SCHEDULE_KEY, 0, 0, withscores=True)
+        return items[0][1] if items else None
 
     def pop(self, queue_list, timeout=None, now=None):
         if timeout is None:  # pragma: no cover
             timeout = 0
 
-        item = self.client.blpop([rqname(r) for r in queue_list],
+        item = self.client.blpop([self.qkey(r) for r in queue_list],
                                  timeout=timeout)
         if not item:
             return None, None
 
-        return qname(item[0]), loads(item[1], encoding='utf-8')
+        return qname(item[0]), self.codec.loads_task(item[1])
+
+    def pop_many(self, queue, count):
+        """Pop up to ``count`` tasks from queue without blocking"""
+        return [self.codec.loads_task(r)
+                for r in self._take_list([self.qkey(queue)], [count])]
+
+    def take_token(self, name, rate, period, now=None):
+        """Take a token from ``name`` rate limit bucket
+
+        Bucket holds up to ``rate`` tokens and refills with ``rate`` tokens
+        per ``period`` seconds. Token is always taken, empty bucket lends it
+        from the future.
+
+        :returns: delay in seconds until the taken token is available.
+        """
+        return float(self._take_token([RATE_PREFIX + name],
+                                      token_args(rate, period, now)))
+
+    def take_tokens(self, name, rate, period, count, now=None):
+        """Take up to ``count`` available tokens from ``name`` bucket without lending
+
+        Negative ``count`` returns tokens into bucket.
+
+        :returns: amount of taken tokens.
+        """
+        return self._take_token([RATE_PREFIX + name],
+                                token_args(rate, period, now) + [count])
+
+    def acquire_slot(self, name, limit, holder, queue, task, lease=60, now=None):
+        """Take one of ``limit`` concurrency slots of ``name``
+
+        If all slots are busy task is parked until a slot is released.
 
-    def reschedule(self, now=None):
+        :param holder: Slot holder id, usually task id.
+        :param lease: Slot is freed after this amount of seconds
+                      if lease is not renewed.
+        :returns: True if slot is taken, False if task is parked.
+        """
         now = now or time()
-        items, _, size = (self.client.pipeline()
-                          .zrangebyscore(SCHEDULE_KEY, '-inf', now)
-                          .zremrangebyscore(SCHEDULE_KEY, '-inf', now)
-                          .zcard(SCHEDULE_KEY)
-                          .execute())
+        return bool(self._acquire_slot(
+            slot_keys(name),
+            [limit, repr(now + lease), holder, repr(now),
+             sitem(queue, self.codec.dumps_task(task))]))
 
-        for chunk in iter_chunks(items, 5000):
-            pipe = self.client.pipeline(False)
-            for r in chunk:
-                queue, _, task = r.partition(b':')
-                pipe.rpush(rqname(queue), task)
-            pipe.execute()
+    def acquire_slots(self, name, limit, holders, lease=60, now=None):
+        """Take free concurrency slots of ``name`` for ``holders`` in order
+
+        Nothing is parked if there are not enough free slots.
+
+        :returns: amount of taken slots, they belong to the first holders.
+        """
+        now = now or time()
+        return self._acquire_slots(slot_keys(name)[:1],
+                                   [limit, repr(now + lease), repr(now)] + holders)
+
+    def renew_slot(self, name, holder, lease=60):
+        """Prolong slot lease of ``holder`` or a list of holders"""
+        expire = time() + lease
+        self.client.zadd(slot_keys(name)[0],
+                         dict((r, expire) for r in holder_list(holder)), xx=True)
+
+    def release_slot(self, name, limit, holder=None, now=None):
+        """Free holder's slot and return parked tasks into their queues
+
+        :param holder: Holder or a list of holders. Without it only slots of
+                       expired leases are freed.
+        :returns: amount of woken tasks.
+        """
+        items = self._release_slot(slot_keys(name),
+                                   [repr(now or time()), limit] + holder_list(holder))
+        if items:
+            self.put_many(parked_batch(items))
+        return len(items)
+
+    def prefetch(self, queue_list, owner, count, heartbeat=60):
+        """Move up to ``count`` tasks from prioritized queues into owner's inflight list
+
+        Items must be confirmed with :py:meth:`ack` after processing.
+        Owner's heartbeat is prolonged on ``heartbeat`` seconds.
+
+        :returns: list of ``(queue, task)``.
+        """
+        items = self._prefetch(inflight_keys(owner) + [self.qkey(r) for r in queue_list],
+                               [count, heartbeat, owner] + list(queue_list))
+        return [(q, self.codec.loads_task(t)) for q, t in map(ritem, items)]
+
+    def ack(self, owner, count, heartbeat=60):
+        """Remove ``count`` processed items from owner's inflight list"""
+        ikey, _, hkey = inflight_keys(owner)
+        (self.client.pipeline(False)
+         .ltrim(ikey, count, -1)
+         .set(hkey, 1, ex=heartbeat)
+         .execute())
+
+    def requeue_inflight(self, owner=None, keep=0):
+        """Return inflight items back to queues
+
+        :param owner: Requeue only this owner's items regardless of heartbeat.
+                      By default items of all owners without alive heartbeat
+                      are requeued.
+        :param keep: Leave this amount of the first owner's items in
+                     inflight list.
+        :returns: amount of requeued items.
+        """
+        if owner is not None:
+            return self._requeue(inflight_keys(owner) + [QUEUES_KEY],
+                                 [owner, rqname(''), 1, keep])
+
+        result = 0
+        for r in self.client.smembers(INFLIGHT_KEY):
+            r = r if PY2 else r.decode('utf-8')
+            result += self._requeue(inflight_keys(r) + [QUEUES_KEY], [r, rqname(''), 0, 0])
+        return result
 
-        return size
+    def reschedule(self, now=None, limit=5000):
+        """Move due scheduled tasks into queues
+
+        Runs atomically inside redis and moves at most ``limit`` items per call.
+        Expired tasks are dropped.
+
+        :returns: ``(moved, due, size)`` tuple. ``due`` is an amount of due
+                  items left in schedule and ``size`` is a whole schedule size.
+        """
+        now = now or time()
+        moved, due, size = self._reschedule([SCHEDULE_KEY, QUEUES_KEY],
+                                            [repr(now), limit, rqname(''), ''])
+        return moved, due, size
 
     def take_many(self, count):
         queues = self.queue_list()
@@ -76,66 +722,288 @@ class QueueStore(object):
         pipe = self.client.pipeline()
         pipe.zrange(SCHEDULE_KEY, 0, count - 1, withscores=True)
         for q in queues:
-            pipe.lrange(rqname(q), 0, count - 1)
+            pipe.lrange(self.qkey(q), 0, count - 1)
 
         pipe.zremrangebyrank(SCHEDULE_KEY, 0, count - 1)
         for q in queues:
-            pipe.ltrim(rqname(q), count, -1)
+            pipe.ltrim(self.qkey(q), count, -1)
 
         cmds = pipe.execute()
+        return self._take_result(queues, cmds[0], cmds[1:], count)
+
+    def _take_result(self, queues, schedule, items, count):
         qresult = {}
-        result = {'schedule': cmds[0], 'queues': qresult}
-        for q, r in zip(queues, cmds[1:]):
+        result = {'schedule': schedule, 'queues': qresult}
+        drained = []
+        for q, r in zip(queues, items):
             if r:
                 qresult[q] = r
+            if len(r) < count:
+                drained.append(q)
 
+        self.prune_queues(drained)
+        result['payloads'] = self.take_payloads(result)
         return result
 
-    def put_many(self, batch):
+    def take_payloads(self, batch):
+        """Returns offloaded payloads of batch tasks
+
+        Batch is already taken from the store, so it must not fail on bad
+        items. Only compressed tasks and tasks with ``args_ref`` key are
+        decoded, items which can't be decoded are skipped and forwarded
+        as is.
+
+        :returns: ``{ref: (blob, ttl)}`` dict for :py:meth:`write_payloads`.
+        """
+        refs = set()
+        bodies = [ritem(r)[1] for r, _ in batch['schedule']]
+        for items in itervalues(batch['queues']):
+            bodies.extend(items)
+        for body in bodies:
+            if body[:1] != COMPRESSED and b'args_ref' not in body:
+                continue
+            try:
+                task = self.codec.loads_task(body)
+            except Exception:
+                log.warning('Can not decode task to find its payload: %r', body[:50])
+                continue
+            if isinstance(task, dict) and task.get('args_ref'):
+                refs.add(task['args_ref'])
+
+        if not refs:
+            return {}
+
+        refs = list(refs)
         pipe = self.client.pipeline(False)
+        for ref in refs:
+            pipe.get(PAYLOAD_PREFIX + ref)
+            pipe.ttl(PAYLOAD_PREFIX + ref)
+        values = pipe.execute()
+        return dict((ref, (blob, ttl if ttl > 0 else self.offload_ttl))
+                    for ref, blob, ttl in zip(refs, values[::2], values[1::2])
+                    if blob is not None)
 
-        if batch['schedule']:
-            pipe.zadd(SCHEDULE_KEY, dict(batch['schedule']))
+    def put_many(self, batch):
+        self.put_many_pipe(self.client.pipeline(False), batch).execute()
+
+    def put_many_pipe(self, pipe, batch):
+        self.write_payloads(pipe, batch.get('payloads', {}))
+        schedule = {}
+        for item, ts in batch['schedule']:
+            schedule.setdefault(self.skey(ritem(item)[0]), {})[item] = ts
+
+        for key, items in iteritems(schedule):
+            pipe.zadd(key, items)
+            self.wakeup_pipe(pipe, min(itervalues(items)))
+
+        if not self.shared_schedule and schedule:
+            pipe.sadd(QUEUES_KEY, *set(ritem(r)[0] for r, _ in batch['schedule']))
 
         for q, items in iteritems(batch['queues']):
             if items:
-                pipe.rpush(rqname(q), *items)
-
-        pipe.execute()
+                pipe.rpush(self.qkey(q), *items)
+                pipe.sadd(QUEUES_KEY, q)
+        return pipe
 
     def queue_list(self):
-        return [qname(r) for r in self.client.keys(rqname('*'))]
+        """Returns registered queue names"""
+        return [r if PY2 else r.decode('utf-8')
+                for r in self.client.smembers(QUEUES_KEY)]
+
+    def prune_queues(self, queues):
+        """Remove empty queues from registry"""
+        if queues:
+            self._prune([QUEUES_KEY] + [self.qkey(r) for r in queues], queues)
+
+    def sync_queues(self):
+        """Register existing queues using SCAN
+
+        Needed to migrate data pushed by dsq versions without queue registry.
+        """
+        queues = [qname(r) for r in self.client.scan_iter(rqname('*'), 1000)]
+        if queues:
+            self.client.sadd(QUEUES_KEY, *queues)
+        return queues
 
     def stat(self):
-        pipe = self.client.pipeline(False)
-        pipe.zcard(SCHEDULE_KEY)
         queues = self.queue_list()
+        skeys = self.schedule_keys(queues)
+        pipe = self.client.pipeline(False)
+        for k in skeys:
+            pipe.zcard(k)
         for q in queues:
-            pipe.llen(rqname(q))
-        result = pipe.execute()
-        return dict(zip(['schedule'] + queues, result))
+            pipe.llen(self.qkey(q))
+        sizes = pipe.execute()
+
+        result = dict(zip(queues, sizes[len(skeys):]))
+        self.prune_queues([q for q in queues if not result[q]])
+        result = dict(r for r in iteritems(result) if r[1])
+        result['schedule'] = sum(sizes[:len(skeys)])
+        return result
 
     def get_queue(self, queue, offset=0, limit=100):
-        items = self.client.lrange(rqname(queue), offset, offset + limit - 1)
-        return [loads(r, encoding='utf-8') for r in items]
+        items = self.client.lrange(self.qkey(queue), offset, offset + limit - 1)
+        return [self.codec.loads_task(r) for r in items]
 
     def get_schedule(self, offset=0, limit=100):
-        items = [(ts, r.partition(b':'))
+        items = [(ts, ritem(r))
                  for r, ts in self.client.zrange(SCHEDULE_KEY, offset,
                                                  offset + limit - 1, withscores=True)]
-        return [(ts, q if PY2 else q.decode('utf-8'), loads(r, encoding='utf-8'))
-                for ts, (q, _, r) in items]
+        return [(ts, q, self.codec.loads_task(r)) for ts, (q, r) in items]
+
+
+class ClusterQueueStore(QueueStore):
+    """Queue store for redis cluster
+
+    Queue list and its schedule share a hash tag, ``queue:{name}`` and
+    ``schedule:{name}``, so they are placed in one slot. Multi-key operations
+    are split per queue. Queue registry is not pruned to avoid races with
+    pushes into queues located on other nodes.
+
+    Worker's pop checks queues in priority order and blocks on the first one
+    for ``poll_interval`` seconds if all queues are empty.
+
+    Prefetch is not supported: inflight list can't be updated atomically
+    with queues from other slots. Worker refuses to start with prefetch.
+
+    :param client: ``redis.cluster.RedisCluster`` client.
+    :param codec: Task codec.
+    :param poll_interval: Blocking interval on the first queue during pop.
+    """
+    shared_schedule = False
+    supports_prefetch = False
+
+    def __init__(self, client, codec=None, poll_interval=0.1, **kwargs):
+        QueueStore.__init__(self, client, codec, **kwargs)
+        self.poll_interval = poll_interval
+        self._take_zset = client.register_script(TAKE_ZSET_SCRIPT)
+
+    def qkey(self, queue):
+        return 'queue:{%s}' % queue
+
+    def skey(self, queue):
+        return 'schedule:{%s}' % queue
+
+    def ukey(self, queue, key):
+        return 'unique:{%s}:%s' % (queue, key)
+
+    def schedule_keys(self, queues):
+        return [self.skey(r) for r in queues]
+
+    def pop(self, queue_list, timeout=None, now=None):
+        deadline = timeout and time() + timeout
+        while True:
+            for q in queue_list:
+                body = self.client.lpop(self.qkey(q))
+                if body is not None:
+                    return q, self.codec.loads_task(body)
+
+            wait = self.poll_interval
+            if deadline:
+                wait = min(wait, deadline - time())
+                if wait <= 0:
+                    return None, None
+
+            item = self.client.blpop([self.qkey(queue_list[0])], timeout=wait)
+            if item:
+                return queue_list[0], self.codec.loads_task(item[1])
+
+    def reschedule(self, now=None, limit=5000):
+        now = now or time()
+        result = 0, 0, 0
+        for q in self.queue_list():
+            r = self._reschedule([self.skey(q)], [repr(now), limit, 'queue:{', '}'])
+            result = tuple(a + b for a, b in zip(result, r))
+        return result
+
+    def take_many(self, count):
+        queues = self.queue_list()
+        schedule = []
+        for q in queues:
+            items = self._take_zset([self.skey(q)], [count])
+            schedule.extend(zip(items[::2], map(float, items[1::2])))
+
+        items = [self._take_list([self.qkey(q)], [count]) for q in queues]
+        return self._take_result(queues, schedule, items, count)
+
+    def prune_queues(self, queues):
+        """Does nothing, queue registry is not pruned in cluster
+
+        Pruning can't check queue emptiness and registry atomically, so
+        it could drop a queue which just got a task. Names of unused queues
+        stay in registry until removed manually with ``SREM queues <name>``.
+        """
+
+    def sync_queues(self):
+        queues = [qname(r)[1:-1] for r in self.client.scan_iter('queue:{*}', 1000)]
+        if queues:
+            self.client.sadd(QUEUES_KEY, *queues)
+        return queues
+
+    def next_eta(self):
+        pipe = self.client.pipeline()
+        for q in self.queue_list():
+            pipe.zrange(self.skey(q), 0, 0, withscores=True)
+        return min([r[0][1] for r in pipe.execute() if r] or [None])
+
+    def get_schedule(self, offset=0, limit=100):
+        items = []
+        for q in self.queue_list():
+            items.extend((ts, ritem(r)) for r, ts in self.client.zrange(
+                self.skey(q), 0, offset + limit - 1, withscores=True))
+
+        items.sort(key=lambda r: r[0])
+        return [(ts, q, self.codec.loads_task(r))
+                for ts, (q, r) in items[offset:offset + limit]]
 
 
 class ResultStore(object):
-    """Result store"""
-    def __init__(self, client):
+    """Result store
+
+    :param client: Redis client.
+    :param codec: Result codec, :py:class:`~.codec.MsgpackCodec` by default.
+    """
+    def __init__(self, client, codec=None):
         self.client = client
+        self.codec = codec or MsgpackCodec()
+        self._renotify = client.register_script(RENOTIFY_SCRIPT)
 
     def set(self, id, value, ttl):
-        self.client.set(id, dumps(value, use_bin_type=True), ttl)
+        """Set result and notify waiters"""
+        nkey = notify_key(id)
+        (self.client.pipeline(False)
+         .set(id, self.codec.dumps(value), ttl)
+         .rpush(nkey, 1)
+         .expire(nkey, ttl)
+         .execute())
+
+    def wait(self, id, timeout):
+        """Wait result notification up to ``timeout`` seconds
+
+        :returns: result or None if timeout is reached.
+        """
+        value = self.get(id)
+        if value is not None:
+            return value
+
+        nkey = notify_key(id)
+        if self.client.blpop([nkey], timeout=timeout):
+            self._renotify([nkey, id])
+            return self.get(id)
+
+    def get_many(self, ids):
+        """Fetch results for many ids in one round trip
+
+        :returns: list of results, None for missing ones.
+        """
+        if not ids:
+            return []
+        # cluster client can't MGET keys from different slots
+        mget = getattr(self.client, 'mget_nonatomic', self.client.mget)
+        loads = self.codec.loads
+        return [None if r is None else loads(r) for r in mget(ids)]
 
     def get(self, id):
         value = self.client.get(id)
         if value is not None:
-            return loads(value, encoding='utf-8')
+            return self.codec.loads(value)
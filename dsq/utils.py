@@ -1,5 +1,7 @@
+import os
 import sys
 import signal
+import threading
 from uuid import uuid4
 from base64 import urlsafe_b64encode
 from itertools import islice
@@ -7,6 +9,10 @@ from functools import wraps
 
 from redis import StrictRedis
 
+from .compat import string_types
+
+RATE_PERIODS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+
 
 def make_id():
     """Make uniq short id"""
@@ -17,10 +23,37 @@ def task_fmt(task):
     arglist = []
     arglist.extend('{}'.format(r) for r in task.get('args', ()))
     arglist.extend('{}={}'.format(*r) for r in task.get('kwargs', {}).items())
+    if 'args_blob' in task:
+        arglist.append('...')
     return '{}({})#{}'.format(task.get('name', '__no_name__'),
                               ', '.join(arglist), task.get('id', '__no_id__'))
 
 
+def parse_rate(value):
+    """Parses rate limit
+
+    :param value: ``'100/s'``, ``'10/m'``, ``'1000/h'``, ``'5/d'`` or
+                  a number of tasks per second.
+    :returns: ``(rate, period)`` tuple.
+    """
+    if not isinstance(value, string_types):
+        return value, 1
+    rate, _, unit = value.partition('/')
+    return float(rate), RATE_PERIODS[unit or 's']
+
+
+def get_rss():
+    """Returns resident memory size of current process in bytes
+
+    Uses /proc/self/statm, returns None if it's not available.
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError):  # pragma: no cover
+        return None
+
+
 def iter_chunks(seq, chunk_size):
     it = iter(seq)
     while True:
@@ -60,6 +93,14 @@ def redis_client(url):  # pragma: no cover
         return StrictRedis()
 
 
+def redis_cluster_client(url):  # pragma: no cover
+    from redis.cluster import RedisCluster
+    url = url or 'localhost:6379'
+    if not url.startswith('redis://'):
+        url = 'redis://' + url
+    return RedisCluster.from_url(url)
+
+
 class LoadError(Exception):
     def __init__(self, var, module):
         self.var = var
@@ -103,3 +144,23 @@ def safe_call(func, logger):
         except Exception:
             logger.exception('Error in safe call:')
     return inner
+
+
+class Repeat(object):
+    """Calls ``func`` every ``interval`` seconds in a thread until stopped
+
+    Used to renew leases and heartbeats while a task is running.
+    Errors are logged with ``logger``.
+    """
+    def __init__(self, func, interval, logger):
+        self.stopped = threading.Event()
+        thread = threading.Thread(target=self.run, args=(safe_call(func, logger), interval))
+        thread.daemon = True
+        thread.start()
+
+    def run(self, func, interval):
+        while not self.stopped.wait(interval):
+            func()
+
+    def stop(self):
+        self.stopped.set()
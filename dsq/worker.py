@@ -1,10 +1,17 @@
+import os
+import sys
+import errno
+import socket
 import traceback
 import logging
 import signal
 import random
-from time import time
+import threading
+from time import time, sleep
+from functools import partial
 
-from .utils import RunFlag, task_fmt
+from .utils import RunFlag, Repeat, task_fmt, get_rss
+from .compat import queue
 
 log = logging.getLogger(__name__)
 
@@ -13,12 +20,133 @@ class StopWorker(Exception):
     pass
 
 
+class Limits(object):
+    """Worker recycling limits
+
+    Checked after every task. ``processed`` and last measured ``rss``
+    counters could be used to tune limits.
+
+    :param max_tasks: Stop worker after this amount of tasks.
+    :param max_memory: Stop worker if resident memory exceeds this amount
+                       of megabytes.
+    """
+    def __init__(self, max_tasks=None, max_memory=None):
+        self.max_tasks = max_tasks
+        self.max_memory = max_memory
+        self.processed = 0
+        self.rss = None
+        self.reached = None
+
+    def done(self):
+        """Counts processed task and checks limits
+
+        :returns: name of reached limit or None.
+        """
+        self.processed += 1
+        if self.max_tasks and self.processed >= self.max_tasks:
+            self.reached = 'max-tasks'
+        elif self.max_memory:
+            self.rss = get_rss()
+            if self.rss and self.rss > self.max_memory * 1048576:
+                self.reached = 'max-memory'
+        return self.reached
+
+    def log(self, worker_id):
+        if self.reached:
+            log.info('Worker %s reached %s limit, processed: %s, rss: %s',
+                     worker_id, self.reached, self.processed, self.rss)
+
+
+class QueueOrder(object):
+    """Queue order for the next pop
+
+    Queue list items could have ``name:weight`` form, missing weight is 1.
+    Without weights queues are served in strict priority order. With weights
+    queue list is reordered before every pop via smooth weighted round
+    robin, so non-empty queues are served in proportion to their weights.
+    Pop still waits on all queues at once if they are empty.
+
+    Queues skipped by a pop were empty, they don't accumulate credit.
+
+    :param queue_list: Queue names, e.g. ``['high:5', 'normal:3', 'low:1']``.
+    :param aging: Move non-empty queue to the front of the list if it was
+                  not served for this amount of seconds.
+    """
+    def __init__(self, queue_list, aging=None):
+        self.names = []
+        self.weights = {}
+        for item in queue_list:
+            name, _, weight = item.partition(':')
+            self.names.append(name)
+            self.weights[name] = int(weight or 1)
+
+        self.weighted = any(':' in r for r in queue_list)
+        self.aging = aging
+        self.credit = dict.fromkeys(self.names, 0)
+        self.served_at = dict.fromkeys(self.names, time())
+        self.order = self.names
+
+    def __call__(self, now=None):
+        """Returns queue list for the next pop"""
+        order = self.names
+        if self.weighted:
+            credit, weights = self.credit, self.weights
+            order = sorted(order, key=lambda q: -credit[q] - weights[q])
+
+        if self.aging:
+            now = now or time()
+            aged = sorted((q for q in order if now - self.served_at[q] > self.aging),
+                          key=self.served_at.get)
+            if aged:
+                order = aged + [q for q in order if q not in aged]
+
+        self.order = order
+        return order
+
+    def served(self, queue, now=None):
+        """Accounts a task popped from ``queue``, None means all queues are empty"""
+        now = now or time()
+        order = self.order
+        idx = len(order) if queue is None else order.index(queue)
+        for q in order[:idx]:
+            self.credit[q] = 0
+            self.served_at[q] = now
+
+        if queue is not None:
+            self.served_at[queue] = now
+            if self.weighted:
+                rest = order[idx:]
+                for q in rest:
+                    self.credit[q] += self.weights[q]
+                self.credit[queue] -= sum(self.weights[q] for q in rest)
+
+
 class Worker(object):
-    def __init__(self, manager, lifetime=None, task_timeout=None):
+    """Worker
+
+    :param lifetime: Max worker lifetime in seconds, randomized by 10%.
+    :param task_timeout: Default task timeout.
+    :param prefetch: Fetch up to this amount of tasks at once. Queue store
+                     must support it, see ``supports_prefetch``.
+    :param max_tasks: Exit after this amount of tasks, see :py:class:`Limits`.
+    :param max_memory: Exit after resident memory exceeds this amount of megabytes.
+    :param aging: Queue aging period, see :py:class:`QueueOrder`.
+    """
+    def __init__(self, manager, lifetime=None, task_timeout=None, prefetch=None,
+                 max_tasks=None, max_memory=None, aging=None):
+        if prefetch and not manager.queue.supports_prefetch:
+            raise ValueError('Prefetch is not supported by {}'.format(
+                type(manager.queue).__name__))
+
         self.manager = manager
         self.lifetime = lifetime and random.randint(lifetime, lifetime + lifetime // 10)
         self.task_timeout = task_timeout
+        self.prefetch = prefetch
+        self.heartbeat = 60
+        self.id = '{}-{}'.format(socket.gethostname(), os.getpid())
         self.current_task = None
+        self.limits = Limits(max_tasks, max_memory)
+        self.aging = aging
 
     def process_one(self, task):
         timeout = task.get('timeout', self.task_timeout)
@@ -28,6 +156,48 @@ class Worker(object):
         self.manager.process(task)
 
         if timeout: signal.alarm(0)
+        self.limits.done()
+
+    def process_prefetched(self, queue_list, run=True):
+        """Fetch and process a batch of up to ``prefetch`` tasks
+
+        Processed tasks are acknowledged in batches, the rest of inflight
+        tasks are returned to queues if worker stops in the middle.
+        Heartbeat is renewed in a thread while tasks are running.
+
+        :param queue_list: Queue list or :py:class:`QueueOrder`.
+        :returns: False if queues are empty.
+        """
+        order = queue_list if isinstance(queue_list, QueueOrder) else QueueOrder(queue_list)
+        tasks = self.manager.prefetch(order(), self.id, self.prefetch, self.heartbeat)
+        if not tasks:
+            return False
+
+        for task in tasks:
+            order.served(task['queue'])
+
+        done = acked = 0
+        last_ack = time()
+        # long tasks must not let heartbeat expire, otherwise other workers
+        # requeue inflight tasks of this one
+        beat = Repeat(partial(self.manager.queue.ack, self.id, 0, self.heartbeat),
+                      self.heartbeat / 3.0, log)
+        try:
+            for task in tasks:
+                if not run or self.limits.reached:
+                    break
+                done += 1
+                self.process_one(task)
+                if time() - last_ack > self.heartbeat / 3:
+                    self.manager.queue.ack(self.id, done - acked, self.heartbeat)
+                    acked, last_ack = done, time()
+        finally:
+            beat.stop()
+            self.manager.queue.ack(self.id, done - acked, self.heartbeat)
+            if done < len(tasks):
+                self.manager.queue.requeue_inflight(self.id)
+
+        return True
 
     def alarm_handler(self, signum, frame):  # pragma: no cover
         trace = ''.join(traceback.format_stack(frame))
@@ -37,22 +207,236 @@ class Worker(object):
             trace)
         raise StopWorker()
 
+    def requeue_dead(self):
+        """Returns inflight tasks of dead workers and batches into queues"""
+        queue = self.manager.queue
+        if self.prefetch or self.manager.batches and queue.supports_prefetch:
+            queue.requeue_inflight()
+
     def process(self, queue_list, burst=False):  # pragma: no cover
         signal.signal(signal.SIGALRM, self.alarm_handler)
+        self.requeue_dead()
 
         run = RunFlag()
+        order = QueueOrder(queue_list, self.aging)
         start = time()
         while run:
-            task = self.manager.pop(queue_list, 1)
+            try:
+                if not (self.prefetch and self.process_prefetched(order, run)):
+                    task = self.manager.pop(order(), 1)
+                    order.served(task and task['queue'])
+                    if task:
+                        self.process_one(task)
+                    elif burst:
+                        break
+            except StopWorker:
+                break
+
+            if self.lifetime and time() - start > self.lifetime:
+                break
+
+            if self.limits.reached:
+                break
+
+        self.limits.log(self.id)
+        self.manager.close()
+
+
+class ThreadWorker(Worker):
+    """Worker running tasks in a pool of threads
+
+    Main thread pops a task only when there is an idle thread, so queue
+    priorities are kept. It also acts as a watchdog: if task exceeds its
+    timeout, worker logs thread's stack, stops popping, waits other threads
+    and exits leaving hung thread behind. Worker should be restarted by
+    supervisor after that.
+
+    Task states are per-thread.
+
+    :param threads: Thread pool size.
+    """
+    def __init__(self, manager, lifetime=None, task_timeout=None, threads=4,
+                 max_tasks=None, max_memory=None, aging=None):
+        Worker.__init__(self, manager, lifetime, task_timeout,
+                        max_tasks=max_tasks, max_memory=max_memory, aging=aging)
+        self.threads = threads
+        self.cond = threading.Condition()
+        self.running = {}
+        self.hung = set()
+        self.busy = 0
+        self.stopped = False
+
+    def thread_loop(self, tasks):
+        ident = threading.current_thread().ident
+        while True:
+            task = tasks.get()
+            if task is None:
+                break
+
+            timeout = task.get('timeout', self.task_timeout)
+            with self.cond:
+                self.running[ident] = task, timeout and time() + timeout
+            try:
+                self.manager.process(task)
+            except StopWorker:
+                self.stopped = True
+            finally:
+                with self.cond:
+                    del self.running[ident]
+                    self.busy -= 1
+                    self.limits.done()
+                    self.cond.notify()
+
+    def check_timeouts(self):
+        """Finds threads with timed out tasks
+
+        :returns: True if there are hung threads.
+        """
+        now = time()
+        with self.cond:
+            items = list(self.running.items())
+
+        frames = sys._current_frames()
+        for ident, (task, deadline) in items:
+            if deadline and now > deadline and ident not in self.hung:
+                self.hung.add(ident)
+                trace = ''.join(traceback.format_stack(frames[ident])) if ident in frames else ''
+                log.error('Timeout during processing task %s\n %s', task_fmt(task), trace)
+
+        return bool(self.hung)
+
+    def wait_idle(self, timeout):
+        with self.cond:
+            if self.busy >= self.threads:
+                self.cond.wait(timeout)
+            return self.busy < self.threads
+
+    def process(self, queue_list, burst=False, run=None):
+        """Process tasks until stopped by signal
+
+        :param run: Run flag, worker installs signal handlers by default.
+        """
+        manager = self.manager
+        manager.thread_states = True
+        self.requeue_dead()
+        run = RunFlag() if run is None else run
+        tasks = queue.Queue()
+        threads = [threading.Thread(target=self.thread_loop, args=(tasks,))
+                   for _ in range(self.threads)]
+        for t in threads:
+            t.daemon = True
+            t.start()
+
+        order = QueueOrder(queue_list, self.aging)
+        start = time()
+        while run and not self.stopped and not self.limits.reached:
+            if self.check_timeouts():
+                break
+
+            if not self.wait_idle(1) or self.stopped or self.limits.reached:
+                continue
+
+            task = manager.pop(order(), 1)
+            order.served(task and task['queue'])
             if task:
-                try:
-                    self.process_one(task)
-                except StopWorker:
-                    break
+                with self.cond:
+                    self.busy += 1
+                tasks.put(task)
             elif burst:
                 break
 
             if self.lifetime and time() - start > self.lifetime:
                 break
 
-        self.manager.close()
+        for t in threads:
+            tasks.put(None)
+
+        for t in threads:
+            while t.is_alive() and t.ident not in self.hung:
+                t.join(1)
+                self.check_timeouts()
+
+        self.limits.log(self.id)
+        manager.close()
+
+
+class Prefork(object):
+    """Prefork supervisor
+
+    Runs ``target`` in ``processes`` forked children and respawns them on
+    exit. Modules imported before fork are shared with children via
+    copy-on-write. TERM and INT signals are forwarded to children, supervisor
+    exits after all children exit.
+
+    :param target: Function to run in a child, usually creates a worker and
+                   runs it.
+    :param processes: Amount of children.
+    :param respawn: Start a new child on exit of other one.
+    """
+    #: Children living less than this amount of seconds are respawned
+    #: with a delay to avoid fork loop.
+    restart_delay = 1
+
+    def __init__(self, target, processes, respawn=True):
+        self.target = target
+        self.processes = processes
+        self.respawn = respawn
+        self.children = {}
+        self.stopping = False
+
+    def spawn(self):
+        pid = os.fork()
+        if not pid:  # pragma: no cover
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            random.seed()
+            code = 0
+            try:
+                self.target()
+            except BaseException:
+                log.exception('Worker error')
+                code = 1
+            finally:
+                os._exit(code)
+
+        self.children[pid] = time()
+
+    def stop(self, signum=signal.SIGTERM, frame=None):
+        """Stops respawning and sends signal to children"""
+        self.stopping = True
+        for pid in list(self.children):
+            try:
+                os.kill(pid, signum)
+            except OSError:  # pragma: no cover
+                pass
+
+    def run(self):
+        """Starts children and waits them"""
+        for _ in range(self.processes):
+            self.spawn()
+
+        while self.children:
+            try:
+                pid, status = os.wait()
+            except OSError as e:  # pragma: no cover
+                if e.errno == errno.EINTR:  # python 2
+                    continue
+                raise
+
+            started = self.children.pop(pid, None)
+            if started is None:  # pragma: no cover
+                continue
+
+            if status:
+                log.error('Worker %s exited with status %s', pid, status)
+
+            if self.respawn and not self.stopping:
+                if time() - started < self.restart_delay:
+                    sleep(self.restart_delay)
+                if not self.stopping:
+                    self.spawn()
+
+    def start(self):  # pragma: no cover
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        self.run()
@@ -1,3 +1,7 @@
+import sys
 import logging
 
 logging.basicConfig()
+
+if sys.version_info < (3, 7):
+    collect_ignore = ['test_aio.py']
@@ -0,0 +1,253 @@
+import time
+import asyncio
+
+import redis
+from redis.asyncio import Redis
+
+from dsq.aio import (AsyncManager, AsyncQueueStore, AsyncResultStore,
+                     AsyncWorker, from_manager)
+from dsq.store import QueueStore, ResultStore
+from dsq.manager import Manager
+from dsq.worker import StopWorker
+
+
+def run(func):
+    async def inner():
+        client = Redis()
+        try:
+            await func(AsyncManager(AsyncQueueStore(client, offload_threshold=100),
+                                    AsyncResultStore(client)))
+        finally:
+            await client.aclose()
+
+    def test():
+        cl = redis.StrictRedis()
+        cl.flushdb()
+        asyncio.run(inner())
+
+    test.__name__ = func.__name__
+    return test
+
+
+def sync_manager():
+    cl = redis.StrictRedis()
+    return Manager(QueueStore(cl), ResultStore(cl))
+
+
+@run
+async def test_push(manager):
+    @manager.task(queue='normal', keep_result=10)
+    def add(a, b):
+        return a + b
+
+    result = await add.push(1, 2)
+    assert not await result.ready()
+    assert not await result.ready(0.1)
+
+    sync = sync_manager()
+    sync.register('add', add)
+    sync.process(sync.pop(['normal'], 1))
+    assert (await result.ready()).value == 3
+    assert await result.ready() is result
+
+    await add.modify(delay=10).push(3, 4)
+    (_, q, task), = sync.queue.get_schedule()
+    assert q == 'normal' and task['args'] == [3, 4]
+
+
+@run
+async def test_push_many_and_gather(manager):
+    @manager.task(queue='normal', keep_result=10)
+    def add(a, b):
+        return a + b
+
+    results = await add.push_many([((1, 2), None), ((3, 4), None),
+                                   ((5, 6), None, {'unique': True})], chunk_size=2)
+    assert len(results) == 3
+    assert await manager.gather(results) == [None] * 3
+
+    sync = sync_manager()
+    sync.register('add', add)
+    sync.process(sync.pop(['normal'], 1))
+    results = list(results)
+    assert [r.id async for r in manager.as_completed(results, 0.1, 0.05)] == [results[0].id]
+
+    sync.process(sync.pop(['normal'], 1))
+    sync.process(sync.pop(['normal'], 1))
+    assert [r.value for r in await manager.gather(results, 1)] == [3, 7, 11]
+
+
+@run
+async def test_unique_and_offload(manager):
+    @manager.task(queue='normal', debounce=10, unique=lambda data: 'key')
+    def task(data):
+        return data
+
+    data = 'x' * 200
+    r1 = await task.push(data)
+    r2 = await task.push(data)
+    assert r1.id != r2.id
+
+    sync = sync_manager()
+    (_, _, item), = sync.queue.get_schedule()
+    assert item['id'].decode() == r2.id and 'args_ref' in item
+    assert await manager.queue.load_args(item) == ([data], {})
+    assert await manager.queue.load_args({'args': [1]}) == ([1], {})
+
+    item['queue'] = 'normal'
+    await manager.queue.release_unique(item)
+    r3 = await task.modify(debounce=None).push(data)
+    assert r3.id != r2.id
+
+    queue, item = await manager.queue.pop(['normal'], 0.1)
+    assert queue == 'normal' and item['id'].decode() == r3.id
+    assert await manager.queue.pop(['normal'], 0.1) == (None, None)
+
+    sync.queue.reschedule(now=2e9)
+    _, item = await manager.queue.pop(['normal'], 0.1)
+    assert item['id'].decode() == r2.id
+
+
+@run
+async def test_result_store(manager):
+    store = manager.result
+    assert await store.wait('id', 0.1) is None
+
+    async def set():
+        await asyncio.sleep(0.1)
+        await store.set('id', 10, 20)
+
+    waiter = asyncio.ensure_future(store.wait('id', 5))
+    await set()
+    assert await waiter == 10
+    assert await store.wait('id', 5) == 10
+    assert await store.get_many([]) == []
+    assert await store.get_many(['id', 'none']) == [10, None]
+
+
+@run
+async def test_worker(manager):
+    @manager.task(queue='normal', keep_result=10)
+    async def sleep(value):
+        await asyncio.sleep(value)
+        return value
+
+    @manager.task(queue='high', keep_result=10)
+    def add(a, b):
+        return a + b
+
+    results = await sleep.push_many([((0.5,), None)] * 4 + [((5,), None)])
+    r_add = await add.push(1, 2)
+    worker = AsyncWorker(manager, task_timeout=1, concurrency=6)
+    start = time.time()
+    await worker.process(['high', 'normal'], burst=True)
+    assert time.time() - start < 1.5
+
+    results = await manager.gather(results)
+    assert [r.value for r in results[:4]] == [0.5] * 4
+    assert results[4] is None
+    assert (await r_add.ready()).value == 3
+
+    results = await sleep.push_many([((0.1,), None)] * 2)
+    await AsyncWorker(manager, lifetime=1e-6).process(['normal'])
+    assert [bool(r) for r in await manager.gather(results)] == [True, False]
+
+    worker = AsyncWorker(manager, max_tasks=1)
+    await worker.process(['normal'])
+    assert worker.limits.reached == 'max-tasks'
+
+
+@run
+async def test_process(manager):
+    @manager.task(queue='normal', with_context=True, retry=1, retry_delay=10)
+    async def fail(ctx):
+        assert ctx.task['name'] == 'fail'
+        1/0
+
+    @manager.task(queue='normal')
+    def stop():
+        raise StopWorker()
+
+    sync = sync_manager()
+    await fail.push()
+    await manager.process(await manager.pop(['normal'], 1))
+    (_, _, task), = sync.queue.get_schedule()
+    assert task['retry'] == 0
+
+    await manager.push('normal', 'unknown')
+    await manager.process(await manager.pop(['normal'], 1))
+    assert sync.queue.get_queue('unknown')[0]['name'] == 'unknown'
+
+    await manager.push('normal', 'fail', ttl=10, unique=True)
+    await manager.process(await manager.pop(['normal'], 1), now=time.time() + 20)
+    await manager.push('normal', 'fail', unique=True)
+    await manager.process(await manager.pop(['normal'], 1))
+    assert not sync.queue.client.keys('unique:*')
+
+    await stop.push()
+    await fail.push()
+    worker = AsyncWorker(manager, concurrency=1)
+    await worker.process(['normal'])
+    assert worker.stopped
+    assert sync.queue.get_queue('normal')[0]['name'] == 'fail'
+
+
+def test_from_manager():
+    sync = sync_manager()
+
+    @sync.task(queue='normal', keep_result=10)
+    async def add(a, b):
+        return a + b
+
+    async def main():
+        manager = from_manager(sync)
+        result = await manager.push('normal', 'add', (1, 2), keep_result=10)
+        await AsyncWorker(manager).process(['normal'], burst=True)
+        assert (await result.ready()).value == 3
+        await manager.queue.client.aclose()
+        await manager.result.client.aclose()
+
+    sync.queue.client.flushdb()
+    asyncio.run(main())
+
+
+@run
+async def test_batch_task(manager):
+    @manager.task(queue='normal', keep_result=10, batch_size=10, with_context=True)
+    async def check(ctx, items):
+        assert len(ctx.task) == 1
+        return [ValueError(a) if a < 0 else a for (a,), _ in items]
+
+    r1 = await check.push(1)
+    r2 = await check.push(-1)
+    await AsyncWorker(manager).process(['normal'], burst=True)
+    assert (await r1.ready()).value == 1
+    assert (await r2.ready()).error == 'ValueError'
+
+
+@run
+async def test_rate_limit(manager):
+    @manager.task(queue='normal', rate_limit='1/m')
+    async def call():
+        pass
+
+    await call.push()
+    await call.push()
+    await AsyncWorker(manager).process(['normal'], burst=True)
+    (ts, _, task), = sync_manager().queue.get_schedule()
+    assert 55 < ts - time.time() <= 60 and task['rate_deferred']
+
+
+@run
+async def test_concurrency_limit(manager):
+    manager.slot_lease = 0.3
+
+    @manager.task(queue='normal', concurrency=1, keep_result=10)
+    async def report():
+        await asyncio.sleep(0.25)
+
+    results = await report.push_many([((), None)] * 2)
+    start = time.time()
+    await AsyncWorker(manager).process(['normal'], burst=True)
+    assert time.time() - start > 0.5
+    assert all(await manager.gather(results))
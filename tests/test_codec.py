@@ -0,0 +1,68 @@
+import msgpack
+
+from dsq.codec import (MsgpackCodec, CompactCodec, compact_task, expand_task,
+                       compress, decompress, COMPRESSED, pack_args, unpack_args)
+
+
+def test_compact_task():
+    task = {'name': 'boo', 'id': b'id', 'args': [1, 2]}
+    assert compact_task(task) == [1, 'boo', b'id', [1, 2]]
+    assert expand_task(compact_task(task)) == task
+
+    task = {'name': 'boo', 'id': b'id', 'keep_result': 10, 'queue': 'normal'}
+    envelope = compact_task(task)
+    assert envelope[-1] == {'queue': 'normal'}
+    assert expand_task(envelope) == task
+
+    assert expand_task('boo') == 'boo'
+    assert expand_task([]) == []
+
+
+def test_codecs():
+    task = {'name': 'boo', 'id': b'id', 'args': [b'bytes', u'str'],
+            'kwargs': {'foo': {1: 2}}, 'expire': 10.5}
+
+    legacy = MsgpackCodec().dumps_task(task)
+    compact = CompactCodec().dumps_task(task)
+    assert len(compact) < len(legacy)
+    assert type(msgpack.loads(legacy)) is dict
+
+    for codec in (MsgpackCodec(), CompactCodec()):
+        assert codec.loads_task(legacy) == task
+        assert codec.loads_task(compact) == task
+        assert codec.loads(codec.dumps({'result': [1]})) == {'result': [1]}
+
+    assert CompactCodec().loads_task(CompactCodec().dumps_task('raw')) == 'raw'
+
+
+def test_compression():
+    data = b'a' * 100
+    assert compress(data, None) is data
+    assert compress(data, 101) is data
+    assert compress(b'abc', 1) == b'abc'
+    packed = compress(data, 100)
+    assert packed[:2] == b'\xc1z'
+    assert decompress(packed) == data
+    assert decompress(data) is data
+
+    task = {'name': 'boo', 'id': b'id', 'args': ['x' * 1000]}
+    for codec in (MsgpackCodec(100), CompactCodec(100)):
+        packed = codec.dumps_task(task)
+        assert packed[:1] == COMPRESSED and len(packed) < 100
+        assert MsgpackCodec().loads_task(packed) == task
+        assert codec.loads_task(MsgpackCodec().dumps_task(task)) == task
+        assert codec.loads(codec.dumps(task)) == task
+
+
+def test_pack_args():
+    task = {'name': 'boo', 'id': b'id', 'args': ['x' * 1000], 'kwargs': {'a': 1}}
+    for codec in (MsgpackCodec(100, pack_args=True), CompactCodec(100, pack_args=True)):
+        packed = codec.dumps_task(task)
+        assert len(packed) < 100
+        loaded = MsgpackCodec().loads_task(packed)
+        assert 'args' not in loaded and loaded['name'] == 'boo'
+        assert unpack_args(loaded, codec.loads) == (['x' * 1000], {'a': 1})
+        assert codec.dumps_task(loaded) == packed
+
+    assert pack_args({'name': 'boo'}, None) == {'name': 'boo'}
+    assert unpack_args({'args': [1]}, None) == ([1], {})
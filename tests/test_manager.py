@@ -1,13 +1,15 @@
 import time
 import signal
+import threading
 
 import pytest
 import redis
 import msgpack
 
 from dsq.store import QueueStore, ResultStore
-from dsq.manager import Manager, make_task
-from dsq.worker import Worker, StopWorker
+from dsq.manager import Manager, make_task, unique_key
+from dsq.worker import Worker, ThreadWorker, StopWorker, Limits
+from dsq.codec import CompactCodec
 
 
 @pytest.fixture
@@ -81,6 +83,30 @@ def test_retry_task(manager):
     assert manager.pop(['test'], 1)['retry'] == 0
 
 
+def test_retry_backoff(manager):
+    @manager.task(queue='test', retry=True, retry_delay=10, retry_backoff=True,
+                  retry_backoff_max=50, retry_on=(ValueError, KeyError), dead='dead')
+    def foo(exc):
+        raise {'value': ValueError, 'type': TypeError}[exc]()
+
+    foo.push('value')
+    etas = []
+    for _ in range(4):
+        manager.queue.reschedule(now=1e10)
+        task = manager.pop(['test'], 1)
+        manager.process(task, now=100)
+        etas.append(manager.queue.get_schedule()[0][0])
+    assert etas == [110, 120, 140, 150]
+    assert task['attempt'] == 4
+
+    assert manager.retry_eta({'retry_delay': 10, 'retry_jitter': True}, now=100) <= 110
+    assert manager.retry_eta({'retry_delay': 0, 'retry_backoff': True}, now=100) == 0
+
+    foo.push('type')
+    manager.process(manager.pop(['test'], 1))
+    assert manager.pop(['dead'], 1)['args'] == ['type']
+
+
 def test_dead_task(manager):
     @manager.task
     def foo():
@@ -215,6 +241,30 @@ def test_result_exception(manager):
     assert not hasattr(result, 'value')
 
 
+def test_gather_results(manager):
+    @manager.task(queue='normal', keep_result=10)
+    def div(a, b):
+        return a / b
+
+    results = div.push_many([((4, 2), None), ((1, 0), None), ((9, 3), None)])
+    assert manager.gather(results) == [None, None, None]
+    assert list(manager.as_completed(results, 0.1, 0.05)) == []
+
+    manager.process(manager.pop(['normal'], 1))
+    manager.process(manager.pop(['normal'], 1))
+    done = list(manager.as_completed(results))
+    assert [r.id for r in done] == [r.id for r in results[:2]]
+    assert done[1].error == 'ZeroDivisionError'
+    assert results[0] is done[0] and results[0].value == 2
+    assert results[-1] is list(results)[2]
+
+    manager.result.client.delete(*results.ids[:2])
+    manager.process(manager.pop(['normal'], 1))
+    done = manager.gather(results, 1)
+    assert done[0].value == 2
+    assert done[2].value == 3
+
+
 def test_tasks_should_have_non_none_fields(manager):
     manager.push('boo', 'foo')
     t = manager.pop(['boo'], 1)
@@ -230,6 +280,8 @@ def test_stateful_tasks(manager):
         ctx.state[0] += 1
         ctx.set_result(None)
 
+    manager.init_states()
+    assert manager.states['task'] == [0]
     manager.process(make_task('task'))
     manager.process(make_task('task'))
     manager.process(make_task('task'))
@@ -266,6 +318,14 @@ def test_crontab_collector(manager):
     manager.process(manager.pop(['normal'], 1))
     assert bar.called == True
 
+    @manager.crontab('0 3 * * *')
+    def foo():
+        pass
+
+    ts, actions = manager.crontab.crontab().next_after(
+        time.mktime((2016, 1, 17, 2, 59, 0, 0, 0, -1)))
+    assert len(actions) == 3 and time.localtime(ts)[3:5] == (3, 0)
+
 
 def test_periodic_collector(manager):
     @manager.periodic(1)
@@ -287,3 +347,425 @@ def test_periodic_collector(manager):
 
     manager.process(manager.pop(['normal'], 1))
     assert bar.called == True
+
+
+def test_push_many(manager):
+    @manager.task(queue='normal', keep_result=10)
+    def add(a, b):
+        return a + b
+
+    results = add.push_many([((1, 2), None),
+                             ((3,), {'b': 4}, {'queue': 'high'}),
+                             {'args': (5, 6), 'delay': 10}], chunk_size=2)
+    assert len(results) == 3
+    assert [r['args'] for r in manager.queue.get_queue('normal')] == [[1, 2]]
+    (_, q, t), = manager.queue.get_schedule()
+    assert q == 'normal' and t['args'] == [5, 6]
+
+    manager.process(manager.pop(['high'], 1))
+    assert results[1].ready().value == 7
+    assert [r.id for r in results] == results.ids
+
+
+def test_push_many_sync(manager):
+    manager.sync = True
+
+    @manager.task
+    def add(a, b):
+        return a + b
+
+    assert [r.value for r in add.push_many([((1, 2), None), ((3, 4), None)])] == [3, 7]
+
+
+def test_worker_prefetch(manager):
+    @manager.task(queue='normal')
+    def foo(value):
+        foo.called.append(value)
+        if value == 0:
+            time.sleep(1.5)
+            # heartbeat is renewed during long task
+            foo.requeued = manager.queue.requeue_inflight()
+        if value == 2:
+            raise StopWorker()
+    foo.called = []
+
+    for r in range(4):
+        foo.push(r)
+
+    w = Worker(manager, prefetch=3)
+    w.heartbeat = 1
+    with pytest.raises(StopWorker):
+        w.process_prefetched(['normal'])
+
+    assert foo.called == [0, 1, 2]
+    assert foo.requeued == 0
+    assert [r['args'] for r in manager.queue.get_queue('normal')] == [[3]]
+    assert not manager.queue.client.llen('inflight:' + w.id)
+
+    assert w.process_prefetched(['normal'], run=False)
+    assert [r['args'] for r in manager.queue.get_queue('normal')] == [[3]]
+    assert w.process_prefetched(['normal'])
+    assert not w.process_prefetched(['normal'])
+    assert foo.called == [0, 1, 2, 3]
+
+
+def test_thread_worker(manager):
+    @manager.task(queue='normal', init_state=list)
+    def sleep(ctx, value):
+        ctx.state.append(value)
+        time.sleep(value)
+        if value == 0:
+            raise StopWorker()
+
+    for _ in range(4):
+        sleep.push(0.3)
+
+    start = time.time()
+    worker = ThreadWorker(manager, threads=4)
+    worker.process(['normal'], burst=True, run=True)
+    assert time.time() - start < 2
+    assert sorted(map(len, manager.states.values())) == [1, 1, 1, 1]
+    assert not worker.running and not worker.busy
+
+    sleep.push(0)
+    sleep.push(0.1)
+    worker = ThreadWorker(manager, threads=1)
+    worker.process(['normal'], run=True)
+    assert worker.stopped
+    assert len(manager.queue.get_queue('normal')) == 1
+
+    sleep.push(3)
+    start = time.time()
+    worker = ThreadWorker(manager, task_timeout=0.5, threads=1)
+    worker.process(['normal'], run=True)
+    assert time.time() - start < 2.5
+    assert worker.hung
+
+    worker = ThreadWorker(manager, lifetime=1)
+    worker.process(['normal'], run=True)
+    assert not worker.stopped
+
+
+def test_worker_limits(manager):
+    limits = Limits(max_memory=1)
+    assert limits.done() == 'max-memory'
+    assert limits.rss > 1048576 and limits.processed == 1
+    assert not Limits(max_memory=100000).done()
+
+    @manager.task(queue='normal')
+    def foo(value):
+        pass
+
+    foo.push_many([((r,), None) for r in range(5)])
+    w = Worker(manager, prefetch=3, max_tasks=2)
+    assert w.process_prefetched(['normal'])
+    assert w.limits.reached == 'max-tasks'
+    assert [r['args'] for r in manager.queue.get_queue('normal')] == [[2], [3], [4]]
+
+    w = ThreadWorker(manager, threads=1, max_tasks=2)
+    w.process(['normal'], run=True)
+    assert w.limits.processed == 2
+    assert [r['args'] for r in manager.queue.get_queue('normal')] == [[4]]
+
+
+def test_batch_task(manager):
+    @manager.task(queue='normal', keep_result=10, batch_size=3, retry=1, retry_delay=10)
+    def index(items):
+        index.calls.append([a for (a,), _ in items])
+        return [ValueError('boo') if a < 0 else a * 2 for (a,), _ in items]
+    index.calls = []
+
+    @manager.task(queue='normal')
+    def foo():
+        foo.called = True
+
+    r1 = index.push(1)
+    manager.push('normal', 'foo')
+    r2 = index.push(-1)
+    r4 = index.push(3)
+    manager.push('normal', 'index', (2,), ttl=-1)
+    manager.process(manager.pop(['normal'], 1))
+    assert index.calls == [[1]]
+    assert r1.ready().value == 2
+    assert manager.queue.client.llen('queue:normal') == 4
+
+    manager.process(manager.pop(['normal'], 1))
+    assert foo.called
+
+    manager.process(manager.pop(['normal'], 1))
+    assert index.calls == [[1], [-1, 3]]
+    assert not r2.ready()
+    assert r4.ready().value == 6
+    (_, _, task), = manager.queue.get_schedule()
+    assert task['args'] == [-1] and task['retry'] == 0
+    assert not manager.queue.client.keys('inflight*')
+
+    @manager.task(queue='normal', batch_size=2, batch_wait=1, with_context=True,
+                  init_state=lambda: [])
+    def collect(ctx, items):
+        ctx.state.append(len(ctx.task))
+        if len(items) == 2:
+            1/0
+
+    collect.push(1)
+    threading.Timer(0.1, collect.push, (2,)).start()
+    manager.process(manager.pop(['normal'], 1))
+    collect.push(3)
+    manager.process(manager.pop(['normal'], 1), now=time.time() + 10)
+    manager.push('normal', 'collect', ttl=-1)
+    manager.process(manager.pop(['normal'], 1))
+    assert manager.states['collect'] == [2, 1]
+
+    manager.register('index', index.func)
+    assert 'index' not in manager.batches
+
+
+def test_batch_task_edge_cases(manager):
+    @manager.task(queue='normal', keep_result=10, batch_size=10)
+    def stop(items):
+        if items[0][0][0] < 0:
+            raise StopWorker()
+        if items[0][0][0] == 0:
+            return ['ok']
+        return ['ok'] * len(items)
+
+    r1 = stop.push(1)
+    r2 = stop.modify(unique=True).push(2)
+    manager.process(manager.pop(['normal'], 1))
+    assert r1.ready().value == r2.ready().value == 'ok'
+    assert not manager.queue.client.keys('unique:*')
+
+    r1 = stop.push(0)
+    r2 = stop.push(1)
+    manager.process(manager.pop(['normal'], 1))
+    assert r1.ready().error == r2.ready().error == 'ValueError'
+
+    assert manager.process_batch([make_task('stop', expire=1)]) is None
+    stop.push(-1)
+    stop.push(1)
+    with pytest.raises(StopWorker):
+        manager.process(manager.pop(['normal'], 1))
+    assert manager.queue.get_queue('normal')[0]['args'] == [1]
+    assert not manager.queue.client.keys('inflight*')
+
+    manager.prefetch(['normal'], 'batch-dead', 1)
+    manager.queue.client.delete('worker:batch-dead')
+    Worker(manager).requeue_dead()
+    assert manager.queue.get_queue('normal')[0]['args'] == [1]
+
+    manager.sync = True
+    assert stop.push(1).value == ['ok']
+    manager.register('check', lambda items: [ValueError()], batch_size=10)
+    with pytest.raises(ValueError):
+        manager.push('normal', 'check')
+
+
+def test_batch_limits(manager):
+    manager.slot_lease = 0.3
+
+    @manager.task(queue='normal', batch_size=5, rate_limit='4/m', concurrency=3)
+    def index(items):
+        index.calls.append([a for (a,), _ in items])
+        if len(items) == 2:
+            time.sleep(0.35)
+            index.alive = (manager.queue.requeue_inflight() == 0
+                           and manager.queue.client.zcard('slots:{index}') == 2)
+    index.calls = []
+
+    manager.queue.acquire_slots('index', 3, ['dead1', 'dead2'])
+    index.push(0)
+    index.push(1)
+    manager.process(manager.pop(['normal'], 1), now=100)
+    assert index.calls == [[0]]
+
+    manager.queue.release_slot('index', 3, ['dead1', 'dead2'])
+    manager.process(manager.pop(['normal'], 1), now=100)
+    assert index.calls == [[0], [1]]
+
+    index.push_many([((r,), None) for r in range(2, 5)])
+    manager.process(manager.pop(['normal'], 1), now=100)
+    assert index.calls == [[0], [1], [2, 3]]
+    assert index.alive
+
+    manager.process(manager.pop(['normal'], 1), now=100)
+    assert index.calls == [[0], [1], [2, 3]]
+    (ts, _, task), = manager.queue.get_schedule()
+    assert task['args'] == [4] and ts == 115
+    assert not manager.queue.client.zcard('slots:{index}')
+    assert not manager.queue.client.keys('inflight*')
+
+
+def test_compact_codec(manager):
+    manager.queue.codec = CompactCodec()
+
+    @manager.task(queue='normal', keep_result=10)
+    def add(a, b):
+        return a + b
+
+    result = add.push(1, b=2)
+    raw = manager.queue.client.lindex('queue:normal', 0)
+    assert msgpack.loads(raw)[0] == 1
+    manager.process(manager.pop(['normal'], 1))
+    assert result.ready().value == 3
+
+
+def test_packed_args(manager):
+    manager.queue.codec = CompactCodec(pack_args=True)
+
+    @manager.task(queue='normal', keep_result=10)
+    def add(a, b):
+        return a + b
+
+    result = add.push(1, b=2)
+    add.modify(ttl=10).push(3, b=4)
+    manager.push('normal', 'unknown', (5,))
+
+    manager.process(manager.pop(['normal'], 1))
+    assert result.ready().value == 3
+
+    manager.queue.codec.loads = None
+    manager.process(manager.pop(['normal'], 1), now=time.time() + 20)
+    manager.process(manager.pop(['normal'], 1))
+    task = manager.pop(['unknown'], 1)
+    assert 'args' not in task and task['args_blob']
+
+
+def test_offloaded_args(manager):
+    manager.queue.offload_threshold = 100
+
+    @manager.task(queue='normal', keep_result=10, dead='dead')
+    def size(data, extra=None):
+        return len(data) + len(extra or '')
+
+    big = 'x' * 200
+    r1 = size.push(big)
+    r2 = size.push(big)
+    size.push('small')
+    size.modify(delay=10).push(big, extra=big)
+
+    cl = manager.queue.client
+    assert len(cl.keys('payload:*')) == 2
+    t1, t2, t3 = [manager.pop(['normal'], 1) for _ in range(3)]
+    assert 'args' not in t1 and t1['args_ref'] == t2['args_ref']
+    assert t3['args'] == ['small']
+    (_, _, t), = manager.queue.get_schedule()
+    assert 10 * 86400 > cl.ttl('payload:' + t['args_ref']) > 7 * 86400
+
+    manager.process(t1)
+    assert r1.ready().value == 200
+
+    manager.queue.push('normal', t1)
+    assert cl.ttl('payload:' + t1['args_ref']) > 0
+
+    cl.delete('payload:' + t2['args_ref'])
+    manager.process(t2)
+    assert r2.ready().error == 'PayloadError'
+    assert manager.pop(['dead'], 1)['args_ref'] == t2['args_ref']
+
+
+def test_unique_task(manager):
+    @manager.task(queue='normal', unique=True)
+    def reindex(user_id):
+        reindex.called.append(user_id)
+    reindex.called = []
+
+    r1 = reindex.push(1)
+    assert reindex.push(1).id == r1.id
+    assert reindex.push(2).id != r1.id
+    assert manager.queue.stat()['normal'] == 2
+
+    manager.process(manager.pop(['normal'], 1))
+    assert reindex.called == [1]
+    assert reindex.push(1).id != r1.id
+
+    by_key = reindex.modify(unique=lambda user_id: user_id % 10)
+    manager.process(manager.pop(['normal'], 1))
+    assert by_key.push(13).id == by_key.push(3).id
+    manager.process(manager.pop(['normal'], 1))
+    manager.process(manager.pop(['normal'], 1))
+    assert reindex.called == [1, 2, 1, 13]
+
+    result = by_key.modify(ttl=10).push(23)
+    t = manager.pop(['normal'], 1)
+    manager.process(t, now=t['expire'] + 1)
+    assert by_key.push(23).id != result.id
+
+    assert unique_key('boo', None, {'a': 1, 'b': 2}) == unique_key('boo', None, {'b': 2, 'a': 1})
+    assert unique_key('boo', [1], {'a': 1}) != unique_key('boo', [1], {'a': 2})
+
+
+def test_debounced_task(manager):
+    @manager.task(queue='normal', debounce=10, unique=lambda user_id, value: user_id)
+    def reindex(user_id, value):
+        pass
+
+    now = time.time()
+    r1 = reindex.push(1, 'old')
+    r2 = reindex.push(1, 'new')
+    assert r1.id != r2.id
+    (ts, _, t), = manager.queue.get_schedule()
+    assert t['args'] == [1, 'new']
+    assert now + 9 < ts < now + 11
+    value, = [manager.queue.client.get(k) for k in manager.queue.client.keys('unique:*')]
+    assert value.startswith(r2.id.encode() + b':normal:')
+
+    reindex.push_many([((2, 'old'), None), ((2, 'new'), None)])
+    assert len(manager.queue.get_schedule()) == 2
+
+    manager.queue.reschedule(now=ts + 1)
+    manager.process(manager.pop(['normal'], 1))
+    manager.process(manager.pop(['normal'], 1))
+    assert not manager.queue.client.keys('unique:*')
+
+
+def test_rate_limit(manager):
+    called = []
+
+    @manager.task(queue='normal', rate_limit='2/m')
+    def call(value):
+        called.append(value)
+
+    call.push_many([((r,), None) for r in range(3)])
+    for _ in range(3):
+        manager.process(manager.pop(['normal'], 1), now=100)
+    assert called == [0, 1]
+
+    (ts, _, task), = manager.queue.get_schedule()
+    assert ts == 130 and task['rate_deferred']
+    manager.queue.reschedule(now=130)
+    manager.process(manager.pop(['normal'], 1), now=130)
+    assert called == [0, 1, 2]
+
+    manager.register('call', call, rate_limit=None)
+    assert not manager.rate_limits
+
+
+def test_concurrency_limit(manager):
+    manager.slot_lease = 0.3
+    called = []
+
+    @manager.task(queue='normal', concurrency=1)
+    def report(value):
+        if value == 1:
+            report.push(2)
+            manager.process(manager.pop(['normal'], 1))
+            time.sleep(0.25)
+        called.append(value)
+
+    report.push(1)
+    manager.process(manager.pop(['normal'], 1))
+    assert called == [1]
+    manager.process(manager.pop(['normal'], 1))
+    assert called == [1, 2]
+
+    manager.queue.acquire_slot('report', 1, 'dead', 'normal', {}, lease=0.1)
+    report.push(3)
+    manager.process(manager.pop(['normal'], 1))
+    assert called == [1, 2]
+    time.sleep(0.15)
+    assert manager.wake_parked() == 1
+    manager.process(manager.pop(['normal'], 1))
+    assert called == [1, 2, 3]
+
+    manager.register('report', report, concurrency=None)
+    assert not manager.concurrency_limits
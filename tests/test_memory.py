@@ -0,0 +1,209 @@
+import time
+import threading
+import pytest
+import redis
+
+from dsq.memory import MemoryQueueStore, MemoryResultStore
+from dsq.store import QueueStore, PayloadError
+from dsq.manager import Manager
+from dsq.worker import Worker
+
+
+@pytest.fixture
+def store(request):
+    return MemoryQueueStore()
+
+
+def test_push_pop(store):
+    assert store.pop(['test'], 0.01) == (None, None)
+    task = {'id': 't0', 'args': [[1]]}
+    store.push('copy', task)
+    task['args'][0].append(2)
+    assert store.pop(['copy'], 1) == ('copy', {'id': 't0', 'args': [[1]]})
+    store.push('test', 't1')
+    store.push_many([('high', 't2', None), ('test', 't3', None)])
+    assert store.pop(['high', 'test'], 1) == ('high', 't2')
+    assert store.pop(['high', 'test'], 1) == ('test', 't1')
+    assert store.stat() == {'test': 1, 'schedule': 0}
+
+    threading.Timer(0.1, store.push, ('high', 't4')).start()
+    assert store.pop(['high'], 5) == ('high', 't4')
+
+    store.push_many([('test', 't5', None), ('test', 't6', None)])
+    assert store.pop_many('test', 2) == ['t3', 't5']
+    assert store.pop_many('test', 2) == ['t6']
+
+
+def test_reschedule(store):
+    store.push('test', 't1', eta=500)
+    store.push('test', {'expire': 505}, eta=501)
+    store.push('test', 't3', eta=502)
+    store.push('test', 't4', eta=600)
+    assert store.reschedule(now=490) == (0, 0, 4)
+    assert store.reschedule(now=510, limit=2) == (1, 1, 2)
+    assert store.reschedule(now=510) == (1, 0, 1)
+    assert store.get_queue('test') == ['t1', 't3']
+    assert store.get_schedule() == [(600, 'test', 't4')]
+
+
+def test_wakeup(store):
+    assert store.next_eta() is None
+    assert store.wait_wakeup(0.01) is None
+    store.push_unique('test', {'id': 'a', 'unique': 'key'}, eta=20)
+    store.push_unique('test', {'id': 'b', 'unique': 'key'}, eta=30, replace=True)
+    assert store.next_eta() == 30
+
+    threading.Timer(0.1, store.push, ('test', 't1', 10)).start()
+    assert store.wait_wakeup(5) == 10
+    threading.Timer(0.1, store.push, ('test', 't2', 40)).start()
+    assert store.wait_wakeup(5) is None
+
+    assert store.crontab_mark() is None
+    store.set_crontab_mark(60)
+    assert store.crontab_mark() == 60
+
+
+def test_push_unique(store):
+    task = {'id': 'a', 'unique': 'key'}
+    assert store.push_unique('test', task) == 'a'
+    assert store.push_unique('test', {'id': 'b', 'unique': 'key'}) == 'a'
+    store.release_unique({'id': 'b', 'unique': 'key'})
+    assert store.push_unique('test', {'id': 'b', 'unique': 'key'}) == 'a'
+    store.release_unique(task)
+    assert store.push_unique('test', {'id': 'b', 'unique': 'key'}, eta=10) == 'b'
+    assert store.push_unique('test', {'id': 'c', 'unique': 'key'}, eta=20, replace=True) == 'c'
+    assert store.stat() == {'test': 1, 'schedule': 1}
+    assert store.reschedule(now=30) == (1, 0, 0)
+    assert [r['id'] for r in store.get_queue('test')] == ['a', 'c']
+
+    # replaced task is already moved from schedule
+    store.push_unique('test', {'id': 'd', 'unique': 'key2'}, eta=10)
+    assert store.reschedule(now=30) == (1, 0, 0)
+    store.push_unique('test', {'id': 'e', 'unique': 'key2'}, eta=20, replace=True)
+    assert store.stat() == {'test': 3, 'schedule': 1}
+    assert store.take_many(10)['schedule'] and store.stat()['schedule'] == 0
+    store.push_unique('test', {'id': 'f', 'unique': 'key2'}, eta=20, replace=True)
+    assert store.stat()['schedule'] == 1
+
+    with pytest.raises(PayloadError):
+        store.load_args({'args_ref': 'ref'})
+    assert store.load_args({'args': [1]}) == ([1], {})
+
+
+def test_take_token(store):
+    assert [store.take_token('foo', 2, 1, now=100) for _ in range(4)] == [0, 0, 0.5, 1]
+    assert store.take_token('foo', 2, 1, now=102) == 0
+
+
+def test_take_tokens(store):
+    assert store.take_tokens('foo', 3, 1, 2, now=100) == 2
+    assert store.take_tokens('foo', 3, 1, 5, now=100) == 1
+    assert store.take_tokens('foo', 3, 1, -2, now=100) == -2
+    assert store.take_token('foo', 3, 1, now=100) == 0
+    assert store.take_tokens('foo', 3, 1, 5, now=100) == 1
+    assert store.take_token('foo', 3, 1, now=100) == pytest.approx(1 / 3.0)
+    assert store.take_tokens('foo', 3, 1, 5, now=100) == 0
+
+
+def test_slots(store):
+    assert store.acquire_slot('foo', 1, 't1', 'test', 't1')
+    assert not store.acquire_slot('foo', 1, 't2', 'test', 't2')
+    assert not store.acquire_slot('foo', 1, 't3', 'test', 't3')
+    store.renew_slot('foo', 't1', 100)
+    store.renew_slot('foo', 't2', 100)
+    assert list(store.slots['foo']) == ['t1']
+
+    assert store.release_slot('foo', 1, 't1') == 1
+    assert store.get_queue('test') == ['t2']
+    assert store.acquire_slot('foo', 1, 't2', 'test', 't2', lease=10)
+    assert store.release_slot('foo', 1, now=time.time() + 20) == 1
+    assert store.get_queue('test') == ['t2', 't3']
+
+    assert store.acquire_slots('foo', 3, ['t4', 't5']) == 2
+    assert store.acquire_slots('foo', 3, ['t6', 't7']) == 1
+    store.renew_slot('foo', ['t4', 't8'], 100)
+    assert store.slots['foo']['t4'] > time.time() + 90
+    assert store.release_slot('foo', 3, ['t4', 't5']) == 0
+    assert list(store.slots['foo']) == ['t6']
+
+
+def test_prefetch_and_ack(store):
+    store.push_many([('high', 't1', None), ('normal', 't2', None),
+                     ('normal', 't3', None)])
+    assert store.prefetch(['high', 'normal'], 'w1', 2) == [('high', 't1'), ('normal', 't2')]
+    store.ack('w1', 1)
+    assert store.requeue_inflight() == 0
+    assert store.requeue_inflight('w1') == 1
+    assert store.get_queue('normal') == ['t2', 't3']
+
+    store.prefetch(['normal'], 'w2', 1, heartbeat=-1)
+    assert store.requeue_inflight() == 1
+    assert store.prefetch(['high'], 'w2', 1) == []
+
+    store.prefetch(['normal'], 'w3', 2)
+    assert store.requeue_inflight('w3', keep=1) == 1
+    assert store.get_queue('normal') == ['t3']
+    assert store.requeue_inflight() == 0
+    assert store.requeue_inflight('w3') == 1
+    assert store.get_queue('normal') == ['t2', 't3']
+
+
+def test_take_and_put(store):
+    cl = redis.StrictRedis()
+    cl.flushdb()
+    rstore = QueueStore(cl)
+    rstore.push('test', {'id': 't1'})
+    rstore.push('test', {'id': 't2'}, eta=10)
+
+    store.put_many(rstore.take_many(10))
+    assert store.queue_list() == ['test']
+    assert store.get_queue('test') == [{'id': 't1'}]
+    assert store.get_schedule() == [(10, 'test', {'id': 't2'})]
+
+    store.push_unique('boo', {'id': 't3', 'unique': 'key'}, eta=5)
+    store.push_unique('boo', {'id': 't4', 'unique': 'key'}, eta=5, replace=True)
+    rstore.put_many(store.take_many(10))
+    assert store.stat() == {'schedule': 0}
+    assert rstore.get_queue('test') == [{'id': 't1'}]
+    assert [r[2]['id'] for r in rstore.get_schedule()] == ['t4', 't2']
+
+    store.prune_queues(['test', 'boo'])
+    assert store.sync_queues() == []
+
+
+def test_put_offloaded(store):
+    cl = redis.StrictRedis()
+    cl.flushdb()
+    rstore = QueueStore(cl, offload_threshold=10)
+    rstore.push('big', {'id': 't1', 'args': ['x' * 10]})
+    rstore.push('big', {'id': 't2', 'kwargs': {'a': 'x' * 10}})
+    store.put_many(rstore.take_many(10))
+    assert store.get_queue('big') == [{'id': 't1', 'args': ['x' * 10]},
+                                      {'id': 't2', 'kwargs': {'a': 'x' * 10}}]
+
+
+def test_result_store():
+    store = MemoryResultStore()
+    store.set('id1', 10, 20)
+    store.set('id2', 20, -1)
+    assert store.get('id1') == 10
+    assert store.get_many(['id1', 'id2', 'id3']) == [10, None, None]
+    assert store.wait('id3', 0.1) is None
+
+    threading.Timer(0.1, store.set, ('id3', 30, 20)).start()
+    start = time.time()
+    assert store.wait('id3', 5) == 30
+    assert time.time() - start < 1
+    assert 'id2' not in store.results
+
+
+def test_manager():
+    manager = Manager(MemoryQueueStore(), MemoryResultStore())
+
+    @manager.task(queue='normal', keep_result=10)
+    def add(a, b):
+        return a + b
+
+    results = add.push_many([((1, 2), None), ((3, 4), None)])
+    assert Worker(manager, prefetch=10).process_prefetched(['normal'])
+    assert [r.value for r in manager.gather(results)] == [3, 7]
@@ -1,9 +1,13 @@
 import time
+import threading
 import pytest
 import redis
 import msgpack
 
-from dsq.store import QueueStore
+from dsq.store import QueueStore, ClusterQueueStore
+from dsq.codec import MsgpackCodec, CompactCodec
+from dsq.manager import Manager
+from dsq.worker import Worker
 
 
 @pytest.fixture
@@ -13,6 +17,13 @@ def store(request):
     return QueueStore(cl)
 
 
+@pytest.fixture
+def cstore(request):
+    cl = redis.StrictRedis()
+    cl.flushdb()
+    return ClusterQueueStore(cl)
+
+
 def test_push_pop(store):
     assert store.pop(['test'], 1) == (None, None)
     store.push('test', 't1')
@@ -20,6 +31,84 @@ def test_push_pop(store):
     assert result == ('test', 't1')
 
 
+def test_pop_many(store):
+    store.push_many([('test', 't1', None), ('test', 't2', None), ('test', 't3', None)])
+    assert store.pop_many('test', 2) == ['t1', 't2']
+    assert store.pop_many('test', 2) == ['t3']
+    assert store.pop_many('test', 2) == []
+
+
+def test_take_token(store):
+    assert [store.take_token('foo', 2, 1, now=100) for _ in range(4)] == [0, 0, 0.5, 1]
+    assert store.take_token('foo', 2, 1, now=102) == 0
+    assert store.take_token('foo', 2, 1, now=200) == 0
+    assert 0 < store.client.pttl('rate:foo') <= 2000
+
+
+def test_take_tokens(store):
+    assert store.take_tokens('foo', 3, 1, 2, now=100) == 2
+    assert store.take_tokens('foo', 3, 1, 5, now=100) == 1
+    assert store.take_tokens('foo', 3, 1, 5, now=100) == 0
+    assert store.take_tokens('foo', 3, 1, -2, now=100) == -2
+    assert store.take_token('foo', 3, 1, now=100) == 0
+    assert store.take_token('foo', 3, 1, now=100) == 0
+    assert store.take_token('foo', 3, 1, now=100) == pytest.approx(1 / 3.0)
+    assert store.take_tokens('foo', 3, 1, 5, now=100) == 0
+
+
+def test_slots(store):
+    assert store.acquire_slot('foo', 1, 't1', 'test', {'id': 't1'})
+    assert not store.acquire_slot('foo', 1, 't2', 'test', {'id': 't2'})
+    assert not store.acquire_slot('foo', 1, 't3', 'test', {'id': 't3'}, now=time.time() + 30)
+    assert store.release_slot('foo', 1) == 0
+
+    store.renew_slot('foo', 't1', 100)
+    store.renew_slot('foo', 't2', 100)
+    assert store.client.zrange('slots:{foo}', 0, -1) == [b't1']
+
+    assert store.release_slot('foo', 1, 't1') == 1
+    assert store.get_queue('test') == [{'id': 't2'}]
+    assert store.acquire_slot('foo', 1, 't2', 'test', {'id': 't2'}, lease=10)
+    assert store.release_slot('foo', 1, now=time.time() + 20) == 1
+    assert store.get_queue('test') == [{'id': 't2'}, {'id': 't3'}]
+
+    assert store.acquire_slots('foo', 3, ['t4', 't5']) == 2
+    assert store.acquire_slots('foo', 3, ['t6', 't7']) == 1
+    assert store.acquire_slots('foo', 3, ['t8']) == 0
+    store.renew_slot('foo', ['t4', 't5', 't8'], 100)
+    assert store.client.zscore('slots:{foo}', 't4') > time.time() + 90
+    assert store.release_slot('foo', 3, ['t4', 't5']) == 0
+    assert store.client.zrange('slots:{foo}', 0, -1) == [b't6']
+
+
+def test_wakeup(store):
+    assert store.next_eta() is None
+    assert store.wait_wakeup(0.01) is None
+
+    store.push('test', 't1', eta=500)
+    store.push('test', 't2', eta=600)
+    assert store.next_eta() == 500
+    assert store.wait_wakeup(1) == 500
+    assert store.wait_wakeup(0.01) is None
+
+    store.push_many([('test', 't3', 400), ('test', 't4', 300)])
+    store.push_unique('test', {'id': 't5', 'unique': 'key'}, eta=200)
+    store.put_many({'schedule': [(b'test:t6', 100)], 'queues': {}})
+    assert store.wait_wakeup(1) == 100
+    assert store.client.zcard('wakeup:schedule') == 0
+
+    threading.Timer(0.1, store.push, ('test', 't7', 50)).start()
+    start = time.time()
+    assert store.wait_wakeup(5) == 50
+    assert time.time() - start < 1
+
+
+def test_crontab_mark(store):
+    assert store.crontab_mark() is None
+    store.set_crontab_mark(60.5)
+    assert store.crontab_mark() == 60.5
+
+
 def test_reschedule(store):
     store.push('test', 't1', eta=500)
     store.reschedule(now=490)
@@ -28,6 +117,36 @@ def test_reschedule(store):
     assert store.pop(['test'], 1)[1] == 't1'
 
 
+def test_reschedule_expired(store):
+    if not store.client.eval('return cmsgpack and 1 or 0', 0):
+        pytest.skip('redis server without cmsgpack')
+
+    args = [b'bin' * 100, 'str' * 20, 1.5, None, {'nested': [1, {'deep': 'x'}]}]
+    for codec in (MsgpackCodec(), CompactCodec(), CompactCodec(pack_args=True)):
+        s = QueueStore(store.client, codec)
+        s.push('test', {'id': b'1', 'name': 'a', 'args': args, 'expire': 505.5}, eta=500)
+        s.push('test', {'id': b'2', 'name': 'b', 'args': args, 'expire': 600}, eta=501)
+        s.push('test', {'id': b'3', 'name': 'c', 'kwargs': {'a': 1}, 'meta': {'m': 2},
+                        'expire': 505}, eta=502)
+        s.push('test', {'id': b'4', 'name': 'd', 'expire': 1e10}, eta=503)
+        s.push('test', {'id': b'5', 'name': 'e'}, eta=504)
+        assert s.reschedule(now=510) == (3, 0, 0)
+        assert [r['id'] for r in s.pop_many('test', 10)] == [b'2', b'4', b'5']
+
+
+def test_reschedule_limit(store):
+    store.push('boo', 't1', eta=10)
+    store.push('foo', 't2', eta=20)
+    store.push('boo', 't3', eta=30)
+    store.push('boo', 't4', eta=100)
+    assert store.reschedule(now=50, limit=2) == (2, 1, 2)
+    assert store.get_queue('boo') == ['t1']
+    assert store.get_queue('foo') == ['t2']
+    assert store.reschedule(now=50, limit=2) == (1, 0, 1)
+    assert store.get_queue('boo') == ['t1', 't3']
+    assert store.reschedule(now=50, limit=2) == (0, 0, 1)
+
+
 def test_stat(store):
     store.push('boo', 't1', eta=500)
     store.push('boo', 't2')
@@ -71,3 +190,164 @@ def test_take_and_put(store):
     assert store.get_schedule() == [(20, 'foo', 'foo3')]
     assert store.get_queue('boo') == ['boo3']
     assert store.get_queue('foo') == []
+
+
+def test_take_and_put_payloads(store):
+    store.offload_threshold = 100
+    store.push('boo', {'id': b't1', 'args': ['x' * 200]})
+    store.push('boo', {'id': b't2', 'args': ['y' * 200]}, eta=time.time() + 100)
+    store.push('boo', {'id': b't3', 'args': ['z' * 200]})
+    store.push('boo', 't4')
+    store.client.delete('payload:' + store.get_queue('boo')[1]['args_ref'])
+
+    dcl = redis.StrictRedis(db=1)
+    dcl.flushdb()
+    dest = QueueStore(dcl)
+    batch = store.take_many(10)
+    assert len(batch['payloads']) == 2
+    dest.put_many(batch)
+
+    (_, _, t2), = dest.get_schedule()
+    assert dest.load_args(t2) == (['y' * 200], {})
+    assert 7 * 86400 < dcl.ttl('payload:' + t2['args_ref']) <= 7 * 86400 + 100
+    t1, t3 = dest.get_queue('boo')[:2]
+    assert dest.load_args(t1) == (['x' * 200], {})
+    assert t3['args_ref'] and not dcl.exists('payload:' + t3['args_ref'])
+    assert store.take_many(10)['payloads'] == {}
+
+    # undecodable items don't break the batch and are forwarded as is
+    store.push('boo', {'id': b't5', 'args': ['u' * 200]})
+    store.client.rpush('queue:boo', b'\xc1x-unknown-compressor')
+    batch = store.take_many(10)
+    assert len(batch['payloads']) == 1
+    assert batch['queues']['boo'][1] == b'\xc1x-unknown-compressor'
+
+
+def test_push_many(store):
+    store.push_many([('boo', 't1', None), ('foo', 't2', None),
+                     ('boo', 't3', None), ('boo', 't4', 10)])
+    assert store.get_queue('boo') == ['t1', 't3']
+    assert store.get_queue('foo') == ['t2']
+    assert store.get_schedule() == [(10, 'boo', 't4')]
+
+
+def test_prefetch_and_ack(store):
+    store.push('boo', 'boo1')
+    store.push('foo', 'foo1')
+    store.push('foo', 'foo2')
+    store.push('foo', 'foo3')
+
+    assert store.prefetch(['boo', 'foo'], 'w1', 3) == [
+        ('boo', 'boo1'), ('foo', 'foo1'), ('foo', 'foo2')]
+    assert store.prefetch(['boo', 'foo'], 'w2', 3) == [('foo', 'foo3')]
+    assert store.prefetch(['boo', 'foo'], 'w2', 3) == []
+    assert store.stat() == {'schedule': 0}
+
+    store.ack('w1', 1)
+    assert store.requeue_inflight() == 0
+
+    store.client.delete('worker:w1')
+    assert store.requeue_inflight() == 2
+    assert store.get_queue('foo') == ['foo1', 'foo2']
+
+    assert store.requeue_inflight('w2') == 1
+    assert store.get_queue('foo') == ['foo3', 'foo1', 'foo2']
+    assert not store.client.smembers('inflight')
+
+    store.prefetch(['foo'], 'w3', 3)
+    assert store.requeue_inflight('w3', keep=1) == 2
+    assert store.get_queue('foo') == ['foo1', 'foo2']
+    assert store.requeue_inflight() == 0
+    assert store.requeue_inflight('w3') == 1
+    assert store.get_queue('foo') == ['foo3', 'foo1', 'foo2']
+
+
+def test_queue_registry(store):
+    store.push('boo', 'boo1')
+    store.push('foo', 'foo1', eta=10)
+    store.push_many([('bar', 'bar1', None)])
+    assert set(store.queue_list()) == set(('boo', 'bar'))
+
+    store.reschedule(now=20)
+    assert set(store.queue_list()) == set(('boo', 'bar', 'foo'))
+
+    store.pop(['boo'], 1)
+    assert store.stat() == {'schedule': 0, 'bar': 1, 'foo': 1}
+    assert set(store.queue_list()) == set(('bar', 'foo'))
+
+    store.client.delete('queues')
+    assert set(store.sync_queues()) == set(('bar', 'foo'))
+    assert set(store.queue_list()) == set(('bar', 'foo'))
+
+
+def test_cluster_keys(cstore):
+    cstore.push('boo', 't1')
+    cstore.push('boo', 't2', eta=10)
+    assert cstore.client.lrange('queue:{boo}', 0, -1) == [msgpack.dumps('t1')]
+    assert cstore.client.zcard('schedule:{boo}') == 1
+
+    with pytest.raises(ValueError):
+        Worker(Manager(cstore), prefetch=10)
+
+
+def test_cluster_pop_priority(cstore):
+    assert cstore.pop(['high', 'low'], 0.2) == (None, None)
+    cstore.push_many([('low', 'l1', None), ('high', 'h1', None)])
+    assert cstore.pop(['high', 'low'], 1) == ('high', 'h1')
+    assert cstore.pop(['high', 'low'], 1) == ('low', 'l1')
+
+    cstore.client.rpush('queue:{high}', msgpack.dumps('h2'))
+    assert cstore.pop(['high', 'low']) == ('high', 'h2')
+
+    cstore.poll_interval = 1
+    threading.Timer(0.2, cstore.push, ('high', 'h3')).start()
+    assert cstore.pop(['high', 'low']) == ('high', 'h3')
+
+
+def test_cluster_reschedule_and_stat(cstore):
+    cstore.push_many([('boo', 'b1', 10), ('foo', 'f1', 20),
+                      ('foo', 'f2', 100), ('bar', 'r1', None)])
+    assert cstore.stat() == {'schedule': 3, 'bar': 1}
+    assert cstore.get_schedule(1, 2) == [(20, 'foo', 'f1'), (100, 'foo', 'f2')]
+
+    assert cstore.reschedule(now=50) == (2, 0, 1)
+    assert cstore.pop(['boo'], 1) == ('boo', 'b1')
+    assert cstore.pop(['foo'], 1) == ('foo', 'f1')
+    assert cstore.stat() == {'schedule': 1, 'bar': 1}
+    assert set(cstore.queue_list()) == set(('boo', 'foo', 'bar'))
+    assert cstore.next_eta() == 100
+
+
+def test_cluster_take_and_put(cstore, store):
+    cstore.push_many([('boo', 'b1', None), ('boo', 'b2', None),
+                      ('boo', 'b3', 10), ('foo', 'f1', 20)])
+    result = cstore.take_many(1)
+    assert task_names(result['queues']['boo']) == [b'b1']
+    assert sorted(stask_names(result['schedule'])) == [b'b3', b'f1']
+    assert cstore.stat() == {'schedule': 0, 'boo': 1}
+
+    store.put_many(result)
+    assert store.get_schedule() == [(10, 'boo', 'b3'), (20, 'foo', 'f1')]
+
+    cstore.put_many(store.take_many(10))
+    assert cstore.get_schedule() == [(10, 'boo', 'b3'), (20, 'foo', 'f1')]
+    assert cstore.get_queue('boo') == ['b2', 'b1']
+
+    cstore.client.delete('queues')
+    assert set(cstore.sync_queues()) == set(('boo',))
+
+
+def test_cluster_push_unique(cstore):
+    cstore.offload_threshold = 10
+    task = {'id': b'id1', 'name': 'boo', 'unique': 'boo:1', 'args': ['x' * 10]}
+    assert cstore.push_unique('boo', task) == b'id1'
+    assert cstore.push_unique('boo', dict(task, id=b'id2')) == b'id1'
+    assert cstore.client.get('unique:{boo}:boo:1') == b'id1:'
+    assert cstore.queue_list() == ['boo']
+
+    queue, t = cstore.pop(['boo'], 1)
+    assert cstore.load_args(t) == (['x' * 10], {})
+    cstore.release_unique(dict(t, id=b'id2'))
+    assert cstore.client.exists('unique:{boo}:boo:1')
+    cstore.release_unique(dict(t, queue=queue))
+    assert not cstore.client.exists('unique:{boo}:boo:1')
@@ -1,4 +1,5 @@
 import time
+import threading
 import pytest
 import redis
 
@@ -20,3 +21,27 @@ def test_set(store):
 
 def test_empty_get(store):
     assert store.get('not-exists') == None
+
+
+def test_wait(store):
+    assert store.wait('id', 0.1) is None
+
+    threading.Timer(0.1, store.set, ('id', 10, 600)).start()
+    start = time.time()
+    assert store.wait('id', 5) == 10
+    assert time.time() - start < 1
+    assert 590 < store.client.ttl('notify:{id}') <= 600
+
+    assert store.wait('id', 5) == 10
+
+    # result is gone, notification is not returned
+    store.client.delete('id')
+    assert store.wait('id', 5) is None
+    assert not store.client.exists('notify:{id}')
+
+
+def test_get_many(store):
+    assert store.get_many([]) == []
+    store.set('id1', 10, 20)
+    store.set('id3', 30, 20)
+    assert store.get_many(['id1', 'id2', 'id3']) == [10, None, 30]
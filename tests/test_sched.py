@@ -1,8 +1,21 @@
+import pytest
+import threading
+from calendar import timegm
 from itertools import islice
-from dsq.sched import Timer, Crontab
+from dsq.sched import Timer, Crontab, Scheduler, parse_cron
+from dsq.manager import Manager
+from dsq.memory import MemoryQueueStore, MemoryResultStore
 
 from datetime import datetime
-from time import mktime
+from time import mktime, time, tzset
+
+
+def ts(*args):
+    return mktime(datetime(*args).timetuple())
+
+
+def make_manager():
+    return Manager(MemoryQueueStore(), MemoryResultStore())
 
 
 def test_interval_timer():
@@ -32,3 +45,161 @@ def test_crontab():
 
     ts = mktime(datetime(2016, 1, 17, 5, 1).timetuple())
     assert c.actions_ts(ts) == {'boo', 'bar'}
+
+    c.add('either', 0, 0, [1, 15], -1, 1)
+    assert c.actions(0, 0, 15, 1, 3) == {'boo', 'foo', 'either'}
+    assert c.actions(0, 0, 2, 1, 1) == {'boo', 'foo', 'either'}
+    assert c.actions(0, 0, 2, 1, 2) == {'boo', 'foo'}
+
+
+def test_parse_cron():
+    assert parse_cron('*/20 9-11,13 * jan-feb,dec mon-fri') == (
+        [0, 20, 40], [9, 10, 11, 13], list(range(1, 32)), [1, 2, 12], [1, 2, 3, 4, 5])
+    assert parse_cron('5/20 * * * sun')[0::4] == ([5, 25, 45], [0])
+
+    for expr in ('* * * *', '60 * * * *', '* * 0 * *', '* 5-3 * * *', '* * * foo *'):
+        with pytest.raises(ValueError):
+            parse_cron(expr)
+
+
+def test_crontab_next_after():
+    c = Crontab()
+    assert c.next_after(0) == (None, set())
+
+    c.add('boo', '*/15 9-18 * * mon-fri')
+    c.add('foo', 0, 9, -1, -1, 1)
+    c.add('bar', '0 0 29 feb *')
+    c.add('never', '0 0 31 feb *')
+
+    # 2016-01-17 is sunday
+    assert c.next_after(ts(2016, 1, 17, 5, 1)) == (ts(2016, 1, 18, 9, 0), {'boo', 'foo'})
+    assert c.next_after(ts(2016, 1, 18, 9, 0)) == (ts(2016, 1, 18, 9, 15), {'boo'})
+    assert c.next_after(ts(2016, 1, 18, 9, 14, 59)) == (ts(2016, 1, 18, 9, 15), {'boo'})
+    assert c.next_after(ts(2016, 1, 22, 18, 45)) == (ts(2016, 1, 25, 9, 0), {'boo', 'foo'})
+    assert c.next_after(ts(2016, 2, 26, 18, 45)) == (ts(2016, 2, 29, 0, 0), {'bar'})
+    assert c.actions_ts(ts(2016, 2, 29, 9, 30)) == {'boo'}
+
+    # day and week day are combined with OR when both are restricted
+    c = Crontab()
+    c.add('first-or-monday', '0 0 1 * mon')
+    assert c.next_after(ts(2016, 1, 17)) == (ts(2016, 1, 18), {'first-or-monday'})
+    assert c.next_after(ts(2016, 1, 25)) == (ts(2016, 2, 1), {'first-or-monday'})
+    assert c.next_after(ts(2016, 2, 1)) == (ts(2016, 2, 8), {'first-or-monday'})
+
+
+def test_scheduler_reschedule_and_wakeup():
+    manager = make_manager()
+    now = time()
+    manager.queue.push('normal', 't1', now - 2)
+    manager.queue.push('normal', 't2', now - 1)
+    manager.queue.push('normal', 't3', now + 100)
+
+    sched = Scheduler(manager, limit=1, now=now)
+    sched.step(now)
+    assert manager.queue.get_queue('normal') == ['t1', 't2']
+    assert sched.eta == now + 100
+
+    # push of an earlier task wakes up waiting scheduler
+    threading.Timer(0.05, manager.queue.push, ('normal', 't4', now + 1)).start()
+    sched.step()
+    assert sched.eta == now + 1
+
+    sched.step(now + 1)
+    assert manager.queue.get_queue('normal') == ['t1', 't2', 't4']
+    assert sched.eta == now + 100
+
+
+def test_scheduler_periodic():
+    manager = make_manager()
+    run = [1]
+
+    @manager.periodic(10)
+    def tick():
+        run.pop()
+
+    manager.register('limited', tick, concurrency=1)
+    Scheduler(manager).run(run)
+    assert not run
+
+
+def test_scheduler_crontab():
+    manager = make_manager()
+    called = []
+    manager.crontab('*/5 * * * *')(lambda: called.append(1))
+
+    sched = Scheduler(manager, now=ts(2016, 1, 18, 9, 1))
+    assert sched.next_cron == ts(2016, 1, 18, 9, 5)
+    sched.step(ts(2016, 1, 18, 9, 5, 30))
+    sched.step(ts(2016, 1, 18, 9, 5, 30))
+    assert called == [1]
+    assert manager.queue.crontab_mark() == ts(2016, 1, 18, 9, 5)
+    assert sched.next_cron == ts(2016, 1, 18, 9, 10)
+
+    # stale events are skipped at once
+    sched.step(ts(2016, 1, 18, 9, 30))
+    assert called == [1]
+    assert manager.queue.crontab_mark() == ts(2016, 1, 18, 9, 29)
+    sched.step(ts(2016, 1, 18, 9, 30))
+    assert called == [1, 1]
+
+    manager.queue.set_crontab_mark(ts(2016, 1, 18, 9, 40))
+    sched = Scheduler(manager, catch_up=600, now=ts(2016, 1, 18, 9, 52))
+    assert sched.next_cron == ts(2016, 1, 18, 9, 45)
+    sched.step(ts(2016, 1, 18, 9, 52))
+    sched.step(ts(2016, 1, 18, 9, 52))
+    assert called == [1, 1, 1]
+
+
+def test_scheduler_burst():
+    manager = make_manager()
+    manager.queue.push('normal', 't1', time() + 0.5)
+    Scheduler(manager).burst(True)
+    assert manager.queue.get_queue('normal') == ['t1']
+
+
+@pytest.fixture
+def new_york(monkeypatch):
+    monkeypatch.setenv('TZ', 'America/New_York')
+    tzset()
+    yield
+    monkeypatch.undo()
+    tzset()
+
+
+def test_crontab_dst(new_york):
+    c = Crontab()
+    c.add('every5', '*/5 * * * *')
+    c.add('at3', '0 3 * * *')
+    c.add('at230', '30 2 * * *')
+
+    # 2023-11-05 01:00-02:00 repeats, 05:00 UTC is 01:00 EDT, 06:00 UTC is 01:00 EST
+    utc = lambda *args: timegm((2023, 11, 5) + args + (0,))
+    assert c.next_after(utc(6, 30)) == (utc(6, 35), {'every5'})
+    assert c.next_after(utc(5, 55)) == (utc(6, 0), {'every5'})
+    assert c.next_after(utc(7, 55)) == (utc(8, 0), {'every5', 'at3'})
+
+    # 2023-03-12 02:00-03:00 is skipped, 07:00 UTC is 03:00 EDT
+    utc = lambda *args: timegm((2023, 3, 12) + args + (0,))
+    assert c.next_after(utc(6, 55)) == (utc(7, 0), {'every5', 'at3'})
+    c = Crontab()
+    c.add('at230', '30 2 * * *')
+    assert c.next_after(utc(6, 0)) == (utc(6, 30) + 86400, {'at230'})
+
+
+def test_scheduler_dst(new_york):
+    manager = make_manager()
+    called = []
+    manager.crontab('*/5 * * * *')(lambda: called.append(1))
+
+    # start inside repeated hour, 01:30 EST
+    now = timegm((2023, 11, 5, 6, 30, 0))
+    sched = Scheduler(manager, now=now)
+    assert sched.next_cron == now + 300
+    sched.step(now + 300)
+    sched.step(now + 300)
+    assert called == [1]
+    assert sched.next_cron == now + 600
+
+    sched.crontab.next_after = lambda ts: (ts - 3600, {called.append})
+    sched.step(now + 600)
+    assert sched.next_cron == now + 660 and not sched.cron_actions
@@ -1,5 +1,5 @@
 import sys
-from dsq.utils import load_var, LoadError, task_fmt
+from dsq.utils import load_var, LoadError, task_fmt, parse_rate
 
 
 def test_load_var():
@@ -26,3 +26,11 @@ def test_task_fmt():
     result = task_fmt({'name': 'boo', 'id': 'foo', 'args': (1, [2]),
                        'kwargs': {'bar': {'baz': "10"}}})
     assert result == "boo(1, [2], bar={'baz': '10'})#foo"
+    assert task_fmt({'name': 'boo', 'id': 'foo', 'args_blob': b''}) == 'boo(...)#foo'
+
+
+def test_parse_rate():
+    assert parse_rate('100/s') == (100, 1)
+    assert parse_rate('10/m') == (10, 60)
+    assert parse_rate('5') == (5, 1)
+    assert parse_rate(0.5) == (0.5, 1)
@@ -0,0 +1,72 @@
+import os
+import time
+import threading
+
+from dsq.worker import Prefork, QueueOrder
+from dsq.memory import MemoryQueueStore
+
+
+def test_prefork(tmpdir):
+    log = tmpdir.join('log')
+
+    def target():
+        log.write('{}\n'.format(os.getpid()), mode='a')
+
+    Prefork(target, 2, respawn=False).run()
+    pids = log.read().split()
+    assert len(set(pids)) == 2
+    assert str(os.getpid()) not in pids
+
+    def fail():
+        target()
+        raise Exception('boo')
+
+    log.remove()
+    prefork = Prefork(fail, 2)
+    prefork.restart_delay = 0.3
+    threading.Timer(0.5, prefork.stop).start()
+    prefork.run()
+    assert len(log.read().split()) > 2
+    assert not prefork.children
+
+
+def test_prefork_stop():
+    prefork = Prefork(lambda: time.sleep(10), 2)
+    threading.Timer(0.3, prefork.stop).start()
+    start = time.time()
+    prefork.run()
+    assert time.time() - start < 2
+
+
+def test_queue_order():
+    store = MemoryQueueStore()
+    for q in ('high', 'normal', 'low'):
+        store.push_many([(q, i, None) for i in range(20)])
+
+    def pop(order, count):
+        result = []
+        for _ in range(count):
+            queue, _ = store.pop(order(), 0.01)
+            order.served(queue)
+            result.append(queue)
+        return result
+
+    order = QueueOrder(['high:5', 'normal:3', 'low'])
+    served = pop(order, 18)
+    assert [served.count(q) for q in ('high', 'normal', 'low')] == [10, 6, 2]
+    assert served[:3] == ['high', 'normal', 'high']
+
+    store.pop_many('high', 10)
+    served = pop(order, 8)
+    assert [served.count(q) for q in ('high', 'normal', 'low')] == [0, 6, 2]
+    assert order.credit['high'] == 0
+
+    assert pop(QueueOrder(['high', 'normal']), 2) == ['normal', 'normal']
+
+    order = QueueOrder(['normal:10', 'low:1'], aging=5)
+    assert order() == ['normal', 'low']
+    order.served('normal')
+    assert order(now=time.time() + 10) == ['low', 'normal']
+    order.served(None)
+    assert order() == ['normal', 'low']
+    assert order.credit == {'normal': 0, 'low': 0}